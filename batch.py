@@ -0,0 +1,221 @@
+import base64
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from cycles import InfiniteLoop
+from interpreter import MusicCoderInterpreter, StepLimitExceeded
+from streams import MemoryInput, MemoryOutput
+from tape import DEFAULT_SIZE
+
+# Compiled programs kept per worker, keyed by source and options
+PROGRAM_CACHE_SIZE = 256
+
+# Most jobs run as the lanes of one lockstep engine, see run_batch()
+LOCKSTEP_LANES = 1024
+
+_programs = {}
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _init_worker():
+    # Workers run jobs in their main thread, so a SIGALRM timer can cut a
+    # job short. Ctrl-C is left to the parent.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'setitimer'):
+        signal.signal(signal.SIGALRM, _alarm)
+
+
+def _compile(source, optimize):
+    key = (hashlib.sha256(source.encode('utf-8')).digest(), optimize)
+    program = _programs.pop(key, None)
+    if program is None:
+        program = MusicCoderInterpreter(source, optimize=optimize).compile()
+        if len(_programs) >= PROGRAM_CACHE_SIZE:
+            del _programs[next(iter(_programs))]
+    _programs[key] = program # Most recently used last
+    return program
+
+
+def load_manifest(path):
+    # A manifest is a list of jobs, or {"defaults": {...}, "jobs": [...]}
+    # where every job inherits the defaults. Job keys:
+    #   id            reported back with the result (default: position)
+    #   file/source   program path (relative to the manifest) or inline code
+    #   stdin         program input as text, or stdin_base64 as raw bytes
+    #   max_steps     step budget
+    #   timeout       wall-clock limit in seconds
+    #   detect_cycles stop, with status "infinite_loop", once a loop provably never ends
+    #   optimize, binary, tape_size, max_tape_size as for the interpreter
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    base = os.path.dirname(os.path.abspath(path))
+
+    jobs = []
+    for i, entry in enumerate(manifest['jobs']):
+        job = dict(defaults)
+        job.update(entry)
+        job.setdefault('id', i)
+        if 'file' in job:
+            job['file'] = os.path.join(base, job['file'])
+        jobs.append(job)
+    return jobs
+
+
+def _source(job):
+    if 'source' in job:
+        return job['source']
+    with open(job['file'], 'r') as f:
+        return f.read()
+
+
+def _stdin(job):
+    if 'stdin_base64' in job:
+        return base64.b64decode(job['stdin_base64'])
+    return job.get('stdin', '').encode('latin-1', 'replace')
+
+
+def _output(result, job, data):
+    if job.get('binary'):
+        result['output_base64'] = base64.b64encode(data).decode('ascii')
+    else:
+        result['output'] = data.decode('latin-1')
+
+
+def run_job(job):
+    # Runs one job and returns its result as a dict, never raising
+    result = {'id': job.get('id')}
+    start = time.perf_counter()
+    output = MemoryOutput()
+    interpreter = None
+    timeout = job.get('timeout')
+    timer = timeout and hasattr(signal, 'setitimer')
+
+    try:
+        source = _source(job)
+        data = _stdin(job)
+
+        interpreter = MusicCoderInterpreter(source, input_source=MemoryInput(data), output_sink=output,
+                                            tape_size=job.get('tape_size', DEFAULT_SIZE),
+                                            max_tape_size=job.get('max_tape_size'))
+        interpreter.program = _compile(source, bool(job.get('optimize')))
+        interpreter.count_steps = True
+        interpreter.max_steps = job.get('max_steps')
+        interpreter.detect_cycles = bool(job.get('detect_cycles'))
+
+        if timer:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            interpreter.run()
+        finally:
+            if timer:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        result['status'] = 'ok'
+    except StepLimitExceeded:
+        result['status'] = 'step_limit'
+    except InfiniteLoop as e:
+        result['status'] = 'infinite_loop'
+        result['error'] = str(e)
+    except JobTimeout:
+        result['status'] = 'timeout'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {e}"
+
+    result['steps'] = interpreter.steps if interpreter is not None else 0
+    result['seconds'] = round(time.perf_counter() - start, 6)
+    _output(result, job, output.getvalue())
+    return result
+
+
+def run_lockstep_jobs(jobs):
+    # Runs jobs that share a program and tape settings as the lanes of one
+    # lockstep.LockstepEngine. Results are as from run_job, with "seconds"
+    # the time of the whole group; if the group cannot run at all, every
+    # job is run on its own instead.
+    from lockstep import LockstepEngine # Needs NumPy, only loaded when used
+    start = time.perf_counter()
+    first = jobs[0]
+    try:
+        program = _compile(_source(first), bool(first.get('optimize')))
+        engine = LockstepEngine(program, [_stdin(job) for job in jobs], [job.get('max_steps') for job in jobs],
+                                first.get('tape_size', DEFAULT_SIZE), first.get('max_tape_size'))
+        lanes = engine.run()
+    except Exception:
+        return [run_job(job) for job in jobs]
+
+    seconds = round(time.perf_counter() - start, 6)
+    results = []
+    for job, lane in zip(jobs, lanes):
+        result = {'id': job.get('id'), 'status': lane['status']}
+        if 'error' in lane:
+            result['error'] = lane['error']
+        result['steps'] = lane['steps']
+        result['seconds'] = seconds
+        _output(result, job, lane['output'])
+        results.append(result)
+    return results
+
+
+def _run_jobs(jobs):
+    if len(jobs) == 1:
+        return [run_job(jobs[0])]
+    return run_lockstep_jobs(jobs)
+
+
+def lockstep_groups(jobs, workers):
+    # Splits jobs into lists that run together: jobs with the same program
+    # and tape settings, no timeout and no cycle detection share a lockstep
+    # run, in groups small enough to keep every worker busy; other jobs run
+    # alone
+    shared = {}
+    tasks = []
+    for job in jobs:
+        if job.get('timeout') or job.get('detect_cycles'):
+            tasks.append([job])
+            continue
+        key = (job.get('source'), job.get('file'), bool(job.get('optimize')),
+               job.get('tape_size', DEFAULT_SIZE), job.get('max_tape_size'))
+        shared.setdefault(key, []).append(job)
+    for group in shared.values():
+        size = min(LOCKSTEP_LANES, -(-len(group) // workers))
+        tasks.extend(group[i:i + size] for i in range(0, len(group), size))
+    return tasks
+
+
+def run_batch(jobs, out=None, workers=None, lockstep=False):
+    # Runs the jobs across a process pool and writes one JSON line per
+    # result to `out` as soon as it finishes, in completion order.
+    # With lockstep, jobs that share a program run together, see
+    # lockstep.py. Returns the number of jobs that did not finish with
+    # status "ok".
+    out = out if out is not None else sys.stdout
+    workers = workers or os.cpu_count() or 1
+    if lockstep:
+        tasks = lockstep_groups(jobs, workers)
+    else:
+        tasks = [[job] for job in jobs]
+    chunksize = max(1, min(16, len(tasks) // (workers * 4)))
+    failed = 0
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        for results in pool.imap_unordered(_run_jobs, tasks, chunksize):
+            for result in results:
+                if result['status'] != 'ok':
+                    failed += 1
+                out.write(json.dumps(result) + "\n")
+            out.flush()
+    return failed
@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bytecode import VERSION
+from interpreter import MusicCoderInterpreter, scan
+from streams import MemoryInput, MemoryOutput
+from mc2xml import MC2XML
+from xml2mc import XML2MC
+from mc2mid import MC2MID
+from mid2mc import MID2MC
+from workloads import WORKLOADS, XML_WORKLOADS
+
+# Run stages: (name, interpreter options)
+BACKENDS = [
+    ('run', {}),
+    ('run_optimized', {'optimize': True}),
+    ('run_codegen', {'optimize': True, 'backend': 'codegen'}),
+]
+
+# A stage is a regression when it takes this much longer than the baseline,
+# and by more than MIN_SECONDS, below which timings are mostly noise
+DEFAULT_THRESHOLD = 0.2
+MIN_SECONDS = 0.005
+
+
+def measure(setup, stage, repeat, memory=True):
+    # Best wall time of `repeat` runs, then one more run under tracemalloc
+    # for the peak memory allocated by the stage itself.
+    best = None
+    for i in range(repeat):
+        state = setup()
+        gc.collect()
+        start = time.perf_counter()
+        stage(state)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    if not memory:
+        return {'seconds': best, 'peak_bytes': None}
+
+    state = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage(state)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def interpreter_for(source, data, **options):
+    return MusicCoderInterpreter(source, input_source=MemoryInput(data), output_sink=MemoryOutput(), **options)
+
+
+def bench_program(source, data, repeat, memory):
+    stages = {}
+
+    stages['tokenize'] = measure(lambda: source, lambda text: list(scan(text)), repeat, memory)
+
+    def tokenized():
+        interpreter = interpreter_for(source, data)
+        interpreter.tokens = list(scan(source))
+        return interpreter
+    stages['build_loop_map'] = measure(tokenized, lambda i: i.build_loop_map(), repeat, memory)
+
+    stages['compile'] = measure(lambda: interpreter_for(source, data), lambda i: i.compile(), repeat, memory)
+
+    # Steps are counted once, as executed by the plain bytecode loop, and
+    # used for every backend so their steps/sec compare directly.
+    interpreter = interpreter_for(source, data)
+    interpreter.count_steps = True
+    interpreter.run()
+    steps = interpreter.steps
+
+    for name, options in BACKENDS:
+        def compiled():
+            interpreter = interpreter_for(source, data, **options)
+            interpreter.compile()
+            return interpreter
+        result = measure(compiled, lambda i: i.run(), repeat, memory)
+        result['steps_per_sec'] = steps / result['seconds'] if result['seconds'] else None
+        stages[name] = result
+
+    return {'source_bytes': len(source), 'input_bytes': len(data), 'steps': steps, 'stages': stages}
+
+
+def bench_xml(source, repeat, memory, directory):
+    mc_file = os.path.join(directory, 'score.mc')
+    xml_file = os.path.join(directory, 'score.musicxml')
+    with open(mc_file, 'w') as f:
+        f.write(source)
+
+    def parsed():
+        converter = MC2XML(mc_file)
+        converter.parse()
+        return converter
+
+    def generate(converter):
+        # generate_xml reports the file it wrote on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            converter.generate_xml(xml_file)
+
+    stages = {}
+    stages['mc2xml_parse'] = measure(lambda: MC2XML(mc_file), lambda c: c.parse(), repeat, memory)
+    stages['generate_xml'] = measure(parsed, generate, repeat, memory)
+    generate(parsed())
+    stages['xml2mc_parse'] = measure(lambda: XML2MC(xml_file), lambda c: c.parse(), repeat, memory)
+
+    # The same round trip through a Standard MIDI File
+    midi_file = os.path.join(directory, 'score.mid')
+
+    def generate_midi(converter):
+        with contextlib.redirect_stdout(io.StringIO()):
+            converter.generate_midi(midi_file)
+
+    stages['generate_midi'] = measure(lambda: MC2MID(mc_file), generate_midi, repeat, memory)
+    generate_midi(MC2MID(mc_file))
+    stages['mid2mc_parse'] = measure(lambda: MID2MC(midi_file), lambda c: c.parse(), repeat, memory)
+    return {'source_bytes': len(source), 'xml_bytes': os.path.getsize(xml_file),
+            'midi_bytes': os.path.getsize(midi_file), 'stages': stages}
+
+
+def compare(results, baseline, threshold):
+    # Returns (workload, stage, baseline seconds, seconds) for every stage
+    # that got slower than the threshold allows
+    regressions = []
+    for name, workload in results['workloads'].items():
+        base = baseline.get('workloads', {}).get(name)
+        if base is None:
+            continue
+        if base.get('size') != workload.get('size'):
+            print(f"{name}: size {workload.get('size')} differs from baseline {base.get('size')}, skipped",
+                  file=sys.stderr)
+            continue
+        for stage, result in workload['stages'].items():
+            before = base['stages'].get(stage)
+            if before is None or not before['seconds']:
+                continue
+            slower = result['seconds'] - before['seconds']
+            if slower > before['seconds'] * threshold and slower > MIN_SECONDS:
+                regressions.append((name, stage, before['seconds'], result['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MusicCoder interpreter and converters.")
+    parser.add_argument("workloads", nargs="*",
+                        help="Workloads to run (default all): " + ", ".join(list(WORKLOADS) + list(XML_WORKLOADS)))
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every workload size")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage, the best is reported")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the tracemalloc runs for peak memory, which are slow on large programs")
+    parser.add_argument("--output", metavar="FILE", help="Write the JSON results to FILE instead of stdout")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="Compare against saved results and exit with status 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+
+    names = args.workloads or list(WORKLOADS) + list(XML_WORKLOADS)
+    for name in names:
+        if name not in WORKLOADS and name not in XML_WORKLOADS:
+            parser.error(f"unknown workload: {name}")
+
+    results = {
+        'version': VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'workloads': {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            generator, size = WORKLOADS.get(name) or XML_WORKLOADS[name]
+            size = max(1, int(size * args.scale))
+            source, data = generator(size)
+            print(f"{name} (size {size})...", file=sys.stderr)
+            if name in WORKLOADS:
+                result = bench_program(source, data, args.repeat, not args.no_memory)
+            else:
+                result = bench_xml(source, args.repeat, not args.no_memory, directory)
+            results['workloads'][name] = dict(size=size, **result)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, stage, before, after in regressions:
+            print(f"REGRESSION {name}/{stage}: {before:.4f}s -> {after:.4f}s ({after / before - 1:+.0%})",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against " + args.baseline, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
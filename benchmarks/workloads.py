@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interpreter import NOTE_VALUES
+
+# One spelling per note value, e.g. 60 -> C4
+NAMES = {}
+for name, value in NOTE_VALUES.items():
+    NAMES.setdefault(value, name)
+
+# Subtracts 1 from the current cell, right after a rest (previous note 0)
+DECREMENT = "E-1 D#-1 D-1"
+
+
+# Generated programs, each returning (source, input bytes). `size` scales the
+# amount of work roughly linearly.
+
+def straight_line(size):
+    # A long score without loops, printing every third note
+    phrase = ["C4", "E4", "G4.", "R4", "B3", "R2", "C5", "A4", "F4.", "R4", "D4", "R2"]
+    return " ".join(phrase * size), b''
+
+
+def nested_loops(size, depth=3):
+    # Brainfuck loops nested `depth` deep, each counting a cell down from
+    # `count`, so the innermost body runs count ** depth times
+    count = max(2, min(127, round(size ** (1 / depth))))
+    parts = []
+    for level in range(depth):
+        parts += [NAMES[count], "|:", "R4"]
+    parts += ["C4", "E4", "G4", "C5"]
+    for level in range(depth):
+        parts += ["R2", DECREMENT, ":|"]
+    return " ".join(parts), b''
+
+
+def counted_loops(size):
+    # :|xN loops nested two deep, repeated
+    inner = "|: C4 E4 R4 G4 R2 :|x20"
+    outer = f"|: {inner} D4 A4 :|x10"
+    return " ".join([outer] * max(1, size // 200)), b''
+
+
+def next_cell_loops(size):
+    # :|R4 loops counted by the notes after them (C4 -> 60 times) and by
+    # the cell to the right of the pointer
+    from_notes = "|: C4 E4 R4 G4 R2 :|R4 C4"
+    from_cell = f"R4 {NAMES[60]} R2 |: D4 F4 R4 A4 R2 :|R4 R4 R2"
+    return " ".join([from_notes, from_cell] * max(1, size // 120)), b''
+
+
+def heavy_io(size):
+    # cat: reads a byte, writes it back, until input runs out
+    return "C4_ |: C4 C4. C4_ :|", bytes(range(1, 256)) * max(1, size // 255)
+
+
+def score(size):
+    # Everything the MusicXML converters handle: notes, rests, staccato and
+    # repeats with counts
+    phrase = "C4 E4. G4 R4 |: B3 D4 R4 A4. R2 :|x3 F#5 Bb3 R2 |: C5 R4 R2 :|R4 G4"
+    return " ".join([phrase] * size), b''
+
+
+# name -> (generator, default size)
+WORKLOADS = {
+    'straight_line': (straight_line, 1000),
+    'nested_loops': (nested_loops, 50000),
+    'counted_loops': (counted_loops, 20000),
+    'next_cell_loops': (next_cell_loops, 20000),
+    'heavy_io': (heavy_io, 100000),
+}
+
+# MusicXML round trip, mc2xml then xml2mc, and the same through MIDI
+XML_WORKLOADS = {
+    'score': (score, 1000),
+}
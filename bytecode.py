@@ -0,0 +1,215 @@
+import struct
+import sys
+from array import array
+
+# Opcodes for the compiled form of a MusicCoder program.
+# Every instruction is one entry in three parallel integer arrays:
+#   code[pc]  -> opcode
+#   arg[pc]   -> first operand
+#   arg2[pc]  -> second operand
+OP_HALT = 0
+OP_NOTE = 1         # arg = note value, arg2 = I/O flags
+OP_LEFT = 2         # R2
+OP_RIGHT = 3        # R4
+OP_LOOP = 4         # |: of a Brainfuck loop, arg = pc of matching :|
+OP_END_LOOP = 5     # :|,  arg = pc of matching |:
+OP_REPEAT = 6       # |: of a counted loop, arg = pc of matching :|, arg2 = count (-1 = infinite)
+OP_REPEAT_NEXT = 7  # |: of a :|R4 loop, arg = pc of matching :|
+OP_END_REPEAT = 8   # :|xN / :|x00 / :|R4, arg = pc of matching |:, arg2 = counter slot
+
+# Fused instructions, only produced by optimizer.py
+OP_ADD = 9          # run of notes, arg = delta (0-255), arg2 = previous note afterwards
+OP_MOVE = 10        # run of rests, arg = net move, arg2 = lowest offset reached (<= 0)
+OP_CLEAR = 11       # decrement-to-zero loop, arg = previous note if the loop ran
+OP_MULADD = 12      # move/multiply loop, arg = index into tables, arg2 = previous note if the loop ran
+OP_SCAN = 13        # |: R4 :| / |: R2 :|, arg = pointer step
+OP_OUT = 14         # write the current cell, the I/O of a note resolved at compile time
+OP_IN = 15          # read into the current cell, likewise
+OP_ADD_CELLS = 16   # counted loop run in closed form, arg = index into tables, arg2 = previous note afterwards
+
+OP_NAMES = {
+    OP_HALT: 'HALT',
+    OP_NOTE: 'NOTE',
+    OP_LEFT: 'REST_H',
+    OP_RIGHT: 'REST_Q',
+    OP_LOOP: 'LOOP_START',
+    OP_END_LOOP: 'LOOP_END',
+    OP_REPEAT: 'LOOP_START',
+    OP_REPEAT_NEXT: 'LOOP_START',
+    OP_END_REPEAT: 'LOOP_END',
+    OP_ADD: 'ADD',
+    OP_MOVE: 'MOVE',
+    OP_CLEAR: 'CLEAR',
+    OP_MULADD: 'MULADD',
+    OP_SCAN: 'SCAN',
+    OP_OUT: 'OUT',
+    OP_IN: 'IN',
+    OP_ADD_CELLS: 'ADD_CELLS',
+}
+
+# I/O flags of a NOTE
+STACCATO = 1
+LEGATO = 2
+
+INFINITE = -1
+MAX_COUNT = 2 ** 63 - 1
+
+# Bump whenever the opcodes, compile_tokens(), the optimizer or the
+# serialized layout below change, so stale cached programs are not loaded.
+VERSION = 4
+
+# Serialized layout: header, then code, arg, arg2 and positions as raw arrays
+# and the MULADD tables flattened into one array of (factor, low, n, offset, delta...).
+# Arrays are stored little-endian.
+MAGIC = b'MCC\0'
+HEADER = struct.Struct('<4sIQQQ') # magic, version, length, depth, table entries
+
+
+class Program:
+    def __init__(self):
+        self.code = array('B')
+        self.arg = array('q')
+        self.arg2 = array('q')
+        self.depth = 0 # Deepest loop nesting, sizes the counter slots
+        # MULADD operands: (iteration factor, lowest offset, ((offset, factor), ...)),
+        # ADD_CELLS operands: (1, lowest offset, ((offset, delta), ...))
+        self.tables = []
+        self.positions = array('q') # Source offset of each instruction, -1 if unknown
+
+    def __len__(self):
+        return len(self.code)
+
+    def emit(self, op, a=0, b=0, pos=-1):
+        self.code.append(op)
+        self.arg.append(a)
+        self.arg2.append(b)
+        self.positions.append(pos)
+        return len(self.code) - 1
+
+
+def compile_tokens(tokens):
+    # Tokens map one-to-one onto instructions, so pc values match token indices.
+    program = Program()
+    stack = []
+
+    for i, token in enumerate(tokens):
+        ctype = token['type']
+        pos = token.get('pos', -1)
+
+        if ctype == 'NOTE':
+            flags = 0
+            if token['staccato']:
+                flags |= STACCATO
+            if token['legato']:
+                flags |= LEGATO
+            program.emit(OP_NOTE, token['value'], flags, pos)
+
+        elif ctype == 'REST_H':
+            program.emit(OP_LEFT, 0, 0, pos)
+
+        elif ctype == 'REST_Q':
+            program.emit(OP_RIGHT, 0, 0, pos)
+
+        elif ctype == 'LOOP_START':
+            # The loop kind is only known at :|, patched below
+            stack.append(program.emit(OP_LOOP, 0, 0, pos))
+            program.depth = max(program.depth, len(stack))
+
+        elif ctype == 'LOOP_END':
+            if not stack:
+                raise SyntaxError("Unmatched :| at token {}".format(i))
+            start = stack.pop()
+
+            if token['count'] == 'BF':
+                program.code[start] = OP_LOOP
+                end = program.emit(OP_END_LOOP, start, 0, pos)
+            else:
+                if token['use_next_cell']:
+                    program.code[start] = OP_REPEAT_NEXT
+                elif token['infinite']:
+                    program.code[start] = OP_REPEAT
+                    program.arg2[start] = INFINITE
+                else:
+                    # count may still be None for a malformed suffix
+                    program.code[start] = OP_REPEAT
+                    program.arg2[start] = min(token['count'] or 0, MAX_COUNT)
+                end = program.emit(OP_END_REPEAT, start, len(stack), pos)
+            program.arg[start] = end
+
+    if stack:
+        raise SyntaxError("Unmatched |: at token {}".format(stack[0]))
+
+    program.emit(OP_HALT)
+    return program
+
+
+def next_count(program, end_pc):
+    # Iterations of a :|R4 loop taken from the plain notes after its end,
+    # by interval arithmetic from 0: (count, pc after those notes). The
+    # count is None when no such notes follow and the next cell decides.
+    code = program.code
+    arg = program.arg
+    arg2 = program.arg2
+    count = 0
+    local_prev = 0
+    pc = end_pc + 1
+    while code[pc] == OP_NOTE and not arg2[pc]:
+        v = arg[pc]
+        if v > local_prev:
+            count += v
+        elif v < local_prev:
+            count -= v
+        local_prev = v
+        pc += 1
+    if pc == end_pc + 1:
+        return None, pc
+    return count, pc
+
+
+def dumps(program):
+    flat = array('q')
+    for factor, low, targets in program.tables:
+        flat.extend((factor, low, len(targets)))
+        for offset, delta in targets:
+            flat.extend((offset, delta))
+    parts = [HEADER.pack(MAGIC, VERSION, len(program), program.depth, len(flat)), program.code.tobytes()]
+    for values in (program.arg, program.arg2, program.positions, flat):
+        if sys.byteorder == 'big':
+            values = array('q', values)
+            values.byteswap()
+        parts.append(values.tobytes())
+    return b''.join(parts)
+
+
+def loads(data):
+    if len(data) < HEADER.size:
+        raise ValueError("Truncated compiled program")
+    magic, version, length, depth, entries = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a compiled program for this version")
+    if len(data) != HEADER.size + length + 8 * (3 * length + entries):
+        raise ValueError("Truncated compiled program")
+
+    program = Program()
+    pos = HEADER.size
+    program.code.frombytes(data[pos:pos + length])
+    pos += length
+    arrays = []
+    for count in (length, length, length, entries):
+        values = array('q')
+        values.frombytes(data[pos:pos + 8 * count])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        arrays.append(values)
+        pos += 8 * count
+    program.arg, program.arg2, program.positions, flat = arrays
+    program.depth = depth
+
+    i = 0
+    while i < len(flat):
+        factor, low, n = flat[i], flat[i + 1], flat[i + 2]
+        i += 3
+        targets = tuple((flat[i + 2 * k], flat[i + 2 * k + 1]) for k in range(n))
+        program.tables.append((factor, low, targets))
+        i += 2 * n
+    return program
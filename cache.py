@@ -0,0 +1,111 @@
+import hashlib
+import os
+
+from bytecode import VERSION, dumps, loads
+
+# Total size of the cache directory before the least recently used
+# programs are evicted
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+EXTENSION = '.mcc'
+
+
+def default_directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'musiccoder')
+
+
+# Compiled programs on disk, one .mcc file per program named after a hash of
+# its source, the bytecode VERSION and the compile options. A hit skips
+# tokenizing and compiling entirely. Hits refresh the file's mtime, which
+# orders eviction once the directory grows past max_size bytes.
+class ProgramCache:
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory if directory is not None else default_directory()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, optimize=False):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        digest = hashlib.sha256()
+        digest.update(f"musiccoder {VERSION} optimize={int(bool(optimize))}\n".encode('ascii'))
+        digest.update(source)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + EXTENSION)
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                program = loads(f.read())
+        except (OSError, ValueError):
+            # Missing, unreadable or written by another version
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return program
+
+    def store(self, key, program):
+        # Written under a temporary name and renamed, so a concurrent run
+        # never sees half a file. A read-only cache is not an error.
+        path = self.path(key)
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temp, 'wb') as f:
+                f.write(dumps(program))
+            os.replace(temp, path)
+        except OSError:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith(EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith(EXTENSION):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
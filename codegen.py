@@ -0,0 +1,315 @@
+from bytecode import (
+    OP_NOTE, OP_LEFT, OP_RIGHT, OP_LOOP, OP_REPEAT_NEXT,
+    OP_ADD, OP_MOVE, OP_CLEAR, OP_MULADD, OP_SCAN, OP_OUT, OP_IN, OP_ADD_CELLS,
+    STACCATO, LEGATO, INFINITE, next_count
+)
+
+# CPython refuses more than 20 statically nested blocks in one function,
+# and fused loops add up to three more inside the innermost loop.
+MAX_NESTING = 17
+
+# Compiled code objects keyed by generated source, oldest evicted first
+CACHE_SIZE = 64
+_code_cache = {}
+
+
+# Translates a compiled Program into straight-line Python source.
+# The previous note is resolved while generating wherever it is known (at
+# the start, after rests and after the first note of a run), so only the
+# first note after a loop boundary compares against `prev` at run time.
+class CodeGenerator:
+    def __init__(self, program, ranges=None, size=0):
+        self.program = program
+        # PointerRanges of the run and the tape length it starts with: bounds
+        # checks are left out where the pointer provably stays on the tape
+        self.ranges = ranges
+        self.size = size
+        self.lines = []
+        self.indent = 1
+        self.nesting = 0
+        self.loop_id = 0
+        self.known = 0 # Previous note if known while generating, else None
+        self.synced = True # Whether the run-time `prev` already holds self.known
+
+    def generate(self):
+        self.lines.append("def mc_main(t, p, write, read):")
+        self.line("prev = 0")
+        self._block(0, len(self.program) - 1)
+        self.line("return p")
+        return "\n".join(self.lines) + "\n"
+
+    def line(self, text):
+        self.lines.append("    " * self.indent + text)
+
+    def _open(self, header):
+        self.line(header)
+        self.indent += 1
+        self.nesting += 1
+        if self.nesting > MAX_NESTING:
+            raise SyntaxError("Loops nested too deeply for the codegen backend")
+
+    def _close(self):
+        self.indent -= 1
+        self.nesting -= 1
+
+    def _sync(self):
+        if self.known is not None and not self.synced:
+            self.line(f"prev = {self.known}")
+            self.synced = True
+
+    def _set_prev(self, value):
+        self.known = value
+        self.synced = False
+
+    def _block(self, start, end):
+        code = self.program.code
+        arg = self.program.arg
+        arg2 = self.program.arg2
+
+        pc = start
+        while pc < end:
+            op = code[pc]
+
+            if op == OP_NOTE:
+                j = pc
+                while code[j] == OP_NOTE:
+                    j += 1
+                self._notes(pc, j)
+                pc = j
+
+            elif op == OP_RIGHT:
+                self._move(pc, 1, 0)
+                pc += 1
+
+            elif op == OP_LEFT:
+                self._move(pc, -1, -1)
+                pc += 1
+
+            elif op == OP_MOVE:
+                self._move(pc, arg[pc], arg2[pc])
+                pc += 1
+
+            elif op == OP_ADD:
+                self._actions([('add', arg[pc])])
+                self._set_prev(arg2[pc])
+                pc += 1
+
+            elif op == OP_OUT:
+                self._actions([('io', STACCATO)])
+                pc += 1
+
+            elif op == OP_IN:
+                self._actions([('io', LEGATO)])
+                pc += 1
+
+            elif op == OP_CLEAR:
+                self._conditional(["t[p] = 0"], arg[pc])
+                pc += 1
+
+            elif op == OP_MULADD:
+                factor, low, targets = self.program.tables[arg[pc]]
+                body = []
+                if self._below(pc, low):
+                    body += [f"if p < {-low}:", "    raise RuntimeError('Pointer moved left of 0')"]
+                body.append(f"n = t[p] * {factor} & 0xFF")
+                for offset, delta in targets:
+                    if self._beyond(pc, offset):
+                        body += [f"if p + {offset} >= len(t):", f"    t.grow(p + {offset})"]
+                    body.append(f"t[p + {offset}] = (t[p + {offset}] + n * {delta}) & 0xFF")
+                body.append("t[p] = 0")
+                self._conditional(body, arg2[pc])
+                pc += 1
+
+            elif op == OP_ADD_CELLS:
+                factor, low, targets = self.program.tables[arg[pc]]
+                if self._below(pc, low):
+                    self.line(f"if p < {-low}:")
+                    self.line("    raise RuntimeError('Pointer moved left of 0')")
+                for offset, delta in targets:
+                    if self._beyond(pc, offset):
+                        self.line(f"if p + {offset} >= len(t):")
+                        self.line(f"    t.grow(p + {offset})")
+                    if delta:
+                        self.line(f"t[p + {offset}] = (t[p + {offset}] + {delta}) & 0xFF")
+                self._set_prev(arg2[pc])
+                pc += 1
+
+            elif op == OP_SCAN:
+                step = arg[pc]
+                body = ["while t[p]:", f"    p += {step}"]
+                if step < 0:
+                    body += ["    if p < 0:", "        raise RuntimeError('Pointer moved left of 0')"]
+                else:
+                    body += ["    if p >= len(t):", "        t.grow(p)"]
+                self._conditional(body, 0)
+                pc += 1
+
+            else:
+                pc = self._loop(pc)
+
+    def _below(self, pc, offset):
+        # Whether p + offset may be negative at pc
+        return offset < 0 and not (self.ranges is not None and self.ranges.floor_safe(pc, offset))
+
+    def _beyond(self, pc, offset):
+        # Whether p + offset may be past the end of the tape at pc
+        return offset > 0 and not (self.ranges is not None and self.ranges.fits(pc, offset, self.size))
+
+    def _move(self, pc, offset, low):
+        if self._below(pc, low):
+            self.line(f"if p < {-low}:")
+            self.line("    raise RuntimeError('Pointer moved left of 0')")
+        if offset > 0:
+            self.line(f"p += {offset}")
+        elif offset < 0:
+            self.line(f"p -= {-offset}")
+        if self._beyond(pc, offset):
+            self.line("if p >= len(t):")
+            self.line("    t.grow(p)")
+        self._set_prev(0)
+
+    def _conditional(self, body, prev):
+        # Fused loops only leave `prev` behind when they ran at least once
+        changes_prev = self.known != prev
+        if changes_prev:
+            self._sync()
+        self.line("if t[p]:")
+        for text in body:
+            self.line("    " + text)
+        if changes_prev:
+            self.line(f"    prev = {prev}")
+            self._set_prev(None)
+
+    def _static_run(self, start, end, prev):
+        # Resolves a run of notes against a known previous note into
+        # ('add', delta) and ('io', flags) actions, in execution order.
+        arg = self.program.arg
+        arg2 = self.program.arg2
+        actions = []
+        pc = start
+        while pc < end:
+            v = arg[pc]
+            flags = arg2[pc]
+            if v > prev:
+                actions.append(('add', v))
+            elif v < prev:
+                actions.append(('add', -v))
+            elif pc + 1 < end:
+                pc += 1
+                actions.append(('add', arg[pc] - v))
+                actions.append(('io', arg2[pc]))
+                v = arg[pc]
+            actions.append(('io', flags))
+            prev = v
+            pc += 1
+        return actions, prev
+
+    def _add(self, delta):
+        if delta & 0xFF:
+            self.line(f"t[p] = (t[p] + {delta & 0xFF}) & 0xFF")
+
+    def _actions(self, actions):
+        # Consecutive adds collapse into one, I/O flushes them
+        delta = 0
+        for kind, value in actions:
+            if kind == 'add':
+                delta += value
+            elif value:
+                self._add(delta)
+                delta = 0
+                if value & STACCATO:
+                    self.line("write(t[p])")
+                if value & LEGATO:
+                    self.line("t[p] = read()")
+        self._add(delta)
+
+    def _notes(self, start, end):
+        if self.known is not None:
+            actions, prev = self._static_run(start, end, self.known)
+            self._actions(actions)
+            self._set_prev(prev)
+            return
+
+        arg = self.program.arg
+        arg2 = self.program.arg2
+        v = arg[start]
+
+        if start + 1 < end:
+            # Equal to the previous note: consume the next note instead
+            self._open(f"if prev == {v}:")
+            branch_start = len(self.lines)
+            actions, prev = self._static_run(start + 2, end, arg[start + 1])
+            self._actions([('add', arg[start + 1] - v), ('io', arg2[start + 1]), ('io', arg2[start])] + actions)
+            if len(self.lines) == branch_start:
+                self.line("pass")
+            self._close()
+            self._open("else:")
+
+        if v > 0:
+            self.line(f"if prev < {v}:")
+            self.line(f"    t[p] = (t[p] + {v}) & 0xFF")
+        if v < 127:
+            self.line(f"{'elif' if v > 0 else 'if'} prev > {v}:")
+            self.line(f"    t[p] = (t[p] - {v}) & 0xFF")
+        actions, prev = self._static_run(start + 1, end, v)
+        self._actions([('io', arg2[start])] + actions)
+
+        if start + 1 < end:
+            self._close()
+        self._set_prev(prev)
+
+    def _loop(self, pc):
+        code = self.program.code
+        arg = self.program.arg
+        arg2 = self.program.arg2
+        op = code[pc]
+        end_pc = arg[pc]
+        after = end_pc + 1
+
+        self._sync()
+        self.loop_id += 1
+
+        if op == OP_LOOP:
+            self._open("while t[p]:")
+        else:
+            if op == OP_REPEAT_NEXT:
+                # :|R4 counts come from the notes after the loop when there are
+                # any, which are then never executed; else from the next cell.
+                count, after = next_count(self.program, end_pc)
+            else:
+                count = arg2[pc]
+
+            if count is None:
+                name = f"n{self.loop_id}"
+                self.line(f"{name} = t[p + 1] if p + 1 < len(t) else 0")
+                self._open(f"for _ in range({name} or 1):")
+            elif count == INFINITE:
+                self._open("while True:")
+            else:
+                self._open(f"for _ in range({max(count, 1)}):")
+
+        body_start = len(self.lines)
+        self._set_prev(None)
+        self._block(pc + 1, end_pc)
+        self._sync()
+        if len(self.lines) == body_start:
+            self.line("pass")
+        self._close()
+        self._set_prev(None)
+        return after
+
+
+def generate(program, ranges=None, size=0):
+    return CodeGenerator(program, ranges, size).generate()
+
+
+def compile_source(source):
+    code = _code_cache.get(source)
+    if code is None:
+        code = compile(source, "<musiccoder>", "exec")
+        if len(_code_cache) >= CACHE_SIZE:
+            del _code_cache[next(iter(_code_cache))]
+        _code_cache[source] = code
+    namespace = {}
+    exec(code, namespace)
+    return namespace['mc_main']
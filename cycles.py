@@ -0,0 +1,57 @@
+# Proof that a run never halts, found while it runs: the machine state at
+# the back-jumps of loops is compared with a saved state, re-saved after
+# 1, 2, 4, 8, ... back-jumps (Brent's scheme). A deterministic machine that
+# comes back to a state it was in, having read and written nothing since,
+# goes round the same cycle forever. A cycle of n back-jumps starting after
+# back-jump m is found within about 2 * max(m, n) back-jumps.
+#
+# The state is the pc, pointer, previous note, counted-loop counters and
+# skips, and the tape. The cheap parts are compared first; the tape bytes,
+# only when they all match. Tape that grew since the save counts as changed,
+# which only delays detection to the next save.
+
+
+class InfiniteLoop(RuntimeError):
+    def __init__(self, message, pc, length):
+        super().__init__(message)
+        self.pc = pc # The loop end where the state repeated
+        self.length = length # Back-jumps in one turn of the cycle
+
+
+class CycleDetector:
+    def __init__(self):
+        self.io = 0 # Reads and writes so far
+        self.saved = None # (pc, ptr, prev, io, counters, skips, tape)
+        self.power = 1 # Back-jumps between saves
+        self.count = 0 # Back-jumps since the last save
+        self.checks = 0
+
+    def watch(self, write, read):
+        # Wrappers that count I/O, for the dispatch loop to call instead
+        def counted_write(value):
+            self.io += 1
+            write(value)
+
+        def counted_read():
+            self.io += 1
+            return read()
+
+        return counted_write, counted_read
+
+    def check(self, pc, ptr, prev, counters, skips, tape):
+        # Called at every back-jump taken; raises InfiniteLoop when the
+        # state is the saved one again
+        self.checks += 1
+        saved = self.saved
+        if (saved is not None and saved[0] == pc and saved[1] == ptr and saved[2] == prev
+                and saved[3] == self.io and saved[4] == counters and saved[5] == skips
+                and saved[6][ptr] == tape[ptr] and saved[6] == tape):
+            length = self.count + 1
+            raise InfiniteLoop(f"Loop ending at instruction {pc} is back in the same state every {length} "
+                               f"back-jump{'s' if length > 1 else ''}, with no input or output, so it never ends",
+                               pc, length)
+        self.count += 1
+        if self.count >= self.power:
+            self.saved = (pc, ptr, prev, self.io, list(counters), list(skips), bytes(tape))
+            self.power *= 2
+            self.count = 0
@@ -0,0 +1,251 @@
+import re
+from interpreter import TOKEN_PATTERN, MusicCoderInterpreter, _make_token
+
+LOOP_TYPES = ('LOOP_START', 'LOOP_END')
+
+# What may come between a bare :| and the xN or R4 it takes
+LOOP_END_GAP = re.compile(r'(?:\s|<!--[^>]*>)*')
+
+
+def _bisect(tokens, offset, position, right=False):
+    # Index of the first token starting at or after offset (after, when
+    # right), like bisect with a key, which needs Python 3.10
+    low, high = 0, len(tokens)
+    while low < high:
+        middle = (low + high) // 2
+        pos = position(tokens[middle])
+        if pos < offset or right and pos == offset:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# An editable score that keeps its tokens, loop pairs and errors up to date
+# as edits come in, re-scanning only around each edit.
+#
+# Tokens are the dicts scan() gives, plus 'length', and INVALID tokens for
+# notes out of range. Comments and bar lines are not kept. Token positions
+# use a gap: tokens before `gap` hold their offset in the text, the rest
+# their offset from the end of the text (always negative), so an edit only
+# renumbers the tokens between the last edit and this one. A loop sign's
+# matching sign is its 'match' entry, None when unmatched.
+class Document:
+    def __init__(self, text=''):
+        self.text = text
+        self.lexemes = self._scan(0, None)[0]
+        self.gap = len(self.lexemes)
+        self.loops = [token for token in self.lexemes if token['type'] in LOOP_TYPES] # In order
+        self.invalid = {id(token): token for token in self.lexemes if token['type'] == 'INVALID'}
+        self.unmatched = [] # Loop signs without a match
+        self._pair()
+
+    def position(self, token):
+        pos = token['pos']
+        return pos if pos >= 0 else pos + len(self.text)
+
+    def _move_gap(self, index):
+        lexemes = self.lexemes
+        size = len(self.text)
+        for i in range(index, self.gap):
+            lexemes[i]['pos'] -= size
+        for i in range(self.gap, index):
+            lexemes[i]['pos'] += size
+        self.gap = index
+
+    def _index(self, offset):
+        # Number of tokens starting before offset
+        return _bisect(self.lexemes, offset, self.position)
+
+    def _scan(self, start, stop):
+        # Tokens from `start`, until one starts at `stop(pos)` truthy:
+        # (tokens, pos of the token that stopped the scan or None)
+        tokens = []
+        for match in TOKEN_PATTERN.finditer(self.text, start):
+            pos = match.start()
+            if stop is not None and stop(pos):
+                return tokens, pos
+            kind = match.lastgroup
+            if kind == 'comment' or kind == 'bar':
+                continue
+            try:
+                token = _make_token(match)
+            except ValueError as e:
+                token = {'type': 'INVALID', 'error': str(e)}
+            token['pos'] = pos
+            token['length'] = match.end() - pos
+            tokens.append(token)
+        return tokens, None
+
+    def edit(self, start, end, new_text):
+        # Replaces text[start:end] with new_text
+        text = self.text
+        # Re-scan from the token before the edit, which may grow into it (a
+        # note taking a suffix, a bare :| an xN or R4) or, with the junk
+        # before the edit, start a new token. A "<!--" before the edit with
+        # no ">" in between starts the re-scan instead when the edit can
+        # change where it closes: it was closed after the edit, or the edit
+        # brings a ">". A bare :| with only spaces and comments between it
+        # and the re-scan may take an xN or R4 the edit makes, so the
+        # re-scan starts at it.
+        first = self._index(start) - 1
+        if first < 0:
+            first = restart = 0
+        else:
+            restart = self.position(self.lexemes[first])
+        opened = text.find('<!--', text.rfind('>', 0, start) + 1, start)
+        if opened != -1 and ('>' in new_text or text.find('>', start) != -1):
+            restart = min(restart, opened)
+            first = min(first, self._index(restart))
+        before = self._index(restart) - 1
+        if before >= 0:
+            token = self.lexemes[before]
+            pos = self.position(token)
+            if (token['type'] == 'LOOP_END' and token['length'] == 2
+                    and LOOP_END_GAP.fullmatch(text, pos + 2, restart)):
+                restart = pos
+                first = min(first, before)
+        self._move_gap(first)
+
+        self.text = text = text[:start] + new_text + text[end:]
+        size = len(text)
+        edited_end = start + len(new_text)
+        lexemes = self.lexemes
+        # Tokens from `first` on are relative to the end of the text, so
+        # pos + size is where an untouched old token now starts
+        last = [first]
+
+        def resync(pos):
+            # The scan is back in step once it reaches, past the edit, the
+            # start of an old token: everything after matches as before
+            if pos < edited_end:
+                return False
+            j = last[0]
+            while j < len(lexemes) and lexemes[j]['pos'] + size < pos:
+                j += 1
+            last[0] = j
+            return j < len(lexemes) and lexemes[j]['pos'] + size == pos
+
+        tokens, stopped = self._scan(restart, resync)
+        removed = lexemes[first:last[0]] if stopped is not None else lexemes[first:]
+        stop = first + len(removed)
+
+        for token in removed:
+            if token['type'] == 'INVALID':
+                del self.invalid[id(token)]
+        for token in tokens:
+            if token['type'] == 'INVALID':
+                self.invalid[id(token)] = token
+        lexemes[first:stop] = tokens
+        self.gap = first + len(tokens)
+
+        old_loops = [token for token in removed if token['type'] in LOOP_TYPES]
+        new_loops = [token for token in tokens if token['type'] in LOOP_TYPES]
+        if old_loops or new_loops:
+            if old_loops:
+                at = self._loop_index(old_loops[0])
+            else:
+                at = _bisect(self.loops, restart, self.position)
+            self.loops[at:at + len(old_loops)] = new_loops
+            self._repair(old_loops, new_loops)
+        # Where the token list changed: index, tokens removed, tokens added
+        return first, len(removed), len(tokens)
+
+    def _loop_index(self, token):
+        # Index in self.loops of a loop sign still in it, found by position
+        # before the text changed: its pos is end-relative from the gap on
+        at = _bisect(self.loops, token['pos'] + len(self.text), self.position)
+        while self.loops[at] is not token:
+            at += 1
+        return at
+
+    def _residue(self, signs, link):
+        # Pairs loop signs among themselves, setting 'match' when `link`:
+        # (closing signs left unmatched, opening signs left unmatched)
+        stack = []
+        closes = []
+        for token in signs:
+            if token['type'] == 'LOOP_START':
+                stack.append(token)
+            elif stack:
+                opening = stack.pop()
+                if link:
+                    opening['match'] = token
+                    token['match'] = opening
+            else:
+                closes.append(token)
+        return closes, stack
+
+    def _repair(self, old_loops, new_loops):
+        # Outside an edit, pairs only depend on how many signs inside it are
+        # left unmatched each way. When those counts are unchanged, the new
+        # leftover signs take the partners of the old ones, in order;
+        # otherwise every sign is paired again.
+        old_closes, old_opens = self._residue(old_loops, False)
+        new_closes, new_opens = self._residue(new_loops, True)
+        if len(old_closes) != len(new_closes) or len(old_opens) != len(new_opens):
+            self._pair()
+            return
+        replaced = {}
+        for old, new in zip(old_closes + old_opens, new_closes + new_opens):
+            match = old['match']
+            new['match'] = match
+            if match is not None:
+                match['match'] = new
+            replaced[id(old)] = new
+        self.unmatched = [replaced.get(id(token), token) for token in self.unmatched]
+
+    def _pair(self):
+        # Pairs every loop sign again, after an edit that changed their order
+        stack = []
+        unmatched = []
+        for token in self.loops:
+            if token['type'] == 'LOOP_START':
+                stack.append(token)
+            elif stack:
+                opening = stack.pop()
+                opening['match'] = token
+                token['match'] = opening
+            else:
+                token['match'] = None
+                unmatched.append(token)
+        for token in stack:
+            token['match'] = None
+        self.unmatched = unmatched + stack
+
+    def error_count(self):
+        return len(self.invalid) + len(self.unmatched)
+
+    def diagnostics(self):
+        # (offset, message) for every invalid note and unmatched loop sign,
+        # in source order
+        found = [(self.position(token), token['error']) for token in self.invalid.values()]
+        for token in self.unmatched:
+            sign = '|:' if token['type'] == 'LOOP_START' else ':|'
+            found.append((self.position(token), f"Unmatched {sign}"))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def token_at(self, offset):
+        # The token whose text covers offset, else None
+        i = _bisect(self.lexemes, offset, self.position, right=True) - 1
+        if i >= 0 and offset < self.position(self.lexemes[i]) + self.lexemes[i]['length']:
+            return self.lexemes[i]
+        return None
+
+    def tokens(self):
+        # Tokens as tokenize() gives them, with their offsets in the text
+        self._move_gap(len(self.lexemes))
+        return [token for token in self.lexemes if token['type'] != 'INVALID']
+
+    def interpreter(self, **options):
+        # A MusicCoderInterpreter over the text that skips scanning it,
+        # raising the first error tokenize() would
+        if self.invalid:
+            raise ValueError(min(self.invalid.values(), key=self.position)['error'])
+        if self.unmatched:
+            raise SyntaxError(self.diagnostics()[0][1])
+        interpreter = MusicCoderInterpreter(self.text, **options)
+        interpreter.tokens = self.tokens()
+        interpreter.build_loop_map()
+        return interpreter
@@ -1,118 +1,247 @@
-import sys
+import asyncio
+import io
 import re
+import sys
+import time
+import struct
+import argparse
+from array import array
+from bytecode import (
+    compile_tokens, dumps, loads, VERSION, OP_HALT, OP_NOTE, OP_LEFT, OP_RIGHT, OP_LOOP, OP_END_LOOP,
+    OP_REPEAT, OP_REPEAT_NEXT, OP_END_REPEAT, OP_ADD, OP_MOVE, OP_CLEAR, OP_MULADD,
+    OP_SCAN, OP_OUT, OP_IN, OP_ADD_CELLS, OP_NAMES, STACCATO, LEGATO, INFINITE
+)
+from optimizer import optimize as optimize_program
+from codegen import generate, compile_source
+from tape import Tape, DEFAULT_SIZE
+from streams import OutputSink, InputSource, MemoryInput, MemoryOutput, AsyncInput, DEFAULT_BUFFER_SIZE
+from cache import ProgramCache, DEFAULT_MAX_SIZE
+from profiler import Profile
+from ranges import PointerRanges
+from tracer import Trace
+from cycles import CycleDetector
+
+# Note values (MIDI numbers, C-1=0 C4=60), shared by every interpreter
+NOTE_VALUES = {}
+PITCH_CLASSES = {
+    'C': 0, 'C#': 1, 'DB': 1,
+    'D': 2, 'D#': 3, 'EB': 3,
+    'E': 4,
+    'F': 5, 'F#': 6, 'GB': 6,
+    'G': 7, 'G#': 8, 'AB': 8,
+    'A': 9, 'A#': 10, 'BB': 10,
+    'B': 11
+}
+
+for name, base_val in PITCH_CLASSES.items():
+    for octave in range(-1, 11): # -1 to 10
+        midi_val = base_val + octave * 12 + 12 # Standard MIDI (C-1=0, C0=12, C4=60)
+        if 0 <= midi_val <= 127:
+            NOTE_VALUES[f"{name}{octave}"] = midi_val
+
+# Single-pass scanner, one named group per token kind:
+# <!-- ... >      -> Comment (skipped)
+# |:              -> Start Loop
+# :|              -> End Loop, optionally followed (after whitespace or comments) by xN or R4
+# R4 / R2         -> Quarter Rest (Right) / Half Rest (Left)
+# |               -> Bar Line (Cosmetic)
+# C#4._           -> Note (optional sharp/flat) (optional octave) (suffixes: . _)
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment><!--[^>]*>)
+  | (?P<loop_start>\|:)
+  | (?P<loop_end>:\|(?:(?:\s|<!--[^>]*>)*(?:x(?P<count>\d+)|(?P<next_cell>R4)))?)
+  | (?P<rest_q>R4)
+  | (?P<rest_h>R2)
+  | (?P<bar>\|)
+  | (?P<note>(?P<name>[A-G](?:\#|b)?)(?P<octave>-?\d?)(?P<suffix>[._]*))
+""", re.IGNORECASE | re.VERBOSE)
+
+# Characters read per chunk by scan_stream()
+SCAN_CHUNK_SIZE = 65536
+
+
+def _make_token(match):
+    kind = match.lastgroup
+
+    if kind == 'note':
+        note_name = match.group('name').upper()
+        # Default Octave is 4 if not specified
+        octave = match.group('octave') or "4"
+        val = NOTE_VALUES.get(f"{note_name}{octave}")
+        if val is None:
+            raise ValueError(f"Invalid or out-of-range note: {match.group().upper()}")
+        suffixes = match.group('suffix')
+        return {
+            'type': 'NOTE',
+            'value': val,
+            'name': note_name,
+            'octave': octave,
+            'staccato': '.' in suffixes,
+            'legato': '_' in suffixes
+        }
+
+    if kind == 'rest_q':
+        return {'type': 'REST_Q'} # Right
+    if kind == 'rest_h':
+        return {'type': 'REST_H'} # Left
+    if kind == 'loop_start':
+        return {'type': 'LOOP_START'}
+
+    if kind == 'loop_end':
+        count = 'BF' # Default to Brainfuck mode
+        is_infinite = False
+        use_next_cell = False
+
+        if match.group('next_cell'):
+            use_next_cell = True
+            count = None # Determined at runtime
+        elif match.group('count'):
+            if match.group('count') == '00':
+                is_infinite = True
+                count = None
+            else:
+                count = int(match.group('count'))
+
+        return {
+            'type': 'LOOP_END',
+            'count': count,
+            'infinite': is_infinite,
+            'use_next_cell': use_next_cell
+        }
+
+    return None # Comments and bar lines are ignored completely
+
+
+def scan(text, base=0):
+    # Tokens carry 'pos', their offset in the source, for profile reports
+    for match in TOKEN_PATTERN.finditer(text):
+        token = _make_token(match)
+        if token is not None:
+            token['pos'] = base + match.start()
+            yield token
+
+
+def _scan_limit(buffer):
+    # Where scanning has to stop until more text arrives: before a comment
+    # that is still open, or a partial "<!--" at the very end. Every "<!--"
+    # before the last ">" is already closed.
+    open_at = buffer.find('<!--', buffer.rfind('>') + 1)
+    if open_at != -1:
+        return open_at
+    for k in (3, 2, 1):
+        if buffer.endswith('<!--'[:k]):
+            return len(buffer) - k
+    return len(buffer)
+
+
+def _bare_loop_end(match):
+    return match.lastgroup == 'loop_end' and match.end() - match.start() == 2
+
+
+def scan_stream(stream, chunk_size=SCAN_CHUNK_SIZE):
+    # Tokenizes a file object chunk by chunk. The last token of every chunk
+    # is held back and rescanned with the next one, as it may still grow
+    # (C4 -> C4., :| -> :|x12). A bare :| also holds back the comments
+    # after it, since its suffix may follow them.
+    buffer = ''
+    base = 0 # Offset of buffer in the stream
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += chunk
+
+        if not chunk:
+            yield from scan(buffer, base)
+            return
+
+        limit = _scan_limit(buffer)
+        held = []
+        for match in TOKEN_PATTERN.finditer(buffer, 0, limit):
+            if not (held and match.lastgroup == 'comment' and _bare_loop_end(held[0])):
+                for previous in held:
+                    token = _make_token(previous)
+                    if token is not None:
+                        token['pos'] = base + previous.start()
+                        yield token
+                held = []
+            held.append(match)
+
+        if held:
+            cut = held[0].start()
+        elif limit < len(buffer):
+            cut = limit
+        else:
+            cut = max(limit - 3, 0)
+        buffer = buffer[cut:]
+        base += cut
+
+
+# Snapshot layout: header, counters and skips (int64 each, little-endian),
+# the tape up to its last non-zero cell, then the compiled program.
+SNAPSHOT_MAGIC = b'MCS\0'
+# magic, version, pc, ptr, steps, prev note, halted, input consumed,
+# tape length, stored tape bytes, loop depth, program bytes
+SNAPSHOT_HEADER = struct.Struct('<4sIQqQBBQQQIQ')
+
+# Instructions run between chunks of iter_output() and arun()
+SLICE_STEPS = 10000
+
+
+class StepLimitExceeded(RuntimeError):
+    pass
+
 
 class MusicCoderInterpreter:
-    def __init__(self, source_code, debug=False):
+    def __init__(self, source_code, debug=False, optimize=False, backend='bytecode',
+                 tape_size=DEFAULT_SIZE, max_tape_size=None,
+                 input_source=None, output_sink=None, binary=False, cache=None, profile=False,
+                 trace=None):
         self.source_code = source_code
-        self.tape = [0] * 30000
+        self.tape = Tape(tape_size, max_tape_size)
         self.ptr = 0
+        self.count_steps = False # Count executed instructions into self.steps
+        self.steps = 0
+        self.max_steps = None # Raise StepLimitExceeded instead of executing more steps
+        self.detect_cycles = False # Raise InfiniteLoop once a loop provably never ends, see cycles.py
+        self.cycles = None # CycleDetector of the current run
         self.debug = debug
-        
-        # Note values (MIDI numbers, C-1=0 C4=60))
-        self.note_map = {}
-        pitch_classes = {
-            'C': 0, 'C#': 1, 'DB': 1,
-            'D': 2, 'D#': 3, 'EB': 3,
-            'E': 4,
-            'F': 5, 'F#': 6, 'GB': 6,
-            'G': 7, 'G#': 8, 'AB': 8,
-            'A': 9, 'A#': 10, 'BB': 10,
-            'B': 11
-        }
-        
-        for name, base_val in pitch_classes.items():
-            for octave in range(-1, 11): # -1 to 10
-                midi_val = base_val + octave * 12 + 12 # Standard MIDI (C-1=0, C0=12, C4=60)
-                if 0 <= midi_val <= 127:
-                    self.note_map[f"{name}{octave}"] = midi_val
-        
+        self.profiling = profile # Collect a Profile into self.profile, see profiler.py
+        self.profile = None
+        self.trace = trace # Trace recording sampled steps, see tracer.py
+        self.optimize = optimize # Fuse common idioms, see optimizer.py
+        self.backend = backend # 'bytecode' dispatch loop or 'codegen' (generated Python)
+
+        # I/O, see streams.py. Defaults to stdin/stdout when run() starts,
+        # as text (chr/ord) or, with binary=True, raw bytes.
+        self.input_source = input_source
+        self.output_sink = output_sink
+        self.binary = binary
+        self.note_map = NOTE_VALUES
+
         self.tokens = []
         self.loop_map = {}
         self.loop_info = {} # Stores metadata for loops (e.g., fixed counts)
+        self.program = None # Compiled form, see compile()
+        self.cache = cache # ProgramCache of compiled programs, see cache.py
+        self.ranges = None # PointerRanges from the last reserve_tape()
 
-    def tokenize(self):
-        # Remove comments <!-- ... -->
-        clean_code = re.sub(r'<!--[^>]*>', '', self.source_code, flags=re.DOTALL)
-
-        # Regex explanation:
-        # \|:       -> Start Loop
-        # :\|(?:x\d+|R4)? -> End Loop (optional xN or R4)
-        # R4        -> Quarter Rest (Right)
-        # R2        -> Half Rest (Left)
-        # \|        -> Bar Line (Cosmetic)
-        # [A-G][#b]?[0-9]?[._]* -> Note (optional sharp/flat) (optional octave) (suffixes: . _)
-        
-        # Updated regex to allow whitespace in loop suffix
-        pattern = r'\|:|:\|(?:\s*(?:x\d+|R4))?|R4|R2|\||[A-G](?:#|b)?-?\d?(?:[._]+)?'
-        raw_tokens = re.findall(pattern, clean_code, re.IGNORECASE)
-        
-        parsed_tokens = []
-        for t in raw_tokens:
-            t_upper = t.upper()
-            if t_upper == '|:':
-                parsed_tokens.append({'type': 'LOOP_START'})
-            elif t_upper.startswith(':|'):
-                # Check for xN or R4
-                count = 'BF' # Default to Brainfuck mode
-                is_infinite = False
-                use_next_cell = False
-                
-                if 'R4' in t_upper:
-                    use_next_cell = True
-                    count = None # Determined at runtime
-                elif 'X' in t_upper:
-                    parts = t_upper.split('X')
-                    if len(parts) == 2:
-                        val_str = parts[1]
-                        if val_str == '00':
-                            is_infinite = True
-                            count = None
-                        else:
-                            try:
-                                count = int(val_str)
-                            except ValueError:
-                                pass 
-                
-                parsed_tokens.append({
-                    'type': 'LOOP_END',
-                    'count': count,
-                    'infinite': is_infinite,
-                    'use_next_cell': use_next_cell
-                })
-            elif t_upper == 'R4':
-                parsed_tokens.append({'type': 'REST_Q'}) # Right
-            elif t_upper == 'R2':
-                parsed_tokens.append({'type': 'REST_H'}) # Left
-            elif t_upper == '|':
-                pass # Ignore bars completely
-            else:
+        # Machine state between execute() calls, see step() and snapshot()
+        self.pc = 0
+        self.prev_val = 0
+        self.counters = None # Remaining iterations per counted-loop depth
+        self.skips = None # R4 count notes to skip per counted-loop depth
+        self.halted = False
+        self.pause_for_input = False # Pause before a legato note until input_source.ready()
+        self.input_wanted = 0 # Values the paused instruction will read
+        self.input_offset = 0 # Input values to skip when streams open, set by load_snapshot()
 
-                # Match Note + Optional Octave + Optional Suffixes
-                match = re.match(r'([A-G](?:#|B)?)(-?\d?)(.*)', t_upper)
-                if match:
-                    note_name = match.group(1)
-                    octave_str = match.group(2)
-                    suffixes = match.group(3)
-                    
-                    # Default Octave is 4 if not specified
-                    octave = octave_str if octave_str else "4"
-                    lookup_key = f"{note_name}{octave}"
-                    
-                    val = self.note_map.get(lookup_key)
-                    
-                    if val is None:
-                         raise ValueError(f"Invalid or out-of-range note: {t_upper}")
-
-                    parsed_tokens.append({
-                        'type': 'NOTE',
-                        'value': val,
-                        'name': note_name,
-                        'octave': octave,
-                        'staccato': '.' in suffixes,
-                        'legato': '_' in suffixes
-                    })
-        
-        self.tokens = parsed_tokens
+    def _scan(self):
+        # source_code may be a string or a file object read in chunks
+        if hasattr(self.source_code, 'read'):
+            return scan_stream(self.source_code)
+        return scan(self.source_code)
+
+    def tokenize(self):
+        self.tokens = list(self._scan())
         self.build_loop_map()
 
     def build_loop_map(self):
@@ -136,194 +265,721 @@ class MusicCoderInterpreter:
         if stack:
             raise SyntaxError("Unmatched |: at token {}".format(stack[0]))
 
+    def compile(self):
+        # Flatten the tokens into integer opcode/operand arrays with
+        # jump targets resolved, so run() never touches a token dict.
+        # Without a prior tokenize() the scanner feeds the compiler directly
+        # and no token list is kept. With a cache, a hit skips both.
+        key = None
+        if self.cache is not None and not self.tokens:
+            # The whole source is needed for its hash
+            if hasattr(self.source_code, 'read'):
+                self.source_code = self.source_code.read()
+            key = self.cache.key(self.source_code, self.optimize)
+            self.program = self.cache.load(key)
+            if self.program is not None:
+                return self.program
+
+        self.program = compile_tokens(self.tokens if self.tokens else self._scan())
+        if self.optimize:
+            self.program = optimize_program(self.program)
+        if key is not None:
+            self.cache.store(key, self.program)
+        self.reset()
+        return self.program
+
+    def reset(self):
+        # Back to the first instruction; the tape and pointer are kept
+        self.pc = 0
+        self.prev_val = 0
+        depth = self.program.depth if self.program is not None else 0
+        self.counters = [0] * depth
+        self.skips = [0] * depth
+        self.halted = False
+        self.cycles = None
+
+    def open_streams(self):
+        if self.output_sink is None:
+            # Unbuffered while debugging so output interleaves with the trace
+            buffer_size = 1 if self.debug else DEFAULT_BUFFER_SIZE
+            self.output_sink = OutputSink(binary=self.binary, buffer_size=buffer_size)
+        if self.input_source is None:
+            self.input_source = InputSource(binary=self.binary, flush=self.output_sink.flush)
+        if self.input_offset:
+            self.input_source.skip(self.input_offset)
+            self.input_offset = 0
+
+    def snapshot(self):
+        # Serializes the machine state, including the compiled program, so
+        # load_snapshot() can continue it in another process
+        if self.program is None:
+            self.compile()
+        if self.counters is None:
+            self.reset()
+        if self.output_sink is not None:
+            self.output_sink.flush()
+
+        cells = bytes(self.tape).rstrip(b'\0')
+        program = dumps(self.program)
+        counters = array('q', self.counters + self.skips)
+        if sys.byteorder == 'big':
+            counters.byteswap()
+        consumed = self.input_offset
+        if self.input_source is not None:
+            consumed += getattr(self.input_source, 'consumed', 0)
+
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, VERSION, self.pc, self.ptr, self.steps, self.prev_val,
+                                      self.halted, consumed, len(self.tape), len(cells),
+                                      len(self.counters), len(program))
+        return b''.join([header, counters.tobytes(), cells, program])
+
+    def load_snapshot(self, data):
+        # Restores state saved by snapshot(). The input source must replay
+        # the same input from its start: what was consumed before the
+        # snapshot is skipped when execution continues.
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Truncated snapshot")
+        (magic, version, pc, ptr, steps, prev_val, halted, consumed,
+         tape_size, stored, depth, program_size) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != VERSION:
+            raise ValueError("Not a snapshot for this version")
+        if len(data) != SNAPSHOT_HEADER.size + 16 * depth + stored + program_size:
+            raise ValueError("Truncated snapshot")
+
+        pos = SNAPSHOT_HEADER.size
+        counters = array('q')
+        counters.frombytes(data[pos:pos + 16 * depth])
+        if sys.byteorder == 'big':
+            counters.byteswap()
+        pos += 16 * depth
+        cells = data[pos:pos + stored]
+        pos += stored
+
+        self.program = loads(data[pos:])
+        self.tape = Tape(tape_size, self.tape.max_size)
+        self.tape[:stored] = cells
+        self.pc = pc
+        self.ptr = ptr
+        self.steps = steps
+        self.prev_val = prev_val
+        self.halted = bool(halted)
+        self.counters = counters[:depth].tolist()
+        self.skips = counters[depth:].tolist()
+        self.input_offset = consumed
+        if self.input_source is not None and hasattr(self.input_source, 'consumed'):
+            # Already positioned past what it handed out before
+            self.input_offset = max(0, consumed - self.input_source.consumed)
+
+    def memory(self):
+        # Read-only view of the tape without copying; release it before
+        # running again, a live view stops the tape from growing.
+        return self.tape.view()
+
+    def reserve_tape(self):
+        # Grows the tape up front to every cell the program can reach from
+        # the current pointer, when that is bounded (see ranges.py), and
+        # returns the analysis
+        ranges = self.ranges
+        if ranges is None or ranges.program is not self.program or ranges.ptr != self.ptr:
+            ranges = self.ranges = PointerRanges(self.program, self.ptr)
+        if ranges.max_ptr is not None:
+            self.tape.reserve(ranges.max_ptr)
+        return ranges
+
+    def generate_source(self, ranges=None):
+        # Python source for the codegen backend, see codegen.py. With the
+        # PointerRanges of the run, moves that provably stay on the tape
+        # are generated without bounds checks.
+        return generate(self.program, ranges, len(self.tape))
+
     def run(self):
-        self.tokenize()
-        
-        pc = 0
-        prev_val = 0 # Track previous note value for interval arithmetic (0 = C-1)
-        
-        # Loop counters for fixed loops: { loop_start_pc: remaining_iterations }
-        active_loops = {}
-
-        if self.debug:
+        # Runs to the end, continuing where step() paused. A program that
+        # already finished runs again from the start.
+        if self.program is None:
+            self.compile()
+        if self.halted or self.counters is None:
+            self.reset()
+
+        self.open_streams()
+        try:
+            ranges = self.reserve_tape() if self.pc == 0 else None
+            # Generated code cannot count steps or record anything per step,
+            # and always starts from the first instruction
+            per_step = (self.debug or self.count_steps or self.profiling or self.trace is not None
+                        or self.max_steps is not None or self.detect_cycles)
+            if self.backend == 'codegen' and not per_step and self.pc == 0:
+                try:
+                    main = compile_source(self.generate_source(ranges))
+                except SyntaxError:
+                    # Nesting too deep for a single Python function
+                    main = None
+                if main is not None:
+                    self.ptr = main(self.tape, self.ptr, self.output_sink.write, self.input_source.read)
+                    self.pc = len(self.program) - 1
+                    self.halted = True
+                    return
+
+            self.execute()
+        finally:
+            self.output_sink.flush()
+
+    def step(self, n=1):
+        # Executes at most n more instructions on the bytecode loop and
+        # returns True once the program has finished. All state stays on
+        # the interpreter, so stepping can continue later or be saved with
+        # snapshot().
+        if self.program is None:
+            self.compile()
+        if self.counters is None:
+            self.reset()
+        if self.halted:
+            return True
+
+        self.open_streams()
+        try:
+            self.execute(self.steps + n)
+        finally:
+            self.output_sink.flush()
+        return self.halted
+
+    def _slice(self, output, every):
+        # One slice of iter_output() and arun(): (output bytes, finished,
+        # exception). Output from before an error is still handed out.
+        try:
+            done = self.step(every)
+        except Exception as e:
+            return output.take(), True, e
+        return output.take(), done, None
+
+    def iter_output(self, input_source=None, every=SLICE_STEPS):
+        # Runs the program `every` instructions at a time, yielding the
+        # output bytes of each slice as they are produced. Before a legato
+        # note that would block on input, pending output is yielded first.
+        if input_source is not None:
+            self.input_source = input_source
+        sink = self.output_sink
+        self.output_sink = output = MemoryOutput()
+        self.open_streams()
+        self.pause_for_input = hasattr(self.input_source, 'ready')
+        try:
+            while True:
+                data, done, error = self._slice(output, every)
+                if data:
+                    yield data
+                if error is not None:
+                    raise error
+                if done:
+                    return
+                if self.input_wanted:
+                    self.input_source.wait(self.input_wanted)
+        finally:
+            self.pause_for_input = False
+            self.output_sink = sink
+
+    async def arun(self, reader=None, every=SLICE_STEPS):
+        # Async counterpart of iter_output(): input comes from an asyncio
+        # stream (see AsyncInput) and is awaited when a legato note needs
+        # it, and control returns to the event loop every `every`
+        # instructions, so one loop can drive many programs.
+        self.input_source = reader if isinstance(reader, AsyncInput) else AsyncInput(reader)
+        sink = self.output_sink
+        self.output_sink = output = MemoryOutput()
+        self.pause_for_input = True
+        try:
+            while True:
+                data, done, error = self._slice(output, every)
+                if data:
+                    yield data
+                if error is not None:
+                    raise error
+                if done:
+                    return
+                if self.input_wanted:
+                    await self.input_source.fill(self.input_wanted)
+                else:
+                    await asyncio.sleep(0)
+        finally:
+            self.pause_for_input = False
+            self.output_sink = sink
+
+    def _reach(self, ptr):
+        # The pointer passed `size` in execute(): grow the tape if needed.
+        # While profiling `size` is the pointer's high-water mark instead of
+        # the tape length, so new maxima land here too.
+        if ptr >= len(self.tape):
+            self.tape.grow(ptr)
+        if self.profile is not None:
+            self.profile.max_ptr = max(self.profile.max_ptr, ptr)
+            return self.profile.max_ptr + 1
+        return len(self.tape)
+
+    def execute(self, stop=None):
+        # Runs the bytecode loop from self.pc until HALT, or until
+        # self.steps reaches `stop`
+        program = self.program
+        code = program.code
+        arg = program.arg
+        arg2 = program.arg2
+        tables = program.tables
+        tape = self.tape
+        ptr = self.ptr
+        size = len(tape)
+
+        profile = None
+        if self.profiling:
+            if self.profile is None or self.profile.program is not program:
+                self.profile = Profile(program)
+            profile = self.profile
+            taken = profile.taken
+            consumed = profile.consumed
+            outer = profile.outer
+            nest_time = profile.nest_time
+            clock = time.perf_counter
+            started = clock()
+            nest_start = started - profile.nest_elapsed
+            profile.stop_pc = None
+            profile.stop_reason = None
+            size = self._reach(ptr)
+        # Loop markers record their jumps only while profiling
+        profiling = profile is not None
+        self.open_streams()
+        write = self.output_sink.write
+        read = self.input_source.read
+        # Checked at every loop back-jump, with I/O counted
+        detector = None
+        if self.detect_cycles:
+            if self.cycles is None:
+                self.cycles = CycleDetector()
+            detector = self.cycles
+            write, read = detector.watch(write, read)
+        debug = self.debug
+        trace = self.trace
+        # Per-instruction bookkeeping is kept off the fast path
+        traced = (debug or self.count_steps or trace is not None or self.max_steps is not None
+                  or stop is not None)
+        budget = sys.maxsize if self.max_steps is None else self.max_steps
+        limit = budget if stop is None else min(budget, stop)
+        ready = self.input_source.ready if self.pause_for_input else None
+        self.input_wanted = 0
+
+        if self.counters is None:
+            self.reset()
+        pc = self.pc
+        steps = self.steps
+        if trace is not None:
+            record = trace.record
+            every = trace.every
+            next_sample = steps - steps % every + every
+        prev_val = self.prev_val # Track previous note value for interval arithmetic (0 = C-1)
+
+        # Counted loops can only be live once per nesting depth, so their
+        # remaining iterations (and the R4 count notes to skip afterwards)
+        # live in one slot per depth instead of a dict keyed by pc.
+        counters = self.counters
+        skips = self.skips
+
+        if debug:
             print("DEBUG: Starting execution")
-            print(f"DEBUG: Tape size: {len(self.tape)}")
-
-        while pc < len(self.tokens):
-            token = self.tokens[pc]
-            ctype = token['type']
-            
-            if self.debug:
-                print(f"DEBUG: PC={pc}, Token={ctype}, Ptr={self.ptr}, Val={self.tape[self.ptr]}, PrevNote={prev_val}")
-
-            if ctype == 'REST_H': # R2 -> Left
-                self.ptr -= 1
-                prev_val = 0 # Reset previous note
-                if self.ptr < 0:
-                     # Pointer can't go left of 0
-                     pass 
-                
-                if self.ptr < 0:
-                     raise RuntimeError("Pointer moved left of 0")
-            
-            elif ctype == 'REST_Q': # R4 -> Right
-                self.ptr += 1
-                prev_val = 0 # Reset previous note
-                if self.ptr >= len(self.tape):
-                    self.tape.append(0)
-
-
-            elif ctype == 'LOOP_START':
-                info = self.loop_info.get(pc)
-                
-                if info['count'] == 'BF':
-                    if self.tape[self.ptr] == 0:
-                        pc = self.loop_map[pc]
-
-                # Logic is now purely count-based (or infinite)
-                # If infinite, count is None, infinite is True
-                # If fixed, count is N, infinite is False
-
-                elif pc not in active_loops:
-                    if info['infinite']:
-                        active_loops[pc] = -1 # Special marker for infinite
-                    elif info['use_next_cell']:
-                        end_pc = self.loop_map[pc]
-                        lookahead_pc = end_pc + 1
-                        note_count_val = 0
-                        local_prev = 0
-                        has_note_count = False
-                        
-                        while lookahead_pc < len(self.tokens) and self.tokens[lookahead_pc]['type'] == 'NOTE':
-                            # Stop if note has suffixes (likely an instruction)
-                            if self.tokens[lookahead_pc]['staccato'] or self.tokens[lookahead_pc]['legato']:
-                                break
-                            
-                            has_note_count = True
-                            curr_val = self.tokens[lookahead_pc]['value']
-                            if curr_val > local_prev:
-                                note_count_val += curr_val
-                            elif curr_val < local_prev:
-                                note_count_val -= curr_val
-                            local_prev = curr_val
-                            lookahead_pc += 1
-                        
-                        if has_note_count:
-                            active_loops[pc] = note_count_val
-                            # Store the skip count so we don't execute these notes later
-                            self.loop_info[pc]['skip_count'] = lookahead_pc - (end_pc + 1)
+            print(f"DEBUG: Tape size: {len(tape)}")
+
+        try:
+            while True:
+                op = code[pc]
+
+                if traced and op != OP_HALT:
+                    if steps >= limit:
+                        if steps >= budget:
+                            raise StepLimitExceeded(f"Step limit of {budget} reached")
+                        # Paused by step(), pc is the next instruction to run
+                        if profiling:
+                            profile.stop_pc = pc
+                            profile.stop_reason = 'pause'
+                        break
+                    if ready is not None and (op == OP_NOTE or op == OP_IN):
+                        # Reads by this note, and by the next one if this one consumes it
+                        if op == OP_IN:
+                            wanted = 1
                         else:
-                            next_ptr = self.ptr + 1
-                            if next_ptr < len(self.tape):
-                                count_val = self.tape[next_ptr]
-                            else:
-                                count_val = 0 # Out of bounds default
-                            active_loops[pc] = count_val
+                            wanted = (arg2[pc] & LEGATO) >> 1
+                            if arg[pc] == prev_val and code[pc + 1] == OP_NOTE:
+                                wanted += (arg2[pc + 1] & LEGATO) >> 1
+                        if wanted and not ready(wanted):
+                            self.input_wanted = wanted
+                            if profiling:
+                                profile.stop_pc = pc
+                                profile.stop_reason = 'pause'
+                            break
+                    steps += 1
+                    if debug:
+                        print(f"DEBUG: PC={pc}, Token={OP_NAMES[op]}, Ptr={ptr}, Val={tape[ptr]}, PrevNote={prev_val}")
+                    if trace is not None and steps >= next_sample:
+                        record(steps, pc, ptr, tape[ptr], prev_val)
+                        next_sample += every
+
+                if op == OP_NOTE:
+                    current_val = arg[pc]
+                    flags = arg2[pc]
+
+                    # Arithmetic based on interval
+                    if current_val > prev_val:
+                        # Ascending: Add Current Note
+                        tape[ptr] = (tape[ptr] + current_val) & 0xFF
+                    elif current_val < prev_val:
+                        # Descending: Subtract Current Note
+                        tape[ptr] = (tape[ptr] - current_val) & 0xFF
+                    elif code[pc + 1] == OP_NOTE:
+                        # Equal: add the difference to the NEXT note and consume it,
+                        # including its I/O flags. prev_val continues from the consumed note.
+                        # The optimizer resolves this ahead where it can; the
+                        # plain program keeps one instruction per token.
+                        if profiling:
+                            consumed[pc] += 1
+                        pc += 1
+                        next_val = arg[pc]
+                        tape[ptr] = (tape[ptr] + next_val - current_val) & 0xFF
+                        if arg2[pc] & STACCATO:
+                            write(tape[ptr])
+                        if arg2[pc] & LEGATO:
+                            tape[ptr] = read()
+                        current_val = next_val
+
+                    prev_val = current_val
+
+                    if flags & STACCATO:
+                        write(tape[ptr])
+                    if flags & LEGATO:
+                        tape[ptr] = read()
+
+                elif op == OP_RIGHT: # R4 -> Right
+                    ptr += 1
+                    prev_val = 0 # Reset previous note
+                    if ptr >= size:
+                        size = self._reach(ptr)
+
+                elif op == OP_LEFT: # R2 -> Left
+                    ptr -= 1
+                    prev_val = 0 # Reset previous note
+                    if ptr < 0:
+                        raise RuntimeError("Pointer moved left of 0")
+
+                elif op == OP_ADD:
+                    tape[ptr] = (tape[ptr] + arg[pc]) & 0xFF
+                    prev_val = arg2[pc]
+
+                elif op == OP_MOVE:
+                    if ptr + arg2[pc] < 0:
+                        raise RuntimeError("Pointer moved left of 0")
+                    ptr += arg[pc]
+                    prev_val = 0
+                    if ptr >= size:
+                        size = self._reach(ptr)
+
+                elif op == OP_END_LOOP:
+                    if tape[ptr] != 0:
+                        if profiling:
+                            taken[pc] += 1
+                        if detector is not None:
+                            detector.check(pc, ptr, prev_val, counters, skips, tape)
+                        pc = arg[pc]
+                    elif profiling and pc in outer:
+                        nest_time[arg[pc]] += clock() - nest_start
+
+                elif op == OP_LOOP:
+                    if tape[ptr] == 0:
+                        if profiling:
+                            taken[pc] += 1
+                        pc = arg[pc]
+                    elif profiling and pc in outer:
+                        nest_start = clock()
+
+                elif op == OP_END_REPEAT:
+                    slot = arg2[pc]
+                    remaining = counters[slot]
+                    if remaining == INFINITE:
+                        if profiling:
+                            taken[pc] += 1
+                        if detector is not None:
+                            detector.check(pc, ptr, prev_val, counters, skips, tape)
+                        pc = arg[pc]
                     else:
-                        active_loops[pc] = info['count']
-                
-            
-            elif ctype == 'LOOP_END':
-                start_pc = self.loop_map[pc]
-                info = self.loop_info.get(start_pc)
-                
-                if info['count'] == 'BF':
-                    if self.tape[self.ptr] != 0:
-                        pc = start_pc
-                else:
-                    current_count = active_loops.get(start_pc)
-                    
-                    if current_count == -1:
-                        # Infinite Loop
-                        pc = start_pc
-                    elif current_count is not None:
-                        # Decrement remaining iterations
-                        active_loops[start_pc] -= 1
-                        if active_loops[start_pc] > 0:
-                                pc = start_pc
+                        remaining -= 1
+                        if remaining > 0:
+                            counters[slot] = remaining
+                            if profiling:
+                                taken[pc] += 1
+                            if detector is not None:
+                                detector.check(pc, ptr, prev_val, counters, skips, tape)
+                            pc = arg[pc]
                         else:
-                                # Loop Finished
-                                # Skip the notes that were used as count (if any)
-                                skip_count = self.loop_info[start_pc].get('skip_count', 0)
-                                pc += skip_count
-                                del active_loops[start_pc]
-            
-            elif ctype == 'NOTE':
-                current_val = token['value']
-                
-                # Arithmetic based on interval
-                if current_val > prev_val:
-                    # Ascending: Add Current Note
-                    self.tape[self.ptr] = (self.tape[self.ptr] + current_val) % 256
-                elif current_val < prev_val:
-                    # Descending: Subtract Current Note
-                    self.tape[self.ptr] = (self.tape[self.ptr] - current_val) % 256
-                else:
-                    # Equal: Look ahead to the NEXT note to determine operation
-                    lookahead_pc = pc + 1
-                    if lookahead_pc < len(self.tokens) and self.tokens[lookahead_pc]['type'] == 'NOTE':
-                        next_val = self.tokens[lookahead_pc]['value']
-                        diff = next_val - current_val
-                        self.tape[self.ptr] = (self.tape[self.ptr] + diff) % 256
-                        
-                        # We must SKIP the next note because we just used it for "Brainfuck Arithmetic"
-                        # If we don't skip, the next iteration will see Prev=Current, Next=Next, and perform standard Asc/Desc
-                        # which adds large values.
-                        
-                        # Handle I/O flags of the CONSUMED note (since we skip its iteration)
-                        consumed_token = self.tokens[lookahead_pc]
-                        if consumed_token['staccato']:
-                             sys.stdout.write(chr(self.tape[self.ptr]))
-                        if consumed_token['legato']:
-                             try:
-                                 char = sys.stdin.read(1)
-                                 if char:
-                                     self.tape[self.ptr] = ord(char)
-                                 else:
-                                     self.tape[self.ptr] = 0
-                             except:
-                                 self.tape[self.ptr] = 0
-
-                        pc += 1 # Advance PC to skip the next note
-                        
-                        # Update prev_val to the NOTE WE JUST CONSUMED
-                        # This ensures continuity for the note AFTER the consumed one.
-                        # Example: C4 -> C4 -> C#4 -> D4
-                        # 1. C4 (+60). prev=60.
-                        # 2. C4 (==). Lookahead C#4. Add +1. Tape=61. Skip C#4.
-                        #    We need prev to be C#4 (61) so that D4 (62) is processed as 62>61?
-                        #    Or should prev remain C4 (60)?
-                        #    If this is just "+", we transitioned from C4 to C#4 state.
-                        
-                        current_val = next_val # Update current_val so prev_val gets updated correctly below
-                    
-                # Update previous value
-                prev_val = current_val
-                
-                if token['staccato']:
-                    sys.stdout.write(chr(self.tape[self.ptr]))
-                if token['legato']:
-                    try:
-                        char = sys.stdin.read(1)
-                        if char:
-                            self.tape[self.ptr] = ord(char)
+                            # Loop Finished
+                            if profiling and pc in outer:
+                                nest_time[arg[pc]] += clock() - nest_start
+                            # Skip the notes that were used as count (if any)
+                            pc += skips[slot]
+
+                elif op == OP_REPEAT:
+                    slot = arg2[arg[pc]]
+                    counters[slot] = arg2[pc]
+                    skips[slot] = 0
+                    if profiling and pc in outer:
+                        nest_start = clock()
+
+                elif op == OP_REPEAT_NEXT:
+                    # Counts taken from notes are only turned into REPEATs
+                    # by the optimizer, so look ahead here otherwise
+                    if profiling and pc in outer:
+                        nest_start = clock()
+                    end_pc = arg[pc]
+                    slot = arg2[end_pc]
+                    lookahead_pc = end_pc + 1
+                    note_count_val = 0
+                    local_prev = 0
+
+                    # Stop at the first note with suffixes (likely an instruction)
+                    while code[lookahead_pc] == OP_NOTE and not arg2[lookahead_pc]:
+                        curr_val = arg[lookahead_pc]
+                        if curr_val > local_prev:
+                            note_count_val += curr_val
+                        elif curr_val < local_prev:
+                            note_count_val -= curr_val
+                        local_prev = curr_val
+                        lookahead_pc += 1
+
+                    if lookahead_pc > end_pc + 1:
+                        counters[slot] = note_count_val
+                        # Store the skip count so we don't execute these notes later
+                        skips[slot] = lookahead_pc - (end_pc + 1)
+                    else:
+                        next_ptr = ptr + 1
+                        if next_ptr < len(tape):
+                            counters[slot] = tape[next_ptr]
                         else:
-                            self.tape[self.ptr] = 0
-                    except:
-                        self.tape[self.ptr] = 0
+                            counters[slot] = 0 # Out of bounds default
+                        skips[slot] = 0
+
+                elif op == OP_CLEAR:
+                    if tape[ptr]:
+                        tape[ptr] = 0
+                        prev_val = arg[pc]
+
+                elif op == OP_MULADD:
+                    cell = tape[ptr]
+                    if cell:
+                        factor, low, targets = tables[arg[pc]]
+                        if ptr + low < 0:
+                            raise RuntimeError("Pointer moved left of 0")
+                        n = cell * factor & 0xFF
+                        for offset, delta in targets:
+                            target = ptr + offset
+                            if target >= size:
+                                size = self._reach(target)
+                            tape[target] = (tape[target] + n * delta) & 0xFF
+                        tape[ptr] = 0
+                        prev_val = arg2[pc]
+
+                elif op == OP_SCAN:
+                    if tape[ptr]:
+                        step = arg[pc]
+                        prev_val = 0
+                        while tape[ptr]:
+                            ptr += step
+                            if ptr < 0:
+                                raise RuntimeError("Pointer moved left of 0")
+                            if ptr >= size:
+                                size = self._reach(ptr)
+
+                elif op == OP_ADD_CELLS:
+                    factor, low, targets = tables[arg[pc]]
+                    if ptr + low < 0:
+                        raise RuntimeError("Pointer moved left of 0")
+                    for offset, delta in targets:
+                        target = ptr + offset
+                        if target >= size:
+                            size = self._reach(target)
+                        tape[target] = (tape[target] + delta) & 0xFF
+                    prev_val = arg2[pc]
+
+                elif op == OP_OUT:
+                    write(tape[ptr])
+
+                elif op == OP_IN:
+                    tape[ptr] = read()
+
+                elif op == OP_HALT:
+                    self.halted = True
+                    break
+
+                pc += 1
+        except BaseException as e:
+            if profiling:
+                profile.stop_pc = pc
+                # The step limit is checked before the instruction runs
+                profile.stop_reason = 'step_limit' if isinstance(e, StepLimitExceeded) else 'error'
+            raise
+        finally:
+            self.pc = pc
+            self.ptr = ptr
+            self.prev_val = prev_val
+            self.steps = steps
+            if profiling:
+                now = clock()
+                profile.elapsed += now - started
+                profile.nest_elapsed = now - nest_start
+            if trace is not None:
+                trace.flush()
+
+def _cells(text):
+    # argparse type for tape sizes
+    size = int(text)
+    if size < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1 cell, not {size}")
+    return size
 
-            pc += 1
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python interpreter.py <source_file> [--debug]")
-        sys.exit(1)
-        
-    source_file = sys.argv[1]
-    debug_mode = "--debug" in sys.argv
-
-    with open(source_file, 'r') as f:
-        code = f.read()
-    
-    interpreter = MusicCoderInterpreter(code, debug=debug_mode)
-    interpreter.run()
+    parser = argparse.ArgumentParser(description="Run a MusicCoder program.")
+    parser.add_argument("source_file", nargs="?")
+    parser.add_argument("--debug", action="store_true", help="Print every executed instruction")
+    parser.add_argument("--optimize", action="store_true", help="Fuse common idioms before running")
+    parser.add_argument("--backend", choices=["bytecode", "codegen"], default="bytecode",
+                        help="Dispatch loop over bytecode, or generated Python source")
+    parser.add_argument("--tape-size", type=_cells, default=None,
+                        help=f"Initial number of tape cells (default {DEFAULT_SIZE}, or the maximum if smaller)")
+    parser.add_argument("--max-tape-size", type=_cells, default=None,
+                        help="Stop with an error instead of growing the tape past this many cells")
+    parser.add_argument("--binary", action="store_true",
+                        help="Read and write raw bytes instead of text characters")
+    parser.add_argument("--input", metavar="FILE",
+                        help="Read program input from FILE, loaded into memory up front")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE,
+                        help="Bytes of output collected before writing them out")
+    parser.add_argument("--profile", action="store_true",
+                        help="Report how often each note and loop ran, on the bytecode backend")
+    parser.add_argument("--profile-output", metavar="FILE",
+                        help="Write the profile report to FILE instead of stderr")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Record executed steps to a binary trace file, read it with tracer.py")
+    parser.add_argument("--trace-every", type=int, default=1, metavar="N", help="Record every Nth step only")
+    parser.add_argument("--trace-last", type=int, default=None, metavar="N",
+                        help="Keep only the last N records in memory and write them when the program stops")
+    parser.add_argument("--max-steps", type=int, default=None, metavar="N",
+                        help="Stop with an error after executing N instructions")
+    parser.add_argument("--detect-cycles", action="store_true",
+                        help="Stop with an error once a loop comes back to the same state without I/O, "
+                             "on the bytecode backend")
+    parser.add_argument("--pause-after", type=int, default=None, metavar="N",
+                        help="Stop after N instructions and save the machine state to the --snapshot file")
+    parser.add_argument("--snapshot", metavar="FILE", help="Snapshot file written by --pause-after")
+    parser.add_argument("--resume", metavar="FILE",
+                        help="Continue a paused run from its snapshot; give the same input, what the run "
+                             "already consumed is skipped")
+    parser.add_argument("--batch", metavar="MANIFEST",
+                        help="Run the jobs of a JSON manifest in parallel, printing JSON lines (see batch.py)")
+    parser.add_argument("--lockstep", action="store_true",
+                        help="With --batch, run jobs that share a program together, vectorized (needs NumPy)")
+    parser.add_argument("--serve", metavar="ADDRESS",
+                        help="Run as a daemon on unix:PATH or tcp:HOST:PORT, answering run requests (see server.py)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes for --batch or --serve (default: CPU count)")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Directory for compiled .mcc programs (default ~/.cache/musiccoder)")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_SIZE,
+                        help="Bytes of compiled programs kept before the least recently used are evicted")
+    parser.add_argument("--no-cache", action="store_true", help="Always compile from source")
+    parser.add_argument("--check", action="store_true",
+                        help="Report the tape cells the program needs and moves left of 0 instead of running")
+    parser.add_argument("--dump-source", action="store_true",
+                        help="Print the source generated by the codegen backend instead of running")
+    args = parser.parse_args()
+
+    if args.batch:
+        # Imported here, batch.py imports this module
+        from batch import load_manifest, run_batch
+        if args.lockstep:
+            from lockstep import np
+            if np is None:
+                parser.error("--lockstep needs NumPy")
+        failed = run_batch(load_manifest(args.batch), workers=args.workers, lockstep=args.lockstep)
+        sys.exit(1 if failed else 0)
+    if args.serve:
+        from server import serve
+        try:
+            serve(args.serve, args.workers)
+        except ValueError as e:
+            parser.error(str(e))
+        sys.exit(0)
+    if args.source_file is None and args.resume is None:
+        parser.error("a source file is required unless --batch, --serve or --resume is given")
+    if args.tape_size is None:
+        args.tape_size = min(DEFAULT_SIZE, args.max_tape_size or DEFAULT_SIZE)
+    elif args.max_tape_size is not None and args.tape_size > args.max_tape_size:
+        parser.error("--tape-size is larger than --max-tape-size")
+    if args.pause_after is not None and args.snapshot is None:
+        parser.error("--pause-after needs --snapshot")
+
+    input_source = None
+    if args.input:
+        with open(args.input, 'rb') as f:
+            input_source = MemoryInput(f.read())
+    output_sink = OutputSink(binary=args.binary, buffer_size=1 if args.debug else args.buffer_size)
+
+    cache = None if args.no_cache else ProgramCache(args.cache_dir, args.cache_size)
+
+    trace = None
+    trace_file = None
+    if args.trace:
+        if args.trace_last:
+            trace = Trace(args.trace_last, args.trace_every, optimized=args.optimize)
+        else:
+            trace_file = open(args.trace, 'wb')
+            trace = Trace(every=args.trace_every, stream=trace_file, optimized=args.optimize)
+
+    source = open(args.source_file, 'r') if args.source_file else io.StringIO()
+    interpreter = MusicCoderInterpreter(source, debug=args.debug, optimize=args.optimize, backend=args.backend,
+                                        tape_size=args.tape_size, max_tape_size=args.max_tape_size,
+                                        input_source=input_source, output_sink=output_sink, binary=args.binary,
+                                        cache=cache, profile=args.profile, trace=trace)
+    interpreter.max_steps = args.max_steps
+    interpreter.detect_cycles = args.detect_cycles
+    with source:
+        if args.resume:
+            with open(args.resume, 'rb') as f:
+                interpreter.load_snapshot(f.read())
+        else:
+            interpreter.compile()
+    if args.dump_source:
+        try:
+            print(interpreter.generate_source(interpreter.reserve_tape()), end="")
+        except SyntaxError as e:
+            # run() falls back to the bytecode loop here, there is no source to show
+            sys.exit(f"Cannot generate source: {e}")
+    elif args.check:
+        ranges = PointerRanges(interpreter.program)
+        text = None
+        if args.source_file:
+            with open(args.source_file, 'r') as f:
+                text = f.read()
+        sys.stdout.write(ranges.report(text))
+        sys.exit(1 if ranges.underflows else 0)
+    else:
+        try:
+            if args.pause_after is None:
+                interpreter.run()
+            elif not interpreter.step(args.pause_after):
+                with open(args.snapshot, 'wb') as f:
+                    f.write(interpreter.snapshot())
+        finally:
+            if trace_file is not None:
+                trace_file.close()
+            elif trace is not None:
+                trace.save(args.trace)
+            if interpreter.profile is not None:
+                report = interpreter.profile.report()
+                if args.source_file:
+                    with open(args.source_file, 'r') as f:
+                        report = interpreter.profile.report(f.read())
+                if args.profile_output:
+                    with open(args.profile_output, 'w') as f:
+                        f.write(report)
+                else:
+                    sys.stderr.write(report)
@@ -0,0 +1,507 @@
+import sys
+
+try:
+    import numpy as np
+except ImportError: # Optional, only the lockstep engine needs it
+    np = None
+
+from bytecode import (
+    OP_HALT, OP_NOTE, OP_LEFT, OP_RIGHT, OP_LOOP, OP_END_LOOP,
+    OP_REPEAT, OP_REPEAT_NEXT, OP_END_REPEAT, OP_ADD, OP_MOVE, OP_CLEAR, OP_MULADD,
+    OP_SCAN, OP_OUT, OP_IN, OP_ADD_CELLS, STACCATO, LEGATO, INFINITE, next_count
+)
+from interpreter import MusicCoderInterpreter
+from ranges import PointerRanges
+from tape import DEFAULT_SIZE, MIN_GROWTH, MAX_RESERVE
+
+UNDERFLOW = "RuntimeError: Pointer moved left of 0"
+
+
+def _pick(value, mask):
+    # A per-lane value (int while the same for every lane) for the lanes
+    # selected by mask, back to an int once it is uniform
+    if isinstance(value, int):
+        return value
+    value = value[mask]
+    if len(value) and (value == value[0]).all():
+        return int(value[0])
+    return value
+
+
+# Lanes at the same instruction with the same loop counters. The pointer
+# and previous note are ints while they are the same for every lane of the
+# group, else arrays with one entry per lane. Steps are counted for the
+# whole group in `elapsed` and only added to the per-lane `steps` when the
+# group splits or merges.
+class _Group:
+    def __init__(self, pc, lanes, ptr, prev, counters, skips, steps, budget):
+        self.pc = pc
+        self.lanes = lanes
+        self.ptr = ptr
+        self.prev = prev
+        self.counters = counters
+        self.skips = skips
+        self.steps = steps
+        self.budget = budget # Step limit per lane, None for no limits
+        self.elapsed = 0
+        self._limit()
+
+    def _limit(self):
+        # Steps until the first lane reaches its limit
+        if self.budget is None or not len(self.lanes):
+            self.limit = sys.maxsize
+        else:
+            self.limit = int((self.budget - self.steps).min())
+
+    def settle(self):
+        if self.elapsed:
+            self.steps = self.steps + self.elapsed
+            self.limit -= self.elapsed
+            self.elapsed = 0
+
+    def uncount(self):
+        # Takes back the step of an instruction that is run again
+        self.settle()
+        self.steps = self.steps - 1
+        self.limit += 1
+
+    def pointers(self):
+        if isinstance(self.ptr, int):
+            return np.full(len(self.lanes), self.ptr, dtype=np.int64)
+        return self.ptr
+
+    def previous(self):
+        if isinstance(self.prev, int):
+            return np.full(len(self.lanes), self.prev, dtype=np.int64)
+        return self.prev
+
+    def split(self, mask, pc):
+        # Moves the lanes selected by mask into a new group at pc
+        self.settle()
+        keep = ~mask
+        other = _Group(pc, self.lanes[mask], _pick(self.ptr, mask), _pick(self.prev, mask),
+                       list(self.counters), list(self.skips), self.steps[mask],
+                       None if self.budget is None else self.budget[mask])
+        self.lanes = self.lanes[keep]
+        self.ptr = _pick(self.ptr, keep)
+        self.prev = _pick(self.prev, keep)
+        self.steps = self.steps[keep]
+        if self.budget is not None:
+            self.budget = self.budget[keep]
+        self._limit()
+        return other
+
+    def merge(self, other):
+        self.settle()
+        other.settle()
+        order = np.argsort(np.concatenate((self.lanes, other.lanes)))
+        everything = np.ones(len(order), dtype=bool)
+        if not (isinstance(self.ptr, int) and isinstance(other.ptr, int) and self.ptr == other.ptr):
+            self.ptr = _pick(np.concatenate((self.pointers(), other.pointers()))[order], everything)
+        if not (isinstance(self.prev, int) and isinstance(other.prev, int) and self.prev == other.prev):
+            self.prev = _pick(np.concatenate((self.previous(), other.previous()))[order], everything)
+        self.lanes = np.concatenate((self.lanes, other.lanes))[order]
+        self.steps = np.concatenate((self.steps, other.steps))[order]
+        if self.budget is not None:
+            self.budget = np.concatenate((self.budget, other.budget))[order]
+        self._limit()
+
+    def joins(self, other):
+        return self.pc == other.pc and self.counters == other.counters and self.skips == other.skips
+
+
+def _bound(groups):
+    # Instruction of the group furthest behind
+    return min([group.pc for group in groups] + [sys.maxsize])
+
+
+# Runs one Program over many inputs at once. The tapes of all lanes form
+# one 2-D uint8 array with a row per cell, so a cell of every lane is one
+# contiguous row and a note is a single vector add for all of them.
+# Lanes share the instruction stream until they branch differently (a
+# Brainfuck loop test, an equal note, a :|R4 count read from the tape);
+# then the group splits. The group furthest behind in the program runs
+# first, so split groups catch up, and groups that reach the same
+# instruction with the same loop counters merge again.
+class LockstepEngine:
+    def __init__(self, program, inputs, max_steps=None, tape_size=DEFAULT_SIZE, max_tape_size=None):
+        if np is None:
+            raise ImportError("The lockstep engine needs NumPy")
+        if max_tape_size is not None and tape_size > max_tape_size:
+            raise ValueError(f"Tape size {tape_size} exceeds the maximum of {max_tape_size} cells")
+        self.program = program
+        self.count = n = len(inputs)
+        self.max_tape_size = max_tape_size
+
+        # Only cells the program can reach are allocated (see ranges.py),
+        # the rest of the tape would only ever hold zeros
+        ranges = PointerRanges(program)
+        size = MIN_GROWTH if ranges.max_ptr is None else ranges.max_ptr + 1
+        size = min(size, tape_size, MAX_RESERVE)
+        self.tape = np.zeros((max(size, 1), n), dtype=np.uint8)
+
+        # Input per lane, padded with the 0 that reading past the end gives
+        inputs = [data.encode('latin-1', 'replace') if isinstance(data, str) else bytes(data) for data in inputs]
+        self.input = np.zeros((n, max([len(data) for data in inputs] + [0]) + 1), dtype=np.uint8)
+        for lane, data in enumerate(inputs):
+            self.input[lane, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.input_end = np.array([len(data) for data in inputs], dtype=np.int64)
+        self.consumed = np.zeros(n, dtype=np.int64)
+
+        self.written = [] # Output as (lanes, values) array pairs, in order
+        self.status = [None] * n # 'ok', 'error' or 'step_limit' once a lane stopped
+        self.errors = [None] * n
+        self.steps = [0] * n
+        self.ptrs = [0] * n # Pointer of each lane when it stopped
+
+        if max_steps is None:
+            budget = None
+        elif isinstance(max_steps, int):
+            budget = np.full(n, max_steps, dtype=np.int64)
+        else:
+            budget = np.array([sys.maxsize if steps is None else steps for steps in max_steps], dtype=np.int64)
+        self.groups = []
+        if n:
+            depth = program.depth
+            self.groups.append(_Group(0, np.arange(n), 0, 0, [0] * depth, [0] * depth,
+                                      np.zeros(n, dtype=np.int64), budget))
+
+    def _index(self, group, offset=0):
+        # Tape index of each lane's current cell plus offset, a whole row
+        # when the group is every lane at the same cell
+        if isinstance(group.ptr, int) and len(group.lanes) == self.count:
+            return group.ptr + offset
+        return group.ptr + offset, group.lanes
+
+    def _stop(self, group, mask, status, error=None):
+        # The lanes selected by mask leave the group for good
+        stopped = group.split(mask, group.pc)
+        for lane, ptr, steps in zip(stopped.lanes.tolist(), stopped.pointers().tolist(), stopped.steps.tolist()):
+            self.status[lane] = status
+            self.errors[lane] = error
+            self.ptrs[lane] = ptr
+            self.steps[lane] = steps
+
+    def _check(self, group, low, high):
+        # Stops the lanes whose pointer plus low would be left of 0, or
+        # plus high past the maximum tape size, and grows the tape for the
+        # others. Returns whether any lane failed.
+        ptrs = group.pointers()
+        failed = False
+        if low < 0:
+            under = ptrs + low < 0
+            if under.any():
+                self._stop(group, under, 'error', UNDERFLOW)
+                ptrs = group.pointers()
+                failed = True
+        if high > 0 and len(ptrs):
+            if self.max_tape_size is not None:
+                past = ptrs + high >= self.max_tape_size
+                if past.any():
+                    self._stop(group, past, 'error',
+                               f"RuntimeError: Pointer moved past the end of the tape ({self.max_tape_size} cells)")
+                    ptrs = group.pointers()
+                    failed = True
+            if len(ptrs):
+                self._reach(int(ptrs.max()) + high)
+        return failed
+
+    def _reach(self, index):
+        # Grows the tape geometrically so tape[index] exists
+        size = len(self.tape)
+        if index < size:
+            return
+        new_size = max(index + 1, 2 * size, MIN_GROWTH)
+        if self.max_tape_size is not None:
+            new_size = min(new_size, self.max_tape_size)
+        tape = np.zeros((new_size, self.count), dtype=np.uint8)
+        tape[:size] = self.tape
+        self.tape = tape
+
+    def _io(self, group, flags):
+        if flags & STACCATO:
+            self.written.append((group.lanes, self.tape[self._index(group)].copy()))
+        if flags & LEGATO:
+            lanes = group.lanes
+            consumed = self.consumed[lanes]
+            self.tape[self._index(group)] = self.input[lanes, consumed]
+            self.consumed[lanes] = np.minimum(consumed + 1, self.input_end[lanes])
+
+    def _scan(self, group, step):
+        # Moves every lane with a nonzero cell by step until its cell is 0
+        lanes = group.lanes
+        ptrs = group.pointers().copy()
+        moving = self.tape[ptrs, lanes] != 0
+        if not moving.any():
+            return
+        group.prev = _pick(np.where(moving, 0, group.previous()), np.ones(len(lanes), dtype=bool))
+        under = np.zeros(len(lanes), dtype=bool)
+        past = np.zeros(len(lanes), dtype=bool)
+        while moving.any():
+            ptrs[moving] += step
+            if step < 0:
+                under |= moving & (ptrs < 0)
+                moving &= ~under
+            else:
+                if self.max_tape_size is not None:
+                    past |= moving & (ptrs >= self.max_tape_size)
+                    moving &= ~past
+                if moving.any():
+                    self._reach(int(ptrs[moving].max()))
+            moving[moving] = self.tape[ptrs[moving], lanes[moving]] != 0
+        group.ptr = _pick(ptrs, np.ones(len(lanes), dtype=bool))
+        if under.any():
+            self._stop(group, under, 'error', UNDERFLOW)
+        if past.any():
+            past = past[~under]
+            self._stop(group, past, 'error',
+                       f"RuntimeError: Pointer moved past the end of the tape ({self.max_tape_size} cells)")
+
+    def run(self):
+        # Runs every lane to the end and returns results()
+        code = self.program.code
+        arg = self.program.arg
+        arg2 = self.program.arg2
+        tables = self.program.tables
+        tape_add = self._add
+        groups = self.groups
+
+        while groups:
+            group = min(groups, key=lambda g: g.pc)
+            groups.remove(group)
+            bound = _bound(groups)
+            pc = group.pc
+
+            while len(group.lanes):
+                group.pc = pc
+                if pc >= bound:
+                    if pc > bound:
+                        # Let the groups behind catch up
+                        groups.append(group)
+                        break
+                    for other in groups:
+                        if other.joins(group):
+                            groups.remove(other)
+                            group.merge(other)
+                            break
+                    bound = _bound(groups)
+
+                op = code[pc]
+                if op == OP_HALT:
+                    self._stop(group, np.ones(len(group.lanes), dtype=bool), 'ok')
+                    break
+                if group.elapsed >= group.limit:
+                    group.settle()
+                    self._stop(group, group.steps >= group.budget, 'step_limit')
+                    continue
+
+                if op == OP_NOTE and not isinstance(group.prev, int) and code[pc + 1] == OP_NOTE:
+                    # Lanes whose previous note equals this one consume the
+                    # next note, so they go their own way
+                    equal = group.prev == arg[pc]
+                    if equal.all():
+                        group.prev = arg[pc]
+                    elif equal.any():
+                        other = group.split(equal, pc)
+                        other.prev = arg[pc]
+                        groups.append(other)
+                        bound = pc
+
+                group.elapsed += 1
+
+                if op == OP_NOTE:
+                    v = arg[pc]
+                    flags = arg2[pc]
+                    prev = group.prev
+                    if isinstance(prev, int):
+                        if v > prev:
+                            tape_add(group, v)
+                        elif v < prev:
+                            tape_add(group, -v)
+                        elif code[pc + 1] == OP_NOTE:
+                            # Equal: consume the next note, its I/O first
+                            pc += 1
+                            tape_add(group, arg[pc] - v)
+                            self._io(group, arg2[pc])
+                            v = arg[pc]
+                    else:
+                        # Lanes that are equal here have no next note to consume
+                        tape_add(group, np.where(prev < v, v, np.where(prev > v, 256 - v, 0)).astype(np.uint8))
+                    group.prev = v
+                    self._io(group, flags)
+                    pc += 1
+
+                elif op == OP_ADD:
+                    tape_add(group, arg[pc])
+                    group.prev = arg2[pc]
+                    pc += 1
+
+                elif op == OP_RIGHT or op == OP_LEFT or op == OP_MOVE:
+                    if op == OP_MOVE:
+                        offset, low = arg[pc], arg2[pc]
+                    else:
+                        offset = 1 if op == OP_RIGHT else -1
+                        low = min(offset, 0)
+                    if self._check(group, low, offset):
+                        group.uncount()
+                        continue
+                    group.ptr = group.ptr + offset
+                    group.prev = 0
+                    pc += 1
+
+                elif op == OP_OUT:
+                    self._io(group, STACCATO)
+                    pc += 1
+
+                elif op == OP_IN:
+                    self._io(group, LEGATO)
+                    pc += 1
+
+                elif op == OP_LOOP or op == OP_END_LOOP:
+                    cells = self.tape[self._index(group)]
+                    # LOOP skips the body on a zero cell, END_LOOP repeats it on a nonzero one
+                    jump = cells == 0 if op == OP_LOOP else cells != 0
+                    target = arg[pc] + 1
+                    if jump.all():
+                        pc = target
+                    else:
+                        if jump.any():
+                            groups.append(group.split(jump, target))
+                            bound = min(bound, target)
+                        pc += 1
+
+                elif op == OP_REPEAT:
+                    slot = arg2[arg[pc]]
+                    group.counters[slot] = arg2[pc]
+                    group.skips[slot] = 0
+                    pc += 1
+
+                elif op == OP_REPEAT_NEXT:
+                    end_pc = arg[pc]
+                    slot = arg2[end_pc]
+                    count, after = next_count(self.program, end_pc)
+                    group.skips[slot] = after - end_pc - 1
+                    pc += 1
+                    if count is not None:
+                        group.counters[slot] = count
+                        continue
+                    # From the next cell, which differs between lanes. A 0
+                    # runs the body once, like 1.
+                    ptrs = group.pointers() + 1
+                    inside = ptrs < len(self.tape)
+                    counts = np.ones(len(group.lanes), dtype=np.int64)
+                    counts[inside] = self.tape[ptrs[inside], group.lanes[inside]]
+                    counts[counts == 0] = 1
+                    values = np.unique(counts).tolist()
+                    for value in values[1:]:
+                        other = group.split(counts == value, pc)
+                        other.counters[slot] = value
+                        groups.append(other)
+                        counts = counts[counts != value]
+                        bound = pc
+                    group.counters[slot] = values[0]
+
+                elif op == OP_END_REPEAT:
+                    slot = arg2[pc]
+                    remaining = group.counters[slot]
+                    if remaining == INFINITE:
+                        pc = arg[pc] + 1
+                    elif remaining > 1:
+                        group.counters[slot] = remaining - 1
+                        pc = arg[pc] + 1
+                    else:
+                        # Past the notes used as the count, if any. The slot
+                        # is cleared so groups that left the loop can merge.
+                        pc += 1 + group.skips[slot]
+                        group.counters[slot] = 0
+                        group.skips[slot] = 0
+
+                elif op == OP_CLEAR:
+                    index = self._index(group)
+                    nonzero = self.tape[index] != 0
+                    self.tape[index] = 0
+                    if nonzero.all():
+                        group.prev = arg[pc]
+                    elif nonzero.any():
+                        group.prev = np.where(nonzero, arg[pc], group.previous())
+                    pc += 1
+
+                elif op == OP_MULADD:
+                    factor, low, targets = tables[arg[pc]]
+                    cells = self.tape[self._index(group)].astype(np.int64)
+                    nonzero = cells != 0
+                    if nonzero.any():
+                        if not nonzero.all():
+                            # Lanes with a zero cell skip the loop, and its checks
+                            groups.append(group.split(~nonzero, pc + 1))
+                            bound = min(bound, pc + 1)
+                            cells = cells[nonzero]
+                        high = max([offset for offset, delta in targets] + [0])
+                        if self._check(group, low, high):
+                            group.uncount()
+                            continue
+                        n = cells * factor
+                        for offset, delta in targets:
+                            tape_add(group, ((n * delta) & 0xFF).astype(np.uint8), offset)
+                        self.tape[self._index(group)] = 0
+                        group.prev = arg2[pc]
+                    pc += 1
+
+                elif op == OP_ADD_CELLS:
+                    factor, low, targets = tables[arg[pc]]
+                    if self._check(group, low, max([offset for offset, delta in targets] + [0])):
+                        group.uncount()
+                        continue
+                    for offset, delta in targets:
+                        tape_add(group, delta, offset)
+                    group.prev = arg2[pc]
+                    pc += 1
+
+                elif op == OP_SCAN:
+                    self._scan(group, arg[pc])
+                    pc += 1
+
+        return self.results()
+
+    def _add(self, group, delta, offset=0):
+        # Adds delta (an int, or a uint8 array per lane) to each lane's
+        # cell at pointer + offset, modulo 256
+        if isinstance(delta, int):
+            delta &= 0xFF
+            if not delta:
+                return
+        self.tape[self._index(group, offset)] += delta
+
+    def results(self):
+        # One dict per lane, as batch.run_job reports them: status, steps,
+        # output bytes and, for errors, the error
+        outputs = [b''] * self.count
+        if self.written:
+            lanes = np.concatenate([lanes for lanes, values in self.written])
+            values = np.concatenate([values for lanes, values in self.written])
+            # A stable sort keeps each lane's output in order
+            order = np.argsort(lanes, kind='stable')
+            lanes = lanes[order]
+            values = values[order]
+            edges = np.searchsorted(lanes, np.arange(self.count + 1)).tolist()
+            outputs = [values[edges[i]:edges[i + 1]].tobytes() for i in range(self.count)]
+
+        results = []
+        for lane in range(self.count):
+            result = {'status': self.status[lane], 'steps': self.steps[lane], 'output': outputs[lane]}
+            if self.errors[lane] is not None:
+                result['error'] = self.errors[lane]
+            results.append(result)
+        return results
+
+    def memory(self, lane):
+        # Tape of one lane as bytes, up to the highest cell allocated
+        return self.tape[:, lane].tobytes()
+
+
+def run_lockstep(source, inputs, optimize=True, max_steps=None, tape_size=DEFAULT_SIZE, max_tape_size=None):
+    # Runs one program once per input (bytes, or text as latin-1) and
+    # returns the results in the same order; max_steps may be a list with
+    # a limit per input
+    program = MusicCoderInterpreter(source, optimize=optimize).compile()
+    return LockstepEngine(program, inputs, max_steps, tape_size, max_tape_size).run()
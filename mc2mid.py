@@ -0,0 +1,170 @@
+import io
+import os
+import struct
+import sys
+from interpreter import MusicCoderInterpreter, scan_stream
+
+# Standard MIDI File, format 0: one track on channel 1, one tick per
+# quarter note like the <divisions> of mc2xml.
+#   note       note-on at the current time, note-off one tick later
+#   R4 / R2    note-off of key 0, which is not sounding, one / two ticks
+#              after the previous event: the gap is the rest
+#   . _        marker event "." / "_" / "._" right before the note-on
+#   |: :|xN    marker events with the repeat sign as text (":|", ":|x3",
+#              ":|x00", ":|R4")
+# Channel events share one running status, which a marker cancels.
+DIVISION = 1
+VELOCITY = 64
+NOTE_ON = 0x90
+MARKER = 0x06
+TRACK_NAME = 0x03
+END_OF_TRACK = 0x2F
+
+HEADER = struct.Struct('>4sIHHH')
+CHUNK = struct.Struct('>4sI')
+
+# Bytes buffered before each write
+WRITE_SIZE = 65536
+
+
+def number(value):
+    # Variable-length quantity: 7 bits per byte, high bit set on all but the last
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        data.insert(0, value & 0x7F | 0x80)
+        value >>= 7
+    return bytes(data)
+
+
+def meta(kind, text):
+    data = text.encode('utf-8')
+    return bytes([0, 0xFF, kind]) + number(len(data)) + data
+
+
+def loop_end_text(token):
+    if token['infinite']:
+        return ':|x00'
+    if token['use_next_cell']:
+        return ':|R4'
+    if token['count'] != 'BF':
+        return f":|x{token['count']}"
+    return ':|'
+
+
+# Events of one note, after a running note-on status: on now, off one tick later
+NOTE_EVENTS = [bytes([0, v, VELOCITY, DIVISION, v, 0]) for v in range(128)]
+REST_EVENTS = {'REST_Q': bytes([DIVISION, 0, 0]), 'REST_H': bytes([2 * DIVISION, 0, 0])}
+ARTICULATIONS = {1: meta(MARKER, '.'), 2: meta(MARKER, '_'), 3: meta(MARKER, '._')}
+REPEAT_START = meta(MARKER, '|:')
+
+
+class MC2MID:
+    def __init__(self, mc_file):
+        self.mc_file = mc_file
+        self.tokens = []
+
+    def parse(self):
+        # Optional, as for MC2XML: generate_midi() tokenizes as it writes
+        with open(self.mc_file, 'r') as f:
+            interp = MusicCoderInterpreter(f.read())
+        interp.tokenize()
+        self.tokens = interp.tokens
+
+    def generate_midi(self, output_file):
+        try:
+            with open(self.mc_file, 'r') as source, open(output_file, 'wb') as f:
+                tokens = self.tokens if self.tokens else scan_stream(source)
+                self.write_midi(tokens, f)
+        except Exception:
+            # No half-written file on a syntax error
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+        print(f"Successfully wrote {output_file}")
+
+    def write_midi(self, tokens, stream):
+        # The track length goes before the track, so it is patched in at
+        # the end on a seekable stream; anything else gets the track
+        # buffered whole
+        stream.write(HEADER.pack(b'MThd', 6, 0, 1, DIVISION))
+        seekable = stream.seekable()
+        if seekable:
+            length_at = stream.tell()
+            stream.write(CHUNK.pack(b'MTrk', 0))
+            out = stream
+        else:
+            out = io.BytesIO()
+
+        data = bytearray(meta(TRACK_NAME, "MusicCoder Output"))
+        length = 0
+        running = False # Whether the last event set the note-on status
+        depth = 0
+        repeat_ends = {} # Repeat sign text -> marker event
+        for i, token in enumerate(tokens):
+            ctype = token['type']
+            if ctype == 'NOTE':
+                flags = (1 if token['staccato'] else 0) | (2 if token['legato'] else 0)
+                if flags:
+                    data += ARTICULATIONS[flags]
+                    running = False
+                if running:
+                    data += NOTE_EVENTS[token['value']]
+                else:
+                    data += bytes([0, NOTE_ON, token['value'], VELOCITY, DIVISION, token['value'], 0])
+                    running = True
+            elif ctype == 'REST_Q' or ctype == 'REST_H':
+                if running:
+                    data += REST_EVENTS[ctype]
+                else:
+                    events = REST_EVENTS[ctype]
+                    data += bytes([events[0], NOTE_ON]) + events[1:]
+                    running = True
+            elif ctype == 'LOOP_START':
+                depth += 1
+                data += REPEAT_START
+                running = False
+            elif ctype == 'LOOP_END':
+                if not depth:
+                    raise SyntaxError("Unmatched :| at token {}".format(i))
+                depth -= 1
+                text = loop_end_text(token)
+                if text not in repeat_ends:
+                    repeat_ends[text] = meta(MARKER, text)
+                data += repeat_ends[text]
+                running = False
+
+            if len(data) >= WRITE_SIZE:
+                out.write(data)
+                length += len(data)
+                data = bytearray()
+
+        if depth:
+            raise SyntaxError("Unmatched |: in the score")
+        data += bytes([0, 0xFF, END_OF_TRACK, 0])
+        out.write(data)
+        length += len(data)
+
+        if seekable:
+            end = stream.tell()
+            stream.seek(length_at)
+            stream.write(CHUNK.pack(b'MTrk', length))
+            stream.seek(end)
+        else:
+            stream.write(CHUNK.pack(b'MTrk', length))
+            stream.write(out.getvalue())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python mc2mid.py <mc_file> [output_mid]")
+        sys.exit(1)
+
+    mc_file = sys.argv[1]
+    if len(sys.argv) >= 3:
+        out_file = sys.argv[2]
+    else:
+        out_file = mc_file.rsplit('.', 1)[0] + ".mid"
+
+    converter = MC2MID(mc_file)
+    converter.generate_midi(out_file)
@@ -1,151 +1,248 @@
+import os
 import sys
-import re
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from interpreter import MusicCoderInterpreter
+from interpreter import MusicCoderInterpreter, scan, scan_stream
+
+
+def measures(tokens):
+    # Lays the tokens out in 4/4: yields (token, measure number, opens) where
+    # opens is True when the token starts a new <measure> element.
+    measure_num = 1
+    current_beats = 0
+
+    for token in tokens:
+        ctype = token['type']
+        opens = False
+
+        # Check for Measure Full (Simple 4/4 logic)
+        if current_beats >= 4:
+            #measure_num += 1
+            opens = True
+            current_beats = 0
+
+        if ctype == 'LOOP_START' and current_beats > 0:
+            # If mid-measure, start new measure to ensure repeat sign is at start
+            measure_num += 1
+            opens = True
+            current_beats = 0
+
+        yield token, measure_num, opens
+
+        if ctype == 'LOOP_END':
+            # generate_xml forces a new measure after a repeat end
+            current_beats = 0
+        elif ctype == 'REST_H':
+            current_beats += 2
+        elif ctype == 'REST_Q' or ctype == 'NOTE':
+            current_beats += 1
+
+
+# Pitch class -> (step, alter)
+# 0=C, 1=C#, 2=D, 3=D#, 4=E, 5=F, 6=F#, 7=G, 8=G#, 9=A, 10=A#, 11=B
+STEP_MAP = {
+    0: ('C', 0), 1: ('C', 1), 2: ('D', 0), 3: ('D', 1),
+    4: ('E', 0), 5: ('F', 0), 6: ('F', 1), 7: ('G', 0),
+    8: ('G', 1), 9: ('A', 0), 10: ('A', 1), 11: ('B', 0)
+}
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+# Writes indented XML straight to a text stream, laid out exactly like
+# minidom's toprettyxml(indent="  "). An opened element is only written
+# once something goes inside it, so one closed while still empty comes
+# out as <tag/>.
+class XMLWriter:
+    def __init__(self, stream, indent="  "):
+        self.stream = stream
+        self.indent = indent
+        self.open_tags = []
+        self.pending = None # Start tag not written yet
+        stream.write('<?xml version="1.0" ?>\n')
+
+    def _tag(self, name, attrs):
+        return name + ''.join(f' {key}="{_escape(str(value))}"' for key, value in attrs)
+
+    def _flush(self):
+        if self.pending is not None:
+            self.stream.write(f"{self.indent * (len(self.open_tags) - 1)}<{self.pending}>\n")
+            self.pending = None
+
+    def open(self, name, *attrs):
+        # attrs are (name, value) pairs, written in order
+        self._flush()
+        self.open_tags.append(name)
+        self.pending = self._tag(name, attrs)
+
+    def close(self):
+        name = self.open_tags.pop()
+        if self.pending is not None:
+            self.stream.write(f"{self.indent * len(self.open_tags)}<{self.pending}/>\n")
+            self.pending = None
+        else:
+            self.stream.write(f"{self.indent * len(self.open_tags)}</{name}>\n")
+
+    def element(self, name, text=None, *attrs):
+        # A leaf element, with text or empty
+        self._flush()
+        tag = self._tag(name, attrs)
+        if text is None:
+            self.stream.write(f"{self.indent * len(self.open_tags)}<{tag}/>\n")
+        else:
+            self.stream.write(f"{self.indent * len(self.open_tags)}<{tag}>{_escape(text)}</{name}>\n")
 
 
 class MC2XML:
     def __init__(self, mc_file):
-        with open(mc_file, 'r') as f:
-            self.code = f.read()
+        self.mc_file = mc_file
+        self._code = None # Source text, only read when asked for
         self.tokens = []
-        
+
+    @property
+    def code(self):
+        if self._code is None:
+            with open(self.mc_file, 'r') as f:
+                self._code = f.read()
+        return self._code
+
+    @code.setter
+    def code(self, text):
+        self._code = text
+
     def parse(self):
+        # Optional: generate_xml() tokenizes the file as it writes when
+        # nothing was parsed, without holding the tokens in memory
         interp = MusicCoderInterpreter(self.code)
         interp.tokenize()
         self.tokens = interp.tokens
 
     def generate_xml(self, output_file):
-        score = ET.Element('score-partwise', version="3.1")
+        # Each element is written out as its token is reached, so memory
+        # stays flat however long the score is
+        try:
+            with open(output_file, 'w') as f:
+                if self.tokens:
+                    self.write_xml(self.tokens, f)
+                elif self._code is not None:
+                    self.write_xml(scan(self._code), f)
+                else:
+                    with open(self.mc_file, 'r') as source:
+                        self.write_xml(scan_stream(source), f)
+        except Exception:
+            # No half-written score on a syntax error
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+        print(f"Successfully wrote {output_file}")
+
+    def write_xml(self, tokens, stream):
+        out = XMLWriter(stream)
+        out.open('score-partwise', ('version', "3.1"))
         
         # Part List
-        part_list = ET.SubElement(score, 'part-list')
-        score_part = ET.SubElement(part_list, 'score-part', id="P1")
-        part_name = ET.SubElement(score_part, 'part-name')
-        part_name.text = "MusicCoder Output"
+        out.open('part-list')
+        out.open('score-part', ('id', "P1"))
+        out.element('part-name', "MusicCoder Output")
+        out.close()
+        out.close()
         
         # Part
-        part = ET.SubElement(score, 'part', id="P1")
+        out.open('part', ('id', "P1"))
         
         # Measure 1 (Attributes)
-        measure_num = 1
-        current_measure = ET.SubElement(part, 'measure', number=str(measure_num))
-        
-        attrs = ET.SubElement(current_measure, 'attributes')
-        divs = ET.SubElement(attrs, 'divisions')
-        divs.text = "1"
-        key = ET.SubElement(attrs, 'key')
-        fifths = ET.SubElement(key, 'fifths')
-        fifths.text = "0"
-        time = ET.SubElement(attrs, 'time')
-        beats = ET.SubElement(time, 'beats')
-        beats.text = "4"
-        beat_type = ET.SubElement(time, 'beat-type')
-        beat_type.text = "4"
-        clef = ET.SubElement(attrs, 'clef')
-        sign = ET.SubElement(clef, 'sign')
-        sign.text = "G"
-        line = ET.SubElement(clef, 'line')
-        line.text = "2"
+        out.open('measure', ('number', "1"))
         
-        current_beats = 0
+        out.open('attributes')
+        out.element('divisions', "1")
+        out.open('key')
+        out.element('fifths', "0")
+        out.close()
+        out.open('time')
+        out.element('beats', "4")
+        out.element('beat-type', "4")
+        out.close()
+        out.open('clef')
+        out.element('sign', "G")
+        out.element('line', "2")
+        out.close()
+        out.close()
         
-        for token in self.tokens:
+        depth = 0 # Open repeats, checked as parse() would
+        for i, (token, measure_num, opens) in enumerate(measures(tokens)):
             ctype = token['type']
-            
-            # Check for Measure Full (Simple 4/4 logic)
-            if current_beats >= 4:
-                #measure_num += 1
-                current_measure = ET.SubElement(part, 'measure', number=str(measure_num))
-                current_beats = 0
+
+            if opens:
+                out.close()
+                out.open('measure', ('number', measure_num))
             
             if ctype == 'LOOP_START':
-                # If mid-measure, start new measure to ensure repeat sign is at start
-                if current_beats > 0:
-                    measure_num += 1
-                    current_measure = ET.SubElement(part, 'measure', number=str(measure_num))
-                    current_beats = 0
-
+                depth += 1
                 # Barline Repeat Start
-                barline = ET.SubElement(current_measure, 'barline', location="left")
-                bar_style = ET.SubElement(barline, 'bar-style')
-                bar_style.text = "heavy-light"
-                repeat = ET.SubElement(barline, 'repeat', direction="forward")
+                out.open('barline', ('location', "left"))
+                out.element('bar-style', "heavy-light")
+                out.element('repeat', None, ('direction', "forward"))
+                out.close()
                 
             elif ctype == 'LOOP_END':
+                if not depth:
+                    raise SyntaxError("Unmatched :| at token {}".format(i))
+                depth -= 1
                 # Barline Repeat End
-                barline = ET.SubElement(current_measure, 'barline', location="right")
-                bar_style = ET.SubElement(barline, 'bar-style')
-                bar_style.text = "light-heavy"
-                repeat = ET.SubElement(barline, 'repeat', direction="backward")
+                out.open('barline', ('location', "right"))
+                out.element('bar-style', "light-heavy")
+                out.element('repeat', None, ('direction', "backward"))
+                out.close()
                 
                 # Force new measure after repeat end
                 #measure_num += 1
-                current_measure = ET.SubElement(part, 'measure', number=str(measure_num))
-                current_beats = 0
+                out.close()
+                out.open('measure', ('number', measure_num))
                 
             elif ctype == 'REST_H' or ctype == 'REST_Q':
-                note_elem = ET.SubElement(current_measure, 'note')
-                rest_elem = ET.SubElement(note_elem, 'rest')
-                dur_elem = ET.SubElement(note_elem, 'duration')
-                type_elem = ET.SubElement(note_elem, 'type')
-                
+                out.open('note')
+                out.element('rest')
                 if ctype == 'REST_H':
-                    dur_elem.text = "2"
-                    type_elem.text = "half"
-                    current_beats += 2
+                    out.element('duration', "2")
+                    out.element('type', "half")
                 else:
-                    dur_elem.text = "1"
-                    type_elem.text = "quarter"
-                    current_beats += 1
+                    out.element('duration', "1")
+                    out.element('type', "quarter")
+                out.close()
                     
             elif ctype == 'NOTE':
-                note_elem = ET.SubElement(current_measure, 'note')
-                pitch = ET.SubElement(note_elem, 'pitch')
-                
+                out.open('note')
+                out.open('pitch')
 
                 midi_val = token['value']
                 
                 # C-1 = 0 (Standard MIDI)
                 octave = (midi_val // 12) - 1
-                step_val = midi_val % 12
-                
-                # Map step_val to Name + Alter
-                # 0=C, 1=C#, 2=D, 3=D#, 4=E, 5=F, 6=F#, 7=G, 8=G#, 9=A, 10=A#, 11=B
-                step_map = {
-                    0: ('C', 0), 1: ('C', 1), 2: ('D', 0), 3: ('D', 1),
-                    4: ('E', 0), 5: ('F', 0), 6: ('F', 1), 7: ('G', 0),
-                    8: ('G', 1), 9: ('A', 0), 10: ('A', 1), 11: ('B', 0)
-                }
+                step_name, alter_val = STEP_MAP[midi_val % 12]
                 
-                step_name, alter_val = step_map[step_val]
-                
-                step_elem = ET.SubElement(pitch, 'step')
-                step_elem.text = step_name
+                out.element('step', step_name)
                 if alter_val != 0:
-                    alter_elem = ET.SubElement(pitch, 'alter')
-                    alter_elem.text = str(alter_val)
-                octave_elem = ET.SubElement(pitch, 'octave')
-                octave_elem.text = str(octave)
+                    out.element('alter', str(alter_val))
+                out.element('octave', str(octave))
+                out.close()
                 
-                dur_elem = ET.SubElement(note_elem, 'duration')
-                dur_elem.text = "1" # Assume Quarter notes for all notes
-                type_elem = ET.SubElement(note_elem, 'type')
-                type_elem.text = "quarter"
-                current_beats += 1
+                out.element('duration', "1") # Assume Quarter notes for all notes
+                out.element('type', "quarter")
                 
                 # Articulations
                 if token['staccato']:
-                    notations = ET.SubElement(note_elem, 'notations')
-                    artic = ET.SubElement(notations, 'articulations')
-                    ET.SubElement(artic, 'staccato')
-                    
-        # Write to file
-        xml_str = minidom.parseString(ET.tostring(score)).toprettyxml(indent="  ")
-        with open(output_file, 'w') as f:
-            f.write(xml_str)
-        print(f"Successfully wrote {output_file}")
+                    out.open('notations')
+                    out.open('articulations')
+                    out.element('staccato')
+                    out.close()
+                    out.close()
+                out.close()
+
+        if depth:
+            raise SyntaxError("Unmatched |: in the score")
+        out.close()
+        out.close()
+        out.close()
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -159,5 +256,4 @@ if __name__ == "__main__":
         out_file = mc_file.rsplit('.', 1)[0] + ".musicxml"
         
     converter = MC2XML(mc_file)
-    converter.parse()
     converter.generate_xml(out_file)
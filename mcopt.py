@@ -0,0 +1,246 @@
+import argparse
+import sys
+
+from bytecode import STACCATO, LEGATO
+from interpreter import TOKEN_PATTERN, _make_token, scan
+
+# Longest note sequence searched for. From any previous note, any change
+# of a cell ending on any given note takes at most four notes.
+MAX_NOTES = 6
+
+NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Sets of cell changes (0-255) are 256-bit masks, bit d set when d is reachable
+_FULL = (1 << 256) - 1
+
+# Start note -> levels, levels[k][q] the mask of changes k notes can make
+# to a cell, from that previous note, leaving q as the previous note
+_levels = {}
+
+
+def _rotate(mask, shift):
+    # Adds shift (mod 256) to every change in the mask
+    shift %= 256
+    if not shift:
+        return mask
+    return ((mask << shift) | (mask >> (256 - shift))) & _FULL
+
+
+def _grow(start, count):
+    levels = _levels.get(start)
+    if levels is None:
+        levels = _levels[start] = [[0] * 128]
+        levels[0][start] = 1
+    while len(levels) <= count:
+        last = levels[-1]
+        level = [0] * 128
+        # One note v: added after any lower note, subtracted after a higher one
+        below = 0
+        for v in range(128):
+            level[v] |= _rotate(below, v)
+            below |= last[v]
+        above = 0
+        for v in range(127, -1, -1):
+            level[v] |= _rotate(above, -v)
+            above |= last[v]
+        # Two notes: the previous note again, then w, which adds w - previous
+        if len(levels) >= 2:
+            for p, mask in enumerate(levels[-2]):
+                if mask:
+                    for w in range(128):
+                        level[w] |= _rotate(mask, w - p)
+        levels.append(level)
+    return levels
+
+
+def _reaches(mask, delta):
+    if delta is None:
+        return mask != 0
+    return mask >> delta & 1
+
+
+def synthesize(start, delta, end=None, fewest=0, most=MAX_NOTES):
+    # Shortest list of note values that changes a cell by `delta` (mod 256,
+    # None for any change) after previous note `start`, leaving `end` as the
+    # previous note (None for any). Between `fewest` and `most` notes, None
+    # when no such list exists.
+    levels = _grow(start, most)
+    ends = range(128) if end is None else (end,)
+    if delta is not None:
+        delta &= 0xFF
+    for k in range(fewest, most + 1):
+        for q in ends:
+            if _reaches(levels[k][q], delta):
+                if delta is None:
+                    # Any change will do, take the lowest reachable one
+                    mask = levels[k][q]
+                    delta = (mask & -mask).bit_length() - 1
+                return _backtrack(levels, k, q, delta)
+    return None
+
+
+def _backtrack(levels, k, q, delta):
+    # Notes of one way to reach (k, q, delta), walking the levels backwards
+    notes = []
+    while k:
+        for p in range(128):
+            if p != q:
+                step = q if q > p else -q
+                if levels[k - 1][p] >> ((delta - step) & 0xFF) & 1:
+                    notes.append(q)
+                    k, q, delta = k - 1, p, (delta - step) & 0xFF
+                    break
+        else:
+            for p in range(128):
+                if k >= 2 and levels[k - 2][p] >> ((delta - q + p) & 0xFF) & 1:
+                    notes += [q, p]
+                    k, q, delta = k - 2, p, (delta - q + p) & 0xFF
+                    break
+    notes.reverse()
+    return notes
+
+
+def note_name(value, flags=0):
+    name = f"{NOTE_NAMES[value % 12]}{value // 12 - 1}"
+    if flags & STACCATO:
+        name += '.'
+    if flags & LEGATO:
+        name += '_'
+    return name
+
+
+def _segments(notes, prev):
+    # Splits a run of (value, flags) notes, entered with previous note `prev`,
+    # where its I/O happens: (first, end, start note, delta, end note, flags),
+    # flags None for an equal-note pair with I/O on both notes, kept as is.
+    segments = []
+    first = 0
+    start = prev
+    delta = 0
+    i = 0
+    while i < len(notes):
+        v, flags = notes[i]
+        if v == prev and i + 1 < len(notes):
+            # Equal to the previous note: consume the next note instead
+            w, more = notes[i + 1]
+            if flags and more:
+                segments.append((first, i, start, delta, prev, 0))
+                segments.append((i, i + 2, prev, w - v, w, None))
+                first, start, delta, prev, i = i + 2, w, 0, w, i + 2
+                continue
+            delta += w - v
+            flags |= more
+            prev = w
+            i += 2
+        else:
+            if v > prev:
+                delta += v
+            elif v < prev:
+                delta -= v
+            prev = v
+            i += 1
+        if flags:
+            segments.append((first, i, start, delta, prev, flags))
+            first, start, delta = i, prev, 0
+    segments.append((first, len(notes), start, delta, prev, 0))
+    return segments
+
+
+def _rewrite(run, prev, free_end):
+    # Replacement text for each segment of a run of note matches (with the
+    # bar lines and comments between them) that a shorter sequence can do:
+    # [(text start, text end, new text)]
+    notes = []
+    matches = []
+    for match in run:
+        if match.lastgroup == 'note':
+            token = _make_token(match)
+            notes.append((token['value'], (STACCATO if token['staccato'] else 0) | (LEGATO if token['legato'] else 0)))
+            matches.append(match)
+
+    segments = _segments(notes, prev)
+    # The previous note is free after the last notes of a run followed by a rest
+    last = len(segments) - 1
+    while last > 0 and segments[last][0] == segments[last][1]:
+        last -= 1
+
+    edits = []
+    for index, (first, end, start, delta, end_note, flags) in enumerate(segments):
+        if flags is None or end - first < 1:
+            continue
+        if flags == LEGATO:
+            delta = None # The read overwrites the cell
+        if free_end and index >= last:
+            end_note = None
+        values = synthesize(start, delta, end_note, 1 if flags else 0, min(end - first - 1, MAX_NOTES))
+        if values is None:
+            continue
+        names = [note_name(value) for value in values]
+        if flags:
+            names[-1] = note_name(values[-1], flags)
+        # Comments inside the segment move after it, bar lines go
+        text_start = matches[first].start()
+        text_end = matches[end - 1].end()
+        names += [match.group() for match in run
+                  if match.lastgroup == 'comment' and text_start < match.start() < text_end]
+        edits.append((text_start, text_end, " ".join(names)))
+    return edits
+
+
+def optimize_source(text):
+    # Rewrites every run of notes whose previous note is known on entry (at
+    # the start and after rests) with the fewest notes doing the same: the
+    # same output at each staccato note, the same cell value and previous
+    # note wherever the rest of the program can tell.
+    matches = list(TOKEN_PATTERN.finditer(text))
+    edits = []
+    prev = 0 # Previous note on entry to the next run, None when unknown
+    run = []
+    for index, match in enumerate(matches + [None]):
+        kind = None if match is None else match.lastgroup
+        if kind in ('comment', 'bar') or kind == 'note':
+            if kind == 'note' or run:
+                run.append(match)
+            continue
+
+        if run:
+            while run[-1].lastgroup != 'note':
+                run.pop()
+            if prev is not None:
+                edits += _rewrite(run, prev, kind is None or kind in ('rest_q', 'rest_h'))
+            run = []
+        prev = 0 if kind in ('rest_q', 'rest_h') else None
+
+    pieces = []
+    copied = 0
+    for start, end, new in edits:
+        pieces += [text[copied:start], new]
+        copied = end
+    pieces.append(text[copied:])
+    return "".join(pieces)
+
+
+def count_notes(text):
+    return sum(1 for token in scan(text) if token['type'] == 'NOTE')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shorten the note runs of a MusicCoder program.")
+    parser.add_argument("input_file")
+    parser.add_argument("output_file", nargs='?', help="Defaults to standard output")
+    args = parser.parse_args()
+
+    with open(args.input_file, 'r') as f:
+        source = f.read()
+    try:
+        optimized = optimize_source(source)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.output_file:
+        with open(args.output_file, 'w') as f:
+            f.write(optimized)
+    else:
+        sys.stdout.write(optimized)
+    print(f"{count_notes(source)} -> {count_notes(optimized)} notes", file=sys.stderr)
@@ -0,0 +1,195 @@
+import argparse
+import re
+import sys
+from interpreter import MusicCoderInterpreter
+from mc2mid import HEADER, CHUNK, MARKER
+from mcopt import note_name
+from xml2mc import CodeReader, READ_SIZE
+
+REPEAT_SIGN = re.compile(r'\|:|:\|(?:x\d+|R4)?')
+ARTICULATION = re.compile(r'[._]+')
+
+
+# Longest event start: a 4-byte delta time, then a status and two data
+# bytes, or FF, the meta type and a 4-byte data length
+LONGEST_EVENT = 10
+
+NAMES = [note_name(value) for value in range(128)]
+
+
+# Bytes of one track chunk, read from the file a block at a time
+class TrackReader:
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.left = length # Bytes of the chunk not read from the stream yet
+
+    def refill(self, buffer, at, size=LONGEST_EVENT):
+        # buffer[at:] plus the next block, holding `size` bytes if the
+        # chunk has that many left
+        if self.left and len(buffer) - at < max(size, LONGEST_EVENT):
+            block = self.stream.read(min(self.left, max(READ_SIZE, size)))
+            self.left -= len(block)
+            buffer = buffer[at:] + block
+            at = 0
+        if len(buffer) - at < size:
+            raise ValueError("MIDI track ends in the middle of an event")
+        return buffer, at
+
+
+def _number(buffer, at):
+    # Variable-length quantity: 7 bits per byte, high bit set on all but the last
+    value = 0
+    while True:
+        b = buffer[at]
+        at += 1
+        value = value << 7 | b & 0x7F
+        if not b & 0x80:
+            return value, at
+
+
+class MID2MC:
+    def __init__(self, midi_file):
+        self.midi_file = midi_file
+        self.mc_tokens = []
+
+    def iter_code(self):
+        # MusicCoder tokens as text, in order, tracks one after the other.
+        # Reads scores from mc2mid exactly; in other files every note-on is
+        # a note and a silence before one becomes a single rest.
+        with open(self.midi_file, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size or header[:4] != b'MThd':
+                raise ValueError("Not a Standard MIDI File")
+            tag, size, midi_format, tracks, division = HEADER.unpack(header)
+            if division & 0x8000:
+                raise ValueError("SMPTE time division is not supported")
+            f.read(size - 6)
+
+            while True:
+                chunk = f.read(CHUNK.size)
+                if len(chunk) < CHUNK.size:
+                    return
+                tag, length = CHUNK.unpack(chunk)
+                if tag != b'MTrk':
+                    f.seek(length, 1)
+                    continue
+                yield from self._track(TrackReader(f, length), division)
+
+    def _track(self, track, division):
+        time = 0
+        end = 0 # When the last note or rest ended
+        sounding = {} # key -> note-ons not yet turned off
+        flags = ''
+        status = None
+        bare_end = False # Whether the last token was a plain :|, which would take an R4 after it as its count
+        buffer = b''
+        at = 0
+        while True:
+            if len(buffer) - at < LONGEST_EVENT:
+                if at >= len(buffer) and not track.left:
+                    return
+                buffer, at = track.refill(buffer, at, min(LONGEST_EVENT, len(buffer) - at + track.left))
+            delta, at = _number(buffer, at)
+            time += delta
+            b = buffer[at]
+            at += 1
+
+            if b == 0xFF or b == 0xF0 or b == 0xF7:
+                if b == 0xFF:
+                    kind = buffer[at]
+                    at += 1
+                else:
+                    kind = None
+                length, at = _number(buffer, at)
+                buffer, at = track.refill(buffer, at, length)
+                data = buffer[at:at + length]
+                at += length
+                status = None
+                if kind == 0x2F:
+                    return
+                if kind == MARKER:
+                    text = data.decode('utf-8', 'replace')
+                    if REPEAT_SIGN.fullmatch(text):
+                        yield text
+                        bare_end = text == ':|'
+                    elif ARTICULATION.fullmatch(text):
+                        flags = text
+                continue
+
+            if b & 0x80:
+                status = b
+                first = buffer[at]
+                at += 1
+            elif status is None:
+                raise ValueError("MIDI data byte without a status")
+            else:
+                first = b
+            kind = status & 0xF0
+            if kind != 0xC0 and kind != 0xD0:
+                second = buffer[at]
+                at += 1
+            else:
+                second = 0
+
+            if kind == 0x90 and second:
+                if time > end:
+                    yield from self._rest(time - end, division, bare_end)
+                bare_end = False
+                sounding[first] = sounding.get(first, 0) + 1
+                yield NAMES[first] + flags
+                flags = ''
+                end = time
+            elif kind == 0x80 or kind == 0x90:
+                if sounding.get(first):
+                    sounding[first] -= 1
+                    if time > end:
+                        end = time
+                elif time > end:
+                    # Note-off of a silent key: the gap before it is a rest
+                    yield from self._rest(time - end, division, bare_end)
+                    bare_end = False
+                    end = time
+
+    def _rest(self, ticks, division, bare_end):
+        if ticks >= 2 * division:
+            yield 'R2'
+        else:
+            if bare_end:
+                yield '|'
+            yield 'R4'
+
+    def reader(self):
+        # The recovered source as a file object, for MusicCoderInterpreter
+        return CodeReader(self.iter_code())
+
+    def parse(self):
+        self.mc_tokens.extend(self.iter_code())
+
+    def get_code(self):
+        return " ".join(self.mc_tokens)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a MIDI file back to MusicCoder and run it.")
+    parser.add_argument("midi_file")
+    parser.add_argument("--no-run", action="store_true",
+                        help="Only print the recovered code, streamed as the file is read")
+    args = parser.parse_args()
+
+    converter = MID2MC(args.midi_file)
+    reader = converter.reader()
+    if not args.no_run:
+        print("Recovered MC Code:")
+    while True:
+        chunk = reader.read(READ_SIZE)
+        if not chunk:
+            break
+        sys.stdout.write(chunk)
+    print()
+    if args.no_run:
+        sys.exit(0)
+    print("-" * 20)
+    print("Executing Code:")
+
+    interpreter = MusicCoderInterpreter(converter.reader())
+    interpreter.run()
@@ -0,0 +1,407 @@
+from bytecode import (
+    Program, OP_HALT, OP_NOTE, OP_LEFT, OP_RIGHT, OP_LOOP, OP_END_LOOP,
+    OP_REPEAT, OP_REPEAT_NEXT, OP_END_REPEAT,
+    OP_ADD, OP_MOVE, OP_CLEAR, OP_MULADD, OP_SCAN, OP_OUT, OP_IN, OP_ADD_CELLS,
+    STACCATO, LEGATO, INFINITE, next_count
+)
+
+# The previous note is tracked as a frozenset of the values it may hold,
+# or None when nothing is known about it (any of 0-127).
+ZERO = frozenset([0])
+
+
+def _join(a, b):
+    if a is None or b is None:
+        return None
+    return a | b
+
+
+# Rewrites a compiled Program into fused instructions.
+# Interval arithmetic depends on the previous note, so a run of notes is
+# only fused when its effect is the same for every value the previous note
+# can hold at that point (rests reset it to 0, loops join the values flowing
+# in from before the loop and from the end of the body). Runs with I/O
+# become ADD/OUT/IN, so an equal note no longer looks ahead at run time,
+# and :|R4 counts taken from the notes after the loop become plain counts.
+# Counted loops whose body adds the same amounts every time round and ends
+# where it started are replaced by those amounts times the count.
+class PeepholeOptimizer:
+    def __init__(self, program):
+        self.source = program
+        self.program = Program()
+        self.flow_cache = {}
+        self.effect_cache = {}
+        self.depth = 0
+
+    def optimize(self):
+        # The trailing HALT is left out of the walk and re-emitted
+        self._block(0, len(self.source) - 1, ZERO, True)
+        self.program.emit(OP_HALT)
+        return self.program
+
+    def _block(self, start, end, prevs, emit):
+        code = self.source.code
+        arg = self.source.arg
+
+        pc = start
+        while pc < end:
+            op = code[pc]
+
+            if op == OP_NOTE:
+                j = pc
+                while code[j] == OP_NOTE:
+                    j += 1
+                prevs = self._notes(pc, j, prevs, emit)
+                pc = j
+
+            elif op == OP_LEFT or op == OP_RIGHT:
+                j = pc
+                while code[j] == OP_LEFT or code[j] == OP_RIGHT:
+                    j += 1
+                if emit:
+                    self._rests(pc, j)
+                prevs = ZERO
+                pc = j
+
+            else:
+                end_pc = arg[pc]
+                prevs = self._loop(pc, end_pc, prevs, emit)
+                pc = end_pc + 1
+
+                if op == OP_REPEAT_NEXT:
+                    # Count notes after :|R4 are only read by the loop start,
+                    # which now carries their count, and are never executed
+                    pc = next_count(self.source, end_pc)[1]
+
+        return prevs
+
+    def _flow(self, start, end, prevs):
+        key = (start, prevs)
+        if key not in self.flow_cache:
+            self.flow_cache[key] = self._block(start, end, prevs, False)
+        return self.flow_cache[key]
+
+    def _reps(self, start, prevs):
+        # A run only branches on how its first note compares with the previous
+        # note, so an unknown previous note needs one value per outcome.
+        # Counted loops always run their body, whose first note is the one.
+        if prevs is not None:
+            return prevs
+        code = self.source.code
+        while code[start] == OP_REPEAT or code[start] == OP_REPEAT_NEXT:
+            start += 1
+        if code[start] != OP_NOTE:
+            return ZERO
+        v = self.source.arg[start]
+        return [p for p in (v - 1, v, v + 1) if 0 <= p <= 127]
+
+    def _run_effect(self, start, end, prev):
+        arg = self.source.arg
+        delta = 0
+        pc = start
+        while pc < end:
+            v = arg[pc]
+            if v > prev:
+                delta += v
+            elif v < prev:
+                delta -= v
+            elif pc + 1 < end:
+                pc += 1
+                delta += arg[pc] - v
+                v = arg[pc]
+            prev = v
+            pc += 1
+        return delta % 256, prev
+
+    def _segment_effect(self, start, end, prev):
+        code = self.source.code
+        deltas = {}
+        offset = 0
+        low = 0
+        pc = start
+        while pc < end:
+            if code[pc] == OP_NOTE:
+                j = pc
+                while j < end and code[j] == OP_NOTE:
+                    j += 1
+                delta, prev = self._run_effect(pc, j, prev)
+                deltas[offset] = (deltas.get(offset, 0) + delta) % 256
+                pc = j
+            else:
+                offset += 1 if code[pc] == OP_RIGHT else -1
+                low = min(low, offset)
+                prev = 0
+                pc += 1
+        deltas = tuple(sorted((o, d) for o, d in deltas.items() if d))
+        return deltas, offset, low, prev
+
+    def _notes(self, start, end, prevs, emit):
+        effects = set(self._run_effect(start, end, p) for p in self._reps(start, prevs))
+        exits = frozenset(prev for delta, prev in effects)
+
+        if emit:
+            has_io = any(self.source.arg2[pc] for pc in range(start, end))
+            if not has_io and len(effects) == 1:
+                delta, prev = effects.pop()
+                if delta or prevs != exits:
+                    self.program.emit(OP_ADD, delta, prev, self.source.positions[start])
+                return exits
+
+            known = prevs is not None and len(prevs) == 1
+            plans = set(self._plan(start, end, p, known) for p in self._reps(start, prevs))
+            if has_io and len(plans) == 1:
+                for op, a, b, pc in plans.pop():
+                    self.program.emit(op, a, b, self.source.positions[pc])
+            else:
+                self._copy(start, end)
+        return exits
+
+    def _plan(self, start, end, prev, known):
+        # A run with I/O against one previous note, as instructions
+        # (op, arg, arg2, source pc): ADDs with OUT/IN in between. A note
+        # whose own comparison gives the right result at run time stays a
+        # NOTE. `known` says whether prev is the only value possible here,
+        # else the run-time previous note is not trusted until an ADD.
+        arg = self.source.arg
+        arg2 = self.source.arg2
+        plan = []
+        delta = 0
+        now = prev if known else None # Run-time previous note so far
+        pc = start
+        while pc < end:
+            note_pc = pc
+            v = arg[pc]
+            pending = delta
+            flags = [arg2[pc]]
+            if v > prev:
+                delta += v
+            elif v < prev:
+                delta -= v
+            elif pc + 1 < end:
+                # Equal: consumes the next note, whose I/O comes first
+                pc += 1
+                delta += arg[pc] - v
+                flags.insert(0, arg2[pc])
+                v = arg[pc]
+            pc += 1
+
+            if not any(flags):
+                prev = v
+                continue
+            if len(flags) == 1 and v != prev and now == prev and pending % 256 == 0:
+                plan.append((OP_NOTE, v, flags[0], note_pc))
+            else:
+                if delta % 256 or now != v:
+                    plan.append((OP_ADD, delta % 256, v, note_pc))
+                for f in flags:
+                    if f & STACCATO:
+                        plan.append((OP_OUT, 0, 0, note_pc))
+                    if f & LEGATO:
+                        plan.append((OP_IN, 0, 0, note_pc))
+            delta = 0
+            now = prev = v
+
+        if delta % 256 or now != prev:
+            plan.append((OP_ADD, delta % 256, prev, end - 1))
+        return tuple(plan)
+
+    def _rests(self, start, end):
+        if end - start == 1:
+            self._copy(start, end)
+            return
+        offset = 0
+        low = 0
+        for pc in range(start, end):
+            offset += 1 if self.source.code[pc] == OP_RIGHT else -1
+            low = min(low, offset)
+        self.program.emit(OP_MOVE, offset, low, self.source.positions[start])
+
+    def _loop(self, pc, end_pc, prevs, emit):
+        op = self.source.code[pc]
+
+        # Values the previous note can hold at the top of the body: whatever
+        # flows in, plus whatever the body leaves behind. Widen to unknown if
+        # that has not settled after two rounds.
+        head = prevs
+        for attempt in range(3):
+            exits = self._flow(pc + 1, end_pc, head)
+            widened = _join(head, exits)
+            if widened == head:
+                break
+            head = widened if attempt == 0 else None
+
+        count = self.source.arg2[pc]
+        if op == OP_REPEAT_NEXT:
+            notes = next_count(self.source, end_pc)[0]
+            if notes is not None:
+                op = OP_REPEAT
+                count = notes
+
+        if op == OP_LOOP:
+            fused = emit and self._fuse(pc, end_pc, head)
+        else:
+            fused = emit and op == OP_REPEAT and self._closed(pc, end_pc, count, prevs)
+        if emit and not fused:
+            program = self.program
+            positions = self.source.positions
+            start = program.emit(op, 0, count, positions[pc])
+            self.depth += 1
+            program.depth = max(program.depth, self.depth)
+            self._block(pc + 1, end_pc, head, True)
+            self.depth -= 1
+            if op == OP_LOOP:
+                end = program.emit(OP_END_LOOP, start, 0, positions[end_pc])
+            else:
+                end = program.emit(OP_END_REPEAT, start, self.depth, positions[end_pc])
+            program.arg[start] = end
+
+        if op == OP_LOOP:
+            # A Brainfuck loop may be skipped entirely
+            return _join(prevs, exits)
+        return exits
+
+    def _fuse(self, loop_pc, end, head):
+        # Fused instructions take the source position of the loop they replace
+        code = self.source.code
+        arg2 = self.source.arg2
+        pos = self.source.positions[loop_pc]
+        start = loop_pc + 1
+
+        if start == end:
+            return False
+        for pc in range(start, end):
+            op = code[pc]
+            if op == OP_NOTE:
+                if arg2[pc]:
+                    return False
+            elif op != OP_LEFT and op != OP_RIGHT:
+                return False
+
+        effects = set(self._segment_effect(start, end, p) for p in self._reps(start, head))
+        if len(effects) != 1:
+            return False
+        deltas, net, low, prev = effects.pop()
+
+        if net == 0:
+            step = dict(deltas).get(0, 0)
+            if step % 2 == 0:
+                # Only an odd step is guaranteed to reach zero
+                return False
+            others = tuple((o, d) for o, d in deltas if o != 0)
+            if not others and low == 0:
+                self.program.emit(OP_CLEAR, prev, 0, pos)
+            else:
+                # The loop runs until cell + n * step == 0 (mod 256)
+                factor = -pow(step, -1, 256) % 256
+                self.program.tables.append((factor, low, others))
+                self.program.emit(OP_MULADD, len(self.program.tables) - 1, prev, pos)
+            return True
+
+        if all(code[pc] == code[start] for pc in range(start, end)):
+            self.program.emit(OP_SCAN, net, 0, pos)
+            return True
+
+        return False
+
+    def _effect(self, start, end, prev):
+        # What straight-line code, counted loops included, does from one
+        # previous note: ({offset: delta}, pointer move, lowest offset,
+        # highest offset, previous note afterwards), or None if it does I/O
+        # or holds a loop that cannot be resolved this way
+        key = (start, end, prev)
+        if key in self.effect_cache:
+            return self.effect_cache[key]
+        code = self.source.code
+        arg = self.source.arg
+        arg2 = self.source.arg2
+        deltas = {}
+        offset = low = high = 0
+        result = None
+        pc = start
+        while pc < end:
+            op = code[pc]
+            if op == OP_NOTE:
+                j = pc
+                while j < end and code[j] == OP_NOTE:
+                    j += 1
+                if any(arg2[k] for k in range(pc, j)):
+                    break
+                delta, prev = self._run_effect(pc, j, prev)
+                deltas[offset] = deltas.get(offset, 0) + delta
+                pc = j
+            elif op == OP_LEFT or op == OP_RIGHT:
+                offset += 1 if op == OP_RIGHT else -1
+                low = min(low, offset)
+                high = max(high, offset)
+                prev = 0
+                pc += 1
+            elif op == OP_REPEAT or op == OP_REPEAT_NEXT:
+                end_pc = arg[pc]
+                count = arg2[pc]
+                after = end_pc + 1
+                if op == OP_REPEAT_NEXT:
+                    count, after = next_count(self.source, end_pc)
+                if count is None or count == INFINITE:
+                    break
+                inner = self._loop_effect(pc, end_pc, prev)
+                if inner is None:
+                    break
+                inner_deltas, net, inner_low, inner_high, prev = inner
+                times = max(count, 1)
+                for o, d in inner_deltas.items():
+                    deltas[offset + o] = deltas.get(offset + o, 0) + d * times
+                low = min(low, offset + inner_low)
+                high = max(high, offset + inner_high)
+                pc = after
+            else:
+                break
+        else:
+            deltas = dict((o, d % 256) for o, d in deltas.items() if d % 256)
+            result = (deltas, offset, low, high, prev)
+        self.effect_cache[key] = result
+        return result
+
+    def _loop_effect(self, pc, end_pc, prev):
+        # One pass through a counted loop's body, if every pass is the same:
+        # the pointer ends where it started, and the second pass, which
+        # starts from the note the first one left behind, does what the
+        # first did
+        first = self._effect(pc + 1, end_pc, prev)
+        if first is None or first[1] != 0:
+            return None
+        if first[4] != prev and self._effect(pc + 1, end_pc, first[4]) != first:
+            return None
+        return first
+
+    def _closed(self, pc, end_pc, count, prevs):
+        if count == INFINITE:
+            return False
+        effects = [self._loop_effect(pc, end_pc, p) for p in self._reps(pc + 1, prevs)]
+        if None in effects or any(effect != effects[0] for effect in effects):
+            return False
+        deltas, net, low, high, prev = effects[0]
+
+        times = max(count, 1)
+        targets = [(o, d * times % 256) for o, d in sorted(deltas.items())]
+        targets = [(o, d) for o, d in targets if d]
+        pos = self.source.positions[pc]
+        if low == high == 0:
+            delta = dict(targets).get(0, 0)
+            if delta or prevs != frozenset([prev]):
+                self.program.emit(OP_ADD, delta, prev, pos)
+            return True
+        if not targets or targets[-1][0] < high:
+            # The loop would have grown the tape this far
+            targets.append((high, 0))
+        self.program.tables.append((1, low, tuple(targets)))
+        self.program.emit(OP_ADD_CELLS, len(self.program.tables) - 1, prev, pos)
+        return True
+
+    def _copy(self, start, end):
+        for pc in range(start, end):
+            self.program.emit(self.source.code[pc], self.source.arg[pc], self.source.arg2[pc],
+                              self.source.positions[pc])
+
+
+def optimize(program):
+    return PeepholeOptimizer(program).optimize()
@@ -0,0 +1,187 @@
+from array import array
+from bisect import bisect_right
+
+from bytecode import (
+    OP_HALT, OP_NOTE, OP_LOOP, OP_END_LOOP, OP_REPEAT, OP_REPEAT_NEXT, OP_END_REPEAT,
+    OP_NAMES
+)
+
+# Rows in each section of the report
+DEFAULT_TOP = 20
+
+LOOP_STARTS = (OP_LOOP, OP_REPEAT, OP_REPEAT_NEXT)
+LOOP_ENDS = (OP_END_LOOP, OP_END_REPEAT)
+
+
+# Execution profile of one Program, filled in by MusicCoderInterpreter.execute.
+# Only the rare events are recorded while running: jumps taken at loop
+# markers, notes that consumed the next note, entry and exit of outermost
+# loops and new pointer maxima. How often every instruction ran is rebuilt
+# from those afterwards, since all instructions between two jumps run the
+# same number of times.
+class Profile:
+    def __init__(self, program):
+        self.program = program
+        self.taken = array('q', bytes(8 * len(program))) # Jumps taken per loop marker
+        self.consumed = array('q', bytes(8 * len(program))) # Equal notes that consumed the next note
+        self.nest_time = {} # Outermost loop start pc -> seconds spent inside
+        self.nest_elapsed = 0.0 # Time inside the current nest when execution paused
+        self.outer = set() # pcs of the outermost loop markers
+        self.max_ptr = 0
+        self.elapsed = 0.0
+        self.stop_pc = None # Instruction that raised or was paused at, if execution stopped early
+        self.stop_reason = None # 'pause' or 'step_limit' before running it, 'error' while running it
+
+        depth = 0
+        for pc in range(len(program)):
+            op = program.code[pc]
+            if op in LOOP_STARTS:
+                if depth == 0:
+                    self.outer.add(pc)
+                    self.outer.add(program.arg[pc])
+                    self.nest_time[pc] = 0.0
+                depth += 1
+            elif op in LOOP_ENDS:
+                depth -= 1
+
+    def _skip(self, end_pc):
+        # Count notes jumped over when a :|R4 loop finishes
+        program = self.program
+        if program.code[program.arg[end_pc]] != OP_REPEAT_NEXT:
+            return 0
+        pc = end_pc + 1
+        while program.code[pc] == OP_NOTE and not program.arg2[pc]:
+            pc += 1
+        return pc - end_pc - 1
+
+    def arrivals(self):
+        # How often control reached each instruction
+        program = self.program
+        code = program.code
+        arg = program.arg
+        taken = self.taken
+        consumed = self.consumed
+        arrive = [0] * (len(program) + 2)
+        arrive[0] = 1
+
+        # Jumps land one past their target
+        for pc in range(len(program)):
+            if taken[pc]:
+                arrive[arg[pc] + 1] += taken[pc]
+
+        for pc in range(len(program)):
+            op = code[pc]
+            if op == OP_HALT:
+                continue
+            out = arrive[pc]
+            if pc == self.stop_pc:
+                out -= 1
+            if op == OP_NOTE:
+                arrive[pc + 1] += out - consumed[pc]
+                arrive[pc + 2] += consumed[pc]
+            elif op == OP_LOOP or op == OP_END_LOOP:
+                arrive[pc + 1] += out - taken[pc]
+            elif op == OP_END_REPEAT:
+                arrive[pc + 1 + self._skip(pc)] += out - taken[pc]
+            else:
+                arrive[pc + 1] += out
+        return arrive[:len(program)]
+
+    def counts(self):
+        # Executions per instruction; a note consumed by an equal note
+        # counts as executed along with it. An instruction that execution
+        # paused or hit the step limit at was only reached, not run; one
+        # that raised an error counts, as in the step count.
+        arrive = self.arrivals()
+        code = self.program.code
+        counts = list(arrive)
+        for pc in range(len(counts)):
+            if code[pc] == OP_HALT:
+                counts[pc] = 0
+            elif self.consumed[pc]:
+                counts[pc + 1] += self.consumed[pc]
+        if self.stop_pc is not None and self.stop_reason != 'error':
+            counts[self.stop_pc] -= 1
+        return counts
+
+    def loops(self):
+        # (start pc, end pc, entries, iterations) per loop
+        arrive = self.arrivals()
+        program = self.program
+        result = []
+        for pc in range(len(program)):
+            if program.code[pc] in LOOP_STARTS:
+                result.append((pc, program.arg[pc], arrive[pc], arrive[pc + 1]))
+        return result
+
+    def report(self, source=None, top=DEFAULT_TOP):
+        # Text report of the hottest instructions and loops. With the
+        # source text, positions are shown as line:col, measure and token.
+        program = self.program
+        locate = _Locator(source)
+        counts = self.counts()
+        total = sum(counts)
+
+        lines = [f"Profile: {total} instructions in {self.elapsed:.3f}s, max pointer {self.max_ptr}"]
+        if self.stop_pc is not None:
+            where, measure, text = locate(program.positions[self.stop_pc])
+            text = text or OP_NAMES[program.code[self.stop_pc]]
+            if self.stop_reason == 'error':
+                lines.append(f"Stopped by an error at {text} ({where})")
+            else:
+                lines.append(f"Stopped before {text} ({where}), which is not counted as executed")
+
+        lines.append("")
+        lines.append(f"Hot spots (top {top}):")
+        lines.append(f"{'executions':>12} {'share':>6}  {'line:col':<10} {'measure':>7}  token")
+        hot = sorted((pc for pc in range(len(counts)) if counts[pc]), key=lambda pc: -counts[pc])
+        for pc in hot[:top]:
+            where, measure, text = locate(program.positions[pc])
+            if text is None:
+                text = OP_NAMES[program.code[pc]]
+            lines.append(f"{counts[pc]:>12} {counts[pc] / total:>6.1%}  {where:<10} {measure:>7}  {text}")
+
+        lines.append("")
+        lines.append(f"Loops (top {top} by iterations):")
+        lines.append(f"{'iterations':>12} {'entries':>9} {'seconds':>9}  {'line:col':<10} {'measure':>7}  loop")
+        loops = sorted(self.loops(), key=lambda loop: -loop[3])
+        for start, end, entries, iterations in loops[:top]:
+            if not entries:
+                continue
+            where, measure, text = locate(program.positions[start])
+            end_text = locate(program.positions[end])[2] or OP_NAMES[program.code[end]]
+            seconds = self.nest_time.get(start)
+            seconds = f"{seconds:.3f}" if seconds is not None else ""
+            lines.append(f"{iterations:>12} {entries:>9} {seconds:>9}  {where:<10} {measure:>7}  "
+                         f"{text or '|:'} ... {end_text}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Maps source offsets to (line:col, measure, token text)
+class _Locator:
+    def __init__(self, source):
+        self.source = source
+        self.line_starts = [0]
+        self.measures = {}
+        if source is None:
+            return
+        for i, char in enumerate(source):
+            if char == '\n':
+                self.line_starts.append(i + 1)
+
+        # Imported here, mc2xml imports the interpreter
+        from interpreter import scan, TOKEN_PATTERN
+        from mc2xml import measures
+        self.pattern = TOKEN_PATTERN
+        for token, number, opens in measures(scan(source)):
+            self.measures[token['pos']] = number
+
+    def __call__(self, pos):
+        if pos < 0 or self.source is None:
+            return "?", "", None
+        line = bisect_right(self.line_starts, pos)
+        col = pos - self.line_starts[line - 1] + 1
+        match = self.pattern.match(self.source, pos)
+        text = match.group() if match else None
+        return f"{line}:{col}", str(self.measures.get(pos, "")), text
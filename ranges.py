@@ -0,0 +1,224 @@
+from bytecode import (
+    OP_LEFT, OP_RIGHT, OP_LOOP, OP_REPEAT, OP_REPEAT_NEXT,
+    OP_MOVE, OP_MULADD, OP_SCAN, OP_ADD_CELLS, INFINITE, OP_NAMES, next_count
+)
+from profiler import _Locator
+
+LOOP_STARTS = (OP_LOOP, OP_REPEAT, OP_REPEAT_NEXT)
+# Instructions that move the pointer or touch cells other than the current one
+POINTER_OPS = frozenset((OP_LEFT, OP_RIGHT, OP_MOVE, OP_MULADD, OP_SCAN, OP_ADD_CELLS))
+# Those that check how far left they reach every time they run; MULADD and
+# SCAN do nothing on a zero cell
+CHECKED_OPS = frozenset((OP_LEFT, OP_MOVE, OP_ADD_CELLS))
+
+# Largest count a :|R4 loop can read from the next cell
+MAX_CELL_COUNT = 255
+
+
+# Bounds are ints, or None for unbounded: minus infinity as a low bound,
+# plus infinity as a high one
+def _add(a, b):
+    if a is None or b is None:
+        return None
+    return a + b
+
+
+def _lowest(a, b):
+    if a is None or b is None:
+        return None
+    return min(a, b)
+
+
+def _highest(a, b):
+    if a is None or b is None:
+        return None
+    return max(a, b)
+
+
+def _low_times(bound, fewest, most):
+    # Lowest k * bound for fewest <= k <= most, most None for no limit
+    if most == 0:
+        return 0
+    if bound is None:
+        return None
+    if bound >= 0:
+        return bound * fewest
+    return None if most is None else bound * most
+
+
+def _high_times(bound, fewest, most):
+    if most == 0:
+        return 0
+    if bound is None:
+        return None
+    if bound <= 0:
+        return bound * fewest
+    return None if most is None else bound * most
+
+
+# Range of the pointer before every instruction of a Program, found without
+# running it, starting from pointer `ptr`. Loop bodies are first summarised
+# relative to where they start, as (lowest and highest net move, lowest and
+# highest offset reached): a loop whose body ends where it started stays
+# within that body's reach however often it runs, and a counted loop drifts
+# at most count times its body's move. Only loops whose drift depends on the
+# data, Brainfuck loops with a net move and scan loops, leave the pointer
+# unbounded.
+class PointerRanges:
+    def __init__(self, program, ptr=0):
+        self.program = program
+        self.ptr = ptr
+        self.reached = bytearray(len(program)) # Whether the walk got to each instruction
+        self.low = [0] * len(program) # Lowest pointer before each instruction
+        self.high = [None] * len(program) # Highest pointer, None if unbounded
+        self.max_ptr = ptr # Highest pointer the program can reach, None if unbounded
+        self.underflows = [] # Moves that always run and always go left of 0
+        self.summaries = {}
+        self._walk(0, len(program) - 1, ptr, ptr)
+
+    def _op(self, pc):
+        # Summary of an instruction other than a loop
+        program = self.program
+        op = program.code[pc]
+        arg = program.arg[pc]
+        if op == OP_RIGHT:
+            return 1, 1, 0, 1
+        if op == OP_LEFT:
+            return -1, -1, -1, 0
+        if op == OP_MOVE:
+            return arg, arg, program.arg2[pc], max(arg, 0)
+        if op == OP_MULADD or op == OP_ADD_CELLS:
+            factor, low, targets = program.tables[arg]
+            return 0, 0, low, max([0] + [offset for offset, delta in targets])
+        if op == OP_SCAN:
+            return (0, None, 0, None) if arg > 0 else (None, 0, None, 0)
+        return 0, 0, 0, 0
+
+    def _passes(self, pc):
+        # Fewest and most times a loop runs its body, most None for no limit
+        program = self.program
+        op = program.code[pc]
+        if op == OP_LOOP:
+            return 0, None
+        count = program.arg2[pc]
+        if op == OP_REPEAT_NEXT:
+            count = next_count(program, program.arg[pc])[0]
+            if count is None:
+                return 1, MAX_CELL_COUNT
+        if count == INFINITE:
+            return 1, None
+        return max(count, 1), max(count, 1)
+
+    def _after(self, pc):
+        # Instruction after a loop, past any :|R4 count notes
+        program = self.program
+        if program.code[pc] == OP_REPEAT_NEXT:
+            return next_count(program, program.arg[pc])[1]
+        return program.arg[pc] + 1
+
+    def _summary(self, start, end):
+        net_low = net_high = reach_low = reach_high = 0
+        code = self.program.code
+        pc = start
+        while pc < end:
+            op = code[pc]
+            if op in LOOP_STARTS:
+                summary = self._loop(pc)[0]
+                pc = self._after(pc)
+            elif op in POINTER_OPS:
+                summary = self._op(pc)
+                pc += 1
+            else:
+                pc += 1
+                continue
+            reach_low = _lowest(reach_low, _add(net_low, summary[2]))
+            reach_high = _highest(reach_high, _add(net_high, summary[3]))
+            net_low = _add(net_low, summary[0])
+            net_high = _add(net_high, summary[1])
+        return net_low, net_high, reach_low, reach_high
+
+    def _loop(self, pc):
+        # (summary of the whole loop, range of where a pass through the
+        # body can start relative to where the loop was entered)
+        if pc not in self.summaries:
+            net_low, net_high, reach_low, reach_high = self._summary(pc + 1, self.program.arg[pc])
+            fewest, most = self._passes(pc)
+            before = None if most is None else most - 1 # Passes before the last one
+            drift = (_low_times(net_low, 0, before), _high_times(net_high, 0, before))
+            self.summaries[pc] = ((_low_times(net_low, fewest, most), _high_times(net_high, fewest, most),
+                                   _add(drift[0], reach_low), _add(drift[1], reach_high)), drift)
+        return self.summaries[pc]
+
+    def _walk(self, start, end, low, high, always=True):
+        # Records the pointer range before each instruction from the range
+        # at `start`, and returns the range at `end`. The pointer is never
+        # negative while the program runs, as moving left of 0 stops it.
+        # `always` is False inside a loop that may be skipped.
+        program = self.program
+        code = program.code
+        reached = self.reached
+        lows = self.low
+        highs = self.high
+        pc = start
+        while pc < end:
+            reached[pc] = 1
+            lows[pc] = low
+            highs[pc] = high
+            op = code[pc]
+
+            if op not in POINTER_OPS and op not in LOOP_STARTS:
+                pc += 1
+                continue
+
+            if op in LOOP_STARTS:
+                # The body is walked once, from every place a pass can start
+                summary, drift = self._loop(pc)
+                end_pc = program.arg[pc]
+                body_exit = self._walk(pc + 1, end_pc, max(_add(low, drift[0]) or 0, 0), _add(high, drift[1]),
+                                       always and self._passes(pc)[0] > 0)
+                reached[end_pc] = 1
+                lows[end_pc], highs[end_pc] = body_exit
+                low = max(_add(low, summary[0]) or 0, 0)
+                high = _add(high, summary[1])
+                pc = self._after(pc)
+                continue
+
+            net_low, net_high, reach_low, reach_high = self._op(pc)
+            if reach_low is not None and reach_low < 0 and op in CHECKED_OPS:
+                if always and high is not None and high + reach_low < 0:
+                    self.underflows.append(pc)
+                # Past the check the pointer was at least -reach_low
+                low = max(low, -reach_low)
+            self.max_ptr = _highest(self.max_ptr, _add(high, reach_high))
+            low = max(_add(low, net_low) or 0, 0)
+            high = _add(high, net_high)
+            if high is not None and high < low:
+                high = low
+            pc += 1
+        return low, high
+
+    def floor_safe(self, pc, offset):
+        # Whether pointer + offset cannot be negative at pc
+        return bool(self.reached[pc]) and self.low[pc] + offset >= 0
+
+    def fits(self, pc, offset, size):
+        # Whether pointer + offset stays below `size` at pc
+        return bool(self.reached[pc]) and self.high[pc] is not None and self.high[pc] + offset < size
+
+    def report(self, source=None):
+        # Text report of the tape needed and of moves that always fail,
+        # with line:col positions when given the source text
+        program = self.program
+        locate = _Locator(source)
+        if self.max_ptr is None:
+            lines = ["Tape: unbounded, some loop moves the pointer a data-dependent distance"]
+        else:
+            lines = [f"Tape: at most {self.max_ptr + 1} cells"]
+        for pc in self.underflows:
+            where, measure, text = locate(program.positions[pc])
+            lines.append(f"{where}: {text or OP_NAMES[program.code[pc]]} always moves the pointer left of 0")
+        return "\n".join(lines) + "\n"
+
+
+def analyze(program, ptr=0):
+    return PointerRanges(program, ptr)
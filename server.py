@@ -0,0 +1,322 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from batch import PROGRAM_CACHE_SIZE, _init_worker, run_job
+
+# Every message, either way, is a little-endian uint32 length followed by
+# that many bytes of UTF-8 JSON.
+#
+# Requests:
+#   {"op": "run", "source": ...}  run a program, with the job keys of
+#                                 batch.load_manifest (stdin, stdin_base64,
+#                                 max_steps, timeout, optimize, binary, ...)
+#   {"op": "run", "hash": ...}    run a program sent earlier, by the "hash"
+#                                 returned with its first result
+#   {"op": "stats"}               throughput and latency counters
+#   {"op": "ping"}
+# Replies to "run" are batch.run_job results plus "hash"; status
+# "unknown_program" means the hash is not cached (any more) and the source
+# has to be sent again. Malformed requests get {"status": "bad_request"}.
+FRAME = struct.Struct('<I')
+MAX_MESSAGE = 64 * 1024 * 1024
+
+# Latencies kept for the percentiles in "stats"
+LATENCY_SAMPLES = 4096
+
+# Types a "run" request's fields must have when given; null is allowed
+# where the job treats it as "not set"
+FIELD_TYPES = {
+    'source': (str,),
+    'hash': (str,),
+    'stdin': (str,),
+    'stdin_base64': (str,),
+    'max_steps': (int, type(None)),
+    'timeout': (int, float, type(None)),
+    'tape_size': (int,),
+    'max_tape_size': (int, type(None)),
+}
+
+
+def encode(message):
+    data = json.dumps(message).encode('utf-8')
+    return FRAME.pack(len(data)) + data
+
+
+async def read_message(reader):
+    # Next message from an asyncio stream, None once the peer closed it
+    try:
+        header = await reader.readexactly(FRAME.size)
+    except asyncio.IncompleteReadError:
+        return None
+    length, = FRAME.unpack(header)
+    if length > MAX_MESSAGE:
+        raise ValueError(f"Message of {length} bytes is too large")
+    return json.loads(await reader.readexactly(length))
+
+
+def check_run(message):
+    # Why a "run" request cannot be run, or None when it can
+    for field, types in FIELD_TYPES.items():
+        if field in message:
+            value = message[field]
+            if isinstance(value, bool) or not isinstance(value, types):
+                return f"Field {field!r} has the wrong type: {type(value).__name__}"
+    if 'source' not in message and 'hash' not in message:
+        return "A run request needs a 'source' or a 'hash'"
+    return None
+
+
+def parse_address(address):
+    # "unix:PATH" or "tcp:HOST:PORT" -> (family, address)
+    kind, _, rest = address.partition(':')
+    if kind == 'unix' and rest:
+        return socket.AF_UNIX, rest
+    if kind == 'tcp':
+        host, _, port = rest.rpartition(':')
+        if port.isdigit():
+            return socket.AF_INET, (host or '127.0.0.1', int(port))
+    raise ValueError(f"Address must be unix:PATH or tcp:HOST:PORT, not {address!r}")
+
+
+# Accepts run requests on a socket and hands them to a pool of worker
+# processes that were started, and imported the interpreter, up front.
+# Workers keep their own compiled programs (batch._compile); the server
+# keeps the sources by hash so clients can send just the hash.
+class Server:
+    def __init__(self, workers=None, programs=PROGRAM_CACHE_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.programs = programs
+        self.sources = collections.OrderedDict() # hash -> source, least recently used first
+        self.pool = None
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.busy = 0 # Jobs in the pool
+        self.busy_seconds = 0.0 # Summed time the workers spent running jobs
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.socket_path = None # Unix socket this server created
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        # Make sure every worker is up before taking requests
+        for future in [self.pool.submit(abs, 0) for i in range(self.workers)]:
+            future.result()
+
+    def _restart_pool(self, broken):
+        # Only the first job to notice a broken pool replaces it
+        if self.pool is broken:
+            self.counters['pool_restarts'] += 1
+            self.close()
+            self.start()
+
+    def close(self):
+        # Also safe when the workers were already killed, e.g. by a
+        # SIGTERM sent to the whole process group
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def _remember(self, source):
+        digest = hashlib.sha256(source.encode('utf-8', 'surrogatepass')).hexdigest()
+        self.sources[digest] = source
+        self.sources.move_to_end(digest)
+        if len(self.sources) > self.programs:
+            self.sources.popitem(last=False)
+        return digest
+
+    async def run(self, message):
+        start = time.perf_counter()
+        self.counters['requests'] += 1
+        job = dict(message)
+        job.pop('op', None)
+        digest = job.pop('hash', None)
+        if 'source' in job:
+            digest = self._remember(job['source'])
+            self.counters['source_requests'] += 1
+        elif digest in self.sources:
+            self.sources.move_to_end(digest)
+            job['source'] = self.sources[digest]
+            self.counters['hash_hits'] += 1
+        else:
+            self.counters['hash_misses'] += 1
+            return {'id': job.get('id'), 'hash': digest, 'status': 'unknown_program'}
+        job.pop('file', None) # Only code sent by the client runs
+
+        self.busy += 1
+        pool = self.pool
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(pool, run_job, job)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed or out of memory; later jobs get a
+            # fresh pool
+            self._restart_pool(pool)
+            self.counters['error'] += 1
+            return {'id': job.get('id'), 'hash': digest, 'status': 'error',
+                    'error': "Worker process died while running the job"}
+        finally:
+            self.busy -= 1
+        result['hash'] = digest
+        self.counters[result['status']] += 1
+        self.busy_seconds += result['seconds']
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        uptime = time.monotonic() - self.started
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        completed = sum(self.counters[status] for status in ('ok', 'error', 'step_limit', 'timeout', 'infinite_loop'))
+        return {
+            'uptime': uptime,
+            'workers': self.workers,
+            'busy': self.busy,
+            'counters': dict(self.counters),
+            'completed': completed,
+            'runs_per_sec': completed / uptime if uptime else None,
+            'worker_utilization': self.busy_seconds / (uptime * self.workers) if uptime else None,
+            'programs_cached': len(self.sources),
+            'latency': {'samples': len(latencies), 'p50': percentile(0.5),
+                        'p90': percentile(0.9), 'p99': percentile(0.99),
+                        'max': latencies[-1] if latencies else None},
+        }
+
+    async def handle(self, reader, writer):
+        # Requests on one connection are answered in order; clients open
+        # more connections to run programs in parallel
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                    if message is None:
+                        break
+                    op = message.get('op')
+                except (ValueError, AttributeError, asyncio.IncompleteReadError) as e:
+                    self.counters['bad_requests'] += 1
+                    writer.write(encode({'status': 'bad_request', 'error': str(e)}))
+                    break
+
+                if op == 'run':
+                    error = check_run(message)
+                    if error is None:
+                        reply = await self.run(message)
+                    else:
+                        self.counters['bad_requests'] += 1
+                        reply = {'status': 'bad_request', 'error': error}
+                elif op == 'stats':
+                    reply = self.stats()
+                elif op == 'ping':
+                    reply = {'status': 'ok'}
+                else:
+                    self.counters['bad_requests'] += 1
+                    reply = {'status': 'bad_request', 'error': f"Unknown op {op!r}"}
+                writer.write(encode(reply))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, address):
+        family, where = parse_address(address)
+        if family == socket.AF_UNIX:
+            _clear_socket(where)
+            server = await asyncio.start_unix_server(self.handle, where)
+            self.socket_path = where
+        else:
+            server = await asyncio.start_server(self.handle, *where)
+        async with server:
+            await server.serve_forever()
+
+
+def _clear_socket(path):
+    # Removes a socket left over from a server that is gone; anything else
+    # at the path is left alone
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f"{path} exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise ValueError(f"A server is already listening on {path}")
+
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(address, workers=None):
+    # Runs a server until interrupted or terminated
+    family, where = parse_address(address)
+    if family == socket.AF_UNIX:
+        # Before starting the workers, so a bad path fails fast
+        _clear_socket(where)
+    server = Server(workers)
+    server.start()
+    # After the workers fork, so pool.terminate() still stops them quietly
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        asyncio.run(server.serve(address))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if server.socket_path is not None and os.path.exists(server.socket_path):
+            os.unlink(server.socket_path)
+
+
+# Blocking client, one connection for any number of requests
+class Client:
+    def __init__(self, address):
+        family, where = parse_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(where)
+        self.file = self.socket.makefile('rb')
+
+    def request(self, message):
+        self.socket.sendall(encode(message))
+        header = self.file.read(FRAME.size)
+        if len(header) < FRAME.size:
+            raise ConnectionError("Server closed the connection")
+        length, = FRAME.unpack(header)
+        return json.loads(self.file.read(length))
+
+    def run(self, source=None, digest=None, **job):
+        # Runs by hash when given, sending the source again if the server
+        # no longer has it
+        if digest is not None:
+            result = self.request(dict(job, op='run', hash=digest))
+            if result['status'] != 'unknown_program' or source is None:
+                return result
+        return self.request(dict(job, op='run', source=source))
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,221 @@
+import codecs
+import os
+import stat
+import sys
+
+# Bytes collected before the output sink writes through to its stream
+DEFAULT_BUFFER_SIZE = 8192
+# Bytes (or characters in text mode) requested per read from the input stream
+DEFAULT_CHUNK_SIZE = 8192
+
+
+# Program output (staccato notes) as cell values 0-255.
+# Text mode writes chr(value) like the original interpreter, binary mode
+# writes the raw byte. Output is flushed at a size threshold, on newline
+# when writing to a terminal, and by flush() when the program ends.
+class OutputSink:
+    def __init__(self, stream=None, binary=False, buffer_size=DEFAULT_BUFFER_SIZE, line_buffered=None):
+        self.stream = stream if stream is not None else sys.stdout
+        self.binary = binary
+        self.buffer_size = max(buffer_size, 1)
+        if line_buffered is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            line_buffered = bool(isatty and isatty())
+        self.line_buffered = line_buffered
+        self.buffer = bytearray()
+
+    def write(self, value):
+        buffer = self.buffer
+        buffer.append(value)
+        if len(buffer) >= self.buffer_size or (value == 10 and self.line_buffered):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            if self.binary:
+                stream = getattr(self.stream, 'buffer', None)
+                if stream is None:
+                    stream = self.stream
+                else:
+                    # Keep ordering with anything already written as text
+                    self.stream.flush()
+                stream.write(bytes(self.buffer))
+            else:
+                # chr() of 0-255 is exactly a latin-1 decode
+                self.stream.write(self.buffer.decode('latin-1'))
+            self.buffer.clear()
+        self.stream.flush()
+
+
+# Program input (legato notes) as cell values 0-255, 0 once input runs out.
+# Regular files are read a chunk at a time; a terminal a line at a time,
+# and pipes whatever has arrived, so interactive programs do not wait for
+# a full chunk.
+class InputSource:
+    def __init__(self, stream=None, binary=False, chunk_size=DEFAULT_CHUNK_SIZE, flush=None):
+        self.stream = stream if stream is not None else sys.stdin
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.flush = flush # Called before a read that may block, e.g. OutputSink.flush
+        self.data = b''
+        self.pos = 0
+        self.consumed = 0 # Values handed to the program so far
+        self.eof = False
+        self.decoder = None # Text read from a pipe as bytes, decoded here
+
+    def read(self):
+        if self.pos >= len(self.data) and not self._fill():
+            return 0
+        value = self.data[self.pos]
+        self.pos += 1
+        self.consumed += 1
+        return value
+
+    def skip(self, count):
+        # Drops the next count values, e.g. input consumed before a snapshot
+        for i in range(count):
+            self.read()
+
+    def ready(self, count):
+        # True when count values can be read without blocking
+        return self.eof or len(self.data) - self.pos >= count
+
+    def wait(self, count):
+        # Blocks until count values are buffered or input ends
+        while not self.ready(count):
+            self._fill()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        if self.flush is not None:
+            self.flush()
+        try:
+            data = self._read_chunk()
+        except Exception:
+            data = None
+        if not data:
+            self.eof = True
+            return False
+        if not self.binary:
+            # Text mode stores ord(char), reduced to a byte cell
+            data = bytes(ord(char) & 0xFF for char in data)
+        self.data = self.data[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _read_chunk(self):
+        stream = self.stream
+        isatty = getattr(stream, 'isatty', None)
+        interactive = bool(isatty and isatty())
+        if self.binary:
+            stream = getattr(stream, 'buffer', stream)
+            read1 = getattr(stream, 'read1', None)
+            if read1 is not None:
+                return read1(self.chunk_size)
+        if interactive:
+            return stream.readline()
+        raw = getattr(stream, 'buffer', None)
+        read1 = getattr(raw, 'read1', None)
+        if read1 is None or self._regular_file(stream):
+            return stream.read(self.chunk_size)
+        if self.decoder is None:
+            decoder = codecs.getincrementaldecoder(getattr(stream, 'encoding', None) or 'utf-8')
+            self.decoder = decoder(getattr(stream, 'errors', None) or 'strict')
+        while True:
+            block = read1(self.chunk_size)
+            text = self.decoder.decode(block, final=not block)
+            # A block can end inside a character, which then decodes to nothing
+            if text or not block:
+                return text
+
+    def _regular_file(self, stream):
+        try:
+            return stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+        except (AttributeError, OSError, ValueError):
+            return False
+
+
+# In-memory input, bytes in
+class MemoryInput:
+    def __init__(self, data=b''):
+        self.data = bytes(data)
+        self.consumed = 0
+
+    def read(self):
+        if self.consumed >= len(self.data):
+            return 0
+        value = self.data[self.consumed]
+        self.consumed += 1
+        return value
+
+    def skip(self, count):
+        self.consumed += count
+
+
+# In-memory output, bytes out
+class MemoryOutput:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.write = self.buffer.append
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+    def take(self):
+        # Output so far, emptying the buffer
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+# Input from an asyncio stream (anything with an async read(n)), for
+# MusicCoderInterpreter.arun(). read() never waits: the interpreter pauses
+# before a legato note that finds too little buffered, and arun() awaits
+# fill() before continuing. Text chunks are stored as ord(char) & 0xFF.
+class AsyncInput:
+    def __init__(self, reader=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.data = b''
+        self.pos = 0
+        self.consumed = 0
+        self.skipping = 0 # Values still to drop once they arrive
+        self.eof = reader is None
+
+    def read(self):
+        if self.pos >= len(self.data):
+            return 0
+        value = self.data[self.pos]
+        self.pos += 1
+        self.consumed += 1
+        return value
+
+    def skip(self, count):
+        self.skipping += count
+        self._drop()
+
+    def _drop(self):
+        dropped = min(self.skipping, len(self.data) - self.pos)
+        self.pos += dropped
+        self.consumed += dropped
+        self.skipping -= dropped
+
+    def ready(self, count):
+        return self.eof or (not self.skipping and len(self.data) - self.pos >= count)
+
+    async def fill(self, count=1):
+        # Reads until count values are buffered or input ends
+        while not self.ready(count):
+            chunk = await self.reader.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+                return
+            if isinstance(chunk, str):
+                chunk = bytes(ord(char) & 0xFF for char in chunk)
+            self.data = self.data[self.pos:] + chunk
+            self.pos = 0
+            self._drop()
@@ -0,0 +1,41 @@
+# Initial number of cells, as in Brainfuck
+DEFAULT_SIZE = 30000
+# Smallest number of cells added when the tape grows
+MIN_GROWTH = 4096
+# Most cells reserve() allocates ahead of the pointer getting there
+MAX_RESERVE = 16 * 1024 * 1024
+
+
+# Byte cells that grow geometrically when the pointer runs off the end.
+# A memoryview over the tape pins its size, so views must be released
+# before a program that can still move right is resumed.
+class Tape(bytearray):
+    def __init__(self, size=DEFAULT_SIZE, max_size=None):
+        # At least one cell, for the pointer to start on
+        if size < 1:
+            raise ValueError(f"Tape size must be at least 1 cell, not {size}")
+        if max_size is not None and size > max_size:
+            raise ValueError(f"Tape size {size} exceeds the maximum of {max_size} cells")
+        super().__init__(size)
+        self.max_size = max_size
+
+    def grow(self, index):
+        # Make tape[index] valid
+        if self.max_size is not None and index >= self.max_size:
+            raise RuntimeError(f"Pointer moved past the end of the tape ({self.max_size} cells)")
+        size = max(index + 1, 2 * len(self), MIN_GROWTH)
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        self.extend(bytes(size - len(self)))
+
+    def reserve(self, index):
+        # Make tape[index] valid up front, growing to exactly that size,
+        # unless that is past the maximum. Returns whether it is valid.
+        if index >= len(self):
+            if index >= MAX_RESERVE or (self.max_size is not None and index >= self.max_size):
+                return False
+            self.extend(bytes(index + 1 - len(self)))
+        return True
+
+    def view(self):
+        return memoryview(self).toreadonly()
@@ -0,0 +1,112 @@
+# Sample and random programs for the differential tests, and a runner that
+# reduces a run to what every backend has to agree on
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from interpreter import MusicCoderInterpreter
+from streams import MemoryInput, MemoryOutput
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+# Brainfuck commands as notes
+BF = {'+': 'C-1 C-1 C#-1', '-': 'E-1 D#-1 D-1', '>': 'R4', '<': 'R2', '.': 'C-1 C-1 C-1.', ',': 'C-1_'}
+
+SAMPLES = [
+    'C#-1 |: C#-1 R2 D-1 R4 :| R2',
+    '|: C#-1 R2 D-1 R4 :| R2',
+    '|: B3 R2 G4 | D-1 R4 :| R2 G4 C4.',
+    '|: R2 :| C4.',
+    'C4_ |: C4 C4. C4_ :|',
+    'C4 E4 |: D4. :|x3 C4 C4 G4.',
+    'G4 |: R4 C4 C4 D4 R2 :|R4 C5 D5 R4 C4.',
+    'C#-1 C#-1 |: E-1 D#-1 D-1 R4 A4 R2 :| R4 C4.',
+]
+
+
+def note(value, rng):
+    text = NAMES[value % 12] + str(value // 12 - 1)
+    r = rng.random()
+    if r < 0.06:
+        text += '.'
+    elif r < 0.08:
+        text += '_'
+    return text
+
+
+def random_program(rng, depth=0, length=None):
+    # Notes with equal pairs, rests, bars and nested loops of every kind
+    out = []
+    pool = [rng.randint(0, 127) for i in range(4)] + [0, 1, 2, 3, 60, 61]
+    for i in range(length or rng.randint(1, 14)):
+        r = rng.random()
+        if r < 0.5:
+            value = rng.choice(pool)
+            out.append(note(value, rng))
+            if rng.random() < 0.3:
+                out.append(note(value, rng))
+        elif r < 0.65:
+            out.append('R4')
+        elif r < 0.75:
+            out.append('R2')
+        elif r < 0.8:
+            out.append('|')
+        elif depth < 3:
+            body = random_program(rng, depth + 1, rng.randint(1, 6))
+            suffix = rng.choice(['', '', '', 'x2', 'x3', 'x0', 'x1', 'R4', 'R4 C5 D5', 'R4 D5 C5'])
+            out.append('|: ' + body + ' :|' + suffix)
+    return ' '.join(out)
+
+
+def random_bf(rng, depth=0):
+    # Brainfuck-style programs, which mostly end and move data around
+    out = []
+    for i in range(rng.randint(1, 10)):
+        if rng.random() < 0.7:
+            out.append(BF[rng.choice('++++---><>.,')])
+        elif depth < 3:
+            out.append('|: ' + random_bf(rng, depth + 1) + ' :|' + rng.choice(['', '', '', 'x3', 'R4']))
+    return ' '.join(out)
+
+
+def random_programs(count, seed=0):
+    # (source, input) pairs
+    rng = random.Random(seed)
+    for i in range(count):
+        if i % 2:
+            source = random_program(rng)
+        else:
+            source = ' '.join(BF['+'] for k in range(rng.randint(0, 6))) + ' ' + random_bf(rng)
+        yield source, bytes(rng.randint(1, 126) for k in range(rng.randint(0, 5)))
+
+
+def sample(name):
+    with open(os.path.join(ROOT, name)) as f:
+        return f.read()
+
+
+def run(source, data=b'', max_steps=None, **options):
+    # (output, error type or None, tape up to its last non-zero cell); the
+    # tape is left out after an error, where backends may stop at different
+    # points of a fused instruction
+    output = MemoryOutput()
+    interpreter = MusicCoderInterpreter(source, input_source=MemoryInput(data), output_sink=output, **options)
+    interpreter.max_steps = max_steps
+    try:
+        interpreter.run()
+    except Exception as e:
+        return output.getvalue(), type(e).__name__, None
+    return output.getvalue(), None, bytes(interpreter.tape).rstrip(b'\0')
+
+
+def halting(programs, max_steps=20000):
+    # The programs that end within max_steps on the plain bytecode loop,
+    # with that run's result
+    for source, data in programs:
+        result = run(source, data, max_steps)
+        if result[1] != 'StepLimitExceeded':
+            yield source, data, result
@@ -0,0 +1,33 @@
+import base64
+import json
+
+from programs import run
+from batch import load_manifest, run_job
+
+
+def test_statuses():
+    assert run_job({'id': 'a', 'source': 'C4_ C4.', 'stdin': 'x'})['status'] == 'ok'
+    assert run_job({'id': 'b', 'source': 'C4 |: :|x00', 'max_steps': 100})['status'] == 'step_limit'
+    assert run_job({'id': 'c', 'source': 'C4 |: :|x00', 'detect_cycles': True})['status'] == 'infinite_loop'
+    result = run_job({'id': 'd', 'source': 'R2'})
+    assert result['status'] == 'error' and 'left of 0' in result['error']
+
+
+def test_output_matches_interpreter():
+    source = 'C4_ |: C4 C4. C4_ :|'
+    result = run_job({'source': source, 'stdin': 'hello', 'optimize': True})
+    assert result['output'].encode('latin-1') == run(source, b'hello')[0]
+
+
+def test_binary_output():
+    result = run_job({'source': 'C4_ C4.', 'stdin_base64': base64.b64encode(b'\xff').decode(), 'binary': True})
+    assert base64.b64decode(result['output_base64']) == b'\xff'
+
+
+def test_manifest_defaults_and_paths(tmp_path):
+    (tmp_path / 'echo.mc').write_text('C4_ C4.')
+    manifest = tmp_path / 'jobs.json'
+    manifest.write_text(json.dumps({'defaults': {'stdin': 'q'}, 'jobs': [{'file': 'echo.mc'}, {'source': 'C5.'}]}))
+    jobs = load_manifest(str(manifest))
+    assert [job['id'] for job in jobs] == [0, 1]
+    assert [run_job(job)['output'] for job in jobs] == ['q', 'H']
@@ -0,0 +1,16 @@
+from programs import SAMPLES, halting, random_programs, run
+
+
+def check(source, data, expected):
+    assert run(source, data, optimize=True, backend='codegen') == expected, source
+    assert run(source, data, backend='codegen') == expected, source
+
+
+def test_samples_match_bytecode():
+    for source, data, expected in halting((source, b'ab') for source in SAMPLES):
+        check(source, data, expected)
+
+
+def test_random_programs_match_bytecode():
+    for source, data, expected in halting(random_programs(600, seed=19)):
+        check(source, data, expected)
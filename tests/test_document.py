@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document import Document
+from interpreter import scan
+
+
+def scanned(doc):
+    return [{k: v for k, v in token.items() if k not in ('length', 'match')} for token in doc.tokens()]
+
+
+def check_edit(text, start, end, new_text):
+    doc = Document(text)
+    doc.edit(start, end, new_text)
+    assert scanned(doc) == list(scan(doc.text))
+
+
+def test_rest_after_bare_loop_end_becomes_its_count():
+    check_edit('|: C4 :| R2 D4', 10, 11, '4')
+
+
+def test_closed_comment_after_bare_loop_end():
+    check_edit('|: C4 :| <!-- note', 18, 18, ' > R4')
+
+
+def test_count_after_bare_loop_end():
+    check_edit('|: C4 :| <!-- c --> x D4', 21, 21, '3')
+
+
+def test_count_taken_away_from_loop_end():
+    check_edit('|: C4 :| R4 D4', 9, 10, 'x')
+    check_edit('|: C4 :|R4 D4', 8, 8, '|')
@@ -0,0 +1,32 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+from programs import SAMPLES, halting, random_programs, run
+from lockstep import run_lockstep
+
+INPUTS = [b'', b'a', b'ab', b'\x01\x02\x03', b'zzzz']
+
+
+def check(source):
+    # Every lane of one lockstep run against its own bytecode run
+    expected = [run(source, data, max_steps=20000) for data in INPUTS]
+    results = run_lockstep(source, INPUTS, max_steps=20000)
+    for data, want, got in zip(INPUTS, expected, results):
+        assert got['output'] == want[0], (source, data)
+        if want[1] == 'StepLimitExceeded':
+            assert got['status'] == 'step_limit', (source, data)
+        elif want[1] is not None:
+            assert got['status'] == 'error', (source, data)
+        else:
+            assert got['status'] == 'ok', (source, data)
+
+
+def test_samples_match_bytecode():
+    for source in SAMPLES:
+        check(source)
+
+
+def test_random_programs_match_bytecode():
+    for source, data, expected in halting(random_programs(300, seed=31)):
+        check(source)
@@ -0,0 +1,21 @@
+from programs import SAMPLES, halting, random_programs, run, sample
+from mcopt import count_notes, optimize_source
+
+
+def test_hello_world_gets_shorter():
+    source = sample('hello_world.mc')
+    optimized = optimize_source(source)
+    assert run(optimized) == run(source)
+    assert count_notes(optimized) < count_notes(source)
+
+
+def test_samples_match_original():
+    for source, data, expected in halting((source, b'ab') for source in SAMPLES):
+        assert run(optimize_source(source), data, max_steps=100000) == expected, source
+
+
+def test_random_programs_match_original():
+    for source, data, expected in halting(random_programs(600, seed=21)):
+        optimized = optimize_source(source)
+        assert count_notes(optimized) <= count_notes(source), source
+        assert run(optimized, data, max_steps=100000) == expected, source
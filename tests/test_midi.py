@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+from programs import SAMPLES, random_programs, sample
+from interpreter import scan
+from mc2mid import MC2MID
+from mid2mc import MID2MC
+
+
+def tokens(source):
+    return [{k: v for k, v in token.items() if k not in ('pos', 'name', 'octave')} for token in scan(source)]
+
+
+def round_trip(source, tmp_path):
+    mc_file = tmp_path / 'score.mc'
+    midi_file = tmp_path / 'score.mid'
+    mc_file.write_text(source)
+    MC2MID(str(mc_file)).write_midi(scan(source), open(midi_file, 'wb'))
+    converter = MID2MC(str(midi_file))
+    converter.parse()
+    return converter.get_code()
+
+
+def test_samples_round_trip(tmp_path):
+    for source in SAMPLES + [sample('hello_world.mc'), sample('loop.mc')]:
+        assert tokens(round_trip(source, tmp_path)) == tokens(source), source
+
+
+def test_random_programs_round_trip(tmp_path):
+    for source, data in random_programs(300, seed=22):
+        assert tokens(round_trip(source, tmp_path)) == tokens(source), source
+
+
+def test_reader_streams_the_same_code(tmp_path):
+    source = sample('hello_world.mc')
+    code = round_trip(source, tmp_path)
+    reader = MID2MC(str(tmp_path / 'score.mid')).reader()
+    assert tokens(reader.read()) == tokens(code)
+
+
+def test_not_a_midi_file_is_rejected(tmp_path):
+    path = tmp_path / 'bad.mid'
+    path.write_bytes(b'RIFF0000')
+    with pytest.raises(ValueError):
+        MID2MC(str(path)).parse()
+
+
+def test_unseekable_stream_matches_file(tmp_path):
+    class Pipe(io.BytesIO):
+        def seekable(self):
+            return False
+
+    source = sample('loop.mc')
+    pipe = Pipe()
+    MC2MID('unused').write_midi(scan(source), pipe)
+    round_trip(source, tmp_path)
+    assert pipe.getvalue() == (tmp_path / 'score.mid').read_bytes()
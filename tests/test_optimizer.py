@@ -0,0 +1,22 @@
+from programs import SAMPLES, halting, random_programs, run, sample
+
+
+def test_sample_files_match_bytecode():
+    for name in ('hello_world.mc', 'loop.mc', 'equal_arithmetic.mc'):
+        source = sample(name)
+        assert run(source, optimize=True) == run(source), name
+
+
+def test_samples_match_bytecode():
+    for source, data, expected in halting((source, b'ab') for source in SAMPLES):
+        assert run(source, data, optimize=True) == expected, source
+
+
+def test_random_programs_match_bytecode():
+    for source, data, expected in halting(random_programs(600, seed=17)):
+        assert run(source, data, optimize=True) == expected, source
+
+
+def test_step_limit_still_applies():
+    source = 'C4 |: :|x00'
+    assert run(source, max_steps=100, optimize=True)[1] == 'StepLimitExceeded'
@@ -0,0 +1,57 @@
+from programs import halting, random_programs
+from interpreter import MusicCoderInterpreter
+from streams import MemoryInput, MemoryOutput
+
+
+def profiled(source, data=b'', max_steps=None):
+    interpreter = MusicCoderInterpreter(source, profile=True, input_source=MemoryInput(data),
+                                        output_sink=MemoryOutput())
+    interpreter.count_steps = True
+    interpreter.max_steps = max_steps
+    return interpreter
+
+
+def executed(interpreter):
+    # Instructions run, counting a note an equal note consumed as one step with it
+    profile = interpreter.profile
+    return sum(profile.counts()) - sum(profile.consumed)
+
+
+def test_counts_match_steps_at_step_limit():
+    for limit in range(1, 12):
+        interpreter = profiled('C4 D4 E4 R4 C4 |: C4 :|x5 D4', max_steps=limit)
+        try:
+            interpreter.run()
+        except Exception:
+            pass
+        assert executed(interpreter) == interpreter.steps
+
+
+def test_counts_match_steps_on_error():
+    interpreter = profiled('C4 |: R2 R2 :|')
+    try:
+        interpreter.run()
+    except RuntimeError:
+        pass
+    assert interpreter.profile.stop_reason == 'error'
+    assert executed(interpreter) == interpreter.steps == 3
+
+
+def test_counts_match_steps_when_paused():
+    interpreter = profiled('C4 D4 E4 |: R4 C4. :|x3 F4')
+    interpreter.step(4)
+    assert interpreter.profile.stop_reason == 'pause'
+    assert executed(interpreter) == interpreter.steps == 4
+    while not interpreter.step(3):
+        assert executed(interpreter) == interpreter.steps
+
+
+def test_counts_match_steps_on_random_programs():
+    for source, data, expected in halting(random_programs(300, seed=9)):
+        for limit in (None, 7):
+            interpreter = profiled(source, data, limit)
+            try:
+                interpreter.run()
+            except Exception:
+                pass
+            assert executed(interpreter) == interpreter.steps, source
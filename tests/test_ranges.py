@@ -0,0 +1,35 @@
+from programs import halting, random_programs
+from interpreter import MusicCoderInterpreter
+from ranges import PointerRanges
+from streams import MemoryInput, MemoryOutput
+
+
+def test_bounds_hold_on_random_programs():
+    for source, data, expected in halting(random_programs(400, seed=23)):
+        for optimize in (False, True):
+            interpreter = MusicCoderInterpreter(source, optimize=optimize, profile=True,
+                                                input_source=MemoryInput(data), output_sink=MemoryOutput())
+            interpreter.compile()
+            ranges = PointerRanges(interpreter.program)
+            try:
+                interpreter.run()
+            except RuntimeError:
+                pass
+            else:
+                # Only runs that fail can hold a move that always fails
+                assert not ranges.underflows, source
+            if ranges.max_ptr is not None:
+                assert interpreter.profile.max_ptr <= ranges.max_ptr, source
+
+
+def test_moves_that_always_fail_are_reported():
+    interpreter = MusicCoderInterpreter('C4 R2 C4.')
+    interpreter.compile()
+    assert PointerRanges(interpreter.program).underflows == [1]
+
+
+def test_moves_in_skipped_loops_are_not_reported():
+    for source in ('|: R2 :| C4.', '|: C#-1 R2 D-1 R4 :| | R4'):
+        interpreter = MusicCoderInterpreter(source, optimize=True)
+        interpreter.compile()
+        assert PointerRanges(interpreter.program).underflows == [], source
@@ -0,0 +1,46 @@
+import asyncio
+import socket
+
+import pytest
+
+from server import Server, _clear_socket, check_run
+
+
+def test_check_run():
+    assert check_run({'op': 'run', 'source': 'C4.'}) is None
+    assert check_run({'op': 'run', 'hash': 'ab', 'max_steps': None}) is None
+    assert check_run({'op': 'run', 'source': 5}) is not None
+    assert check_run({'op': 'run', 'source': 'C4.', 'max_steps': '9'}) is not None
+    assert check_run({'op': 'run', 'source': 'C4.', 'timeout': True}) is not None
+    assert check_run({'op': 'run'}) is not None
+
+
+def test_clear_socket_keeps_other_files(tmp_path):
+    path = tmp_path / 'victim.txt'
+    path.write_text('keep')
+    with pytest.raises(ValueError):
+        _clear_socket(str(path))
+    assert path.read_text() == 'keep'
+
+
+def test_clear_socket_removes_stale_socket(tmp_path):
+    path = str(tmp_path / 'stale.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    _clear_socket(path)
+    _clear_socket(str(tmp_path / 'missing.sock'))
+
+
+def test_run_by_source_then_hash():
+    server = Server(workers=1)
+    server.start()
+    try:
+        first = asyncio.run(server.run({'op': 'run', 'source': 'C4_ C4.', 'stdin': 'z'}))
+        again = asyncio.run(server.run({'op': 'run', 'hash': first['hash'], 'stdin': 'y'}))
+        missing = asyncio.run(server.run({'op': 'run', 'hash': '0' * 64}))
+    finally:
+        server.close()
+    assert (first['status'], first['output']) == ('ok', 'z')
+    assert (again['status'], again['output']) == ('ok', 'y')
+    assert missing['status'] == 'unknown_program'
@@ -0,0 +1,56 @@
+import pytest
+
+from programs import SAMPLES, halting, random_programs
+from interpreter import MusicCoderInterpreter
+from streams import MemoryInput, MemoryOutput
+
+
+def resumed(source, data, steps, optimize):
+    # Runs `steps` instructions, saves a snapshot and finishes the run from
+    # it in a new interpreter, given the same input again
+    first = MusicCoderInterpreter(source, optimize=optimize, input_source=MemoryInput(data),
+                                  output_sink=MemoryOutput())
+    try:
+        if first.step(steps):
+            return first.output_sink.getvalue(), None, bytes(first.tape).rstrip(b'\0')
+    except Exception as e:
+        return first.output_sink.getvalue(), type(e).__name__, None
+    snapshot = first.snapshot()
+
+    second = MusicCoderInterpreter('', input_source=MemoryInput(data), output_sink=MemoryOutput())
+    second.load_snapshot(snapshot)
+    try:
+        second.run()
+    except Exception as e:
+        return first.output_sink.getvalue() + second.output_sink.getvalue(), type(e).__name__, None
+    output = first.output_sink.getvalue() + second.output_sink.getvalue()
+    return output, None, bytes(second.tape).rstrip(b'\0')
+
+
+def test_samples_resume_from_snapshots():
+    for source, data, expected in halting((source, b'ab') for source in SAMPLES):
+        for steps in (1, 2, 5, 13):
+            assert resumed(source, data, steps, False) == expected, (source, steps)
+
+
+def test_random_programs_resume_from_snapshots():
+    for i, (source, data, expected) in enumerate(halting(random_programs(300, seed=5))):
+        assert resumed(source, data, 1 + i % 17, i % 2 == 1) == expected, source
+
+
+def test_stepping_matches_one_run():
+    for source, data, expected in halting(random_programs(200, seed=6)):
+        interpreter = MusicCoderInterpreter(source, input_source=MemoryInput(data), output_sink=MemoryOutput())
+        try:
+            while not interpreter.step(3):
+                pass
+        except Exception as e:
+            assert expected[1] == type(e).__name__, source
+        else:
+            assert (interpreter.output_sink.getvalue(), None, bytes(interpreter.tape).rstrip(b'\0')) == expected
+
+
+def test_bad_snapshot_is_rejected():
+    interpreter = MusicCoderInterpreter('C4.')
+    with pytest.raises(ValueError):
+        interpreter.load_snapshot(b'MCS\0')
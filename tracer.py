@@ -0,0 +1,159 @@
+import argparse
+import struct
+from array import array
+from collections import deque
+
+# Trace file: a header, then one fixed-size record per sampled step.
+# Written by Trace, read back by read_trace() or `python tracer.py FILE`.
+MAGIC = b'MCT\0'
+HEADER = struct.Struct('<4sIIB') # magic, version, sampling interval, optimized program
+VERSION = 1
+RECORD = struct.Struct('<QIqBB') # step, pc, ptr, cell, previous note
+
+DEFAULT_RING_SIZE = 65536
+# Records collected before a streaming trace writes them out
+FLUSH_RECORDS = 4096
+
+
+# Records (step, pc, ptr, cell, prev) for every `every`-th executed
+# instruction, before it runs. Without a stream the last `size` records are
+# kept in a preallocated ring buffer and written out by save(); with a
+# binary stream every record is written to it in batches.
+class Trace:
+    def __init__(self, size=DEFAULT_RING_SIZE, every=1, stream=None, optimized=False):
+        self.every = max(every, 1)
+        self.stream = stream
+        self.optimized = optimized
+        self.count = 0 # Records taken so far
+        if stream is not None:
+            stream.write(HEADER.pack(MAGIC, VERSION, self.every, optimized))
+            self.buffer = bytearray()
+            self.size = 0
+        else:
+            self.size = max(size, 1)
+            self.steps = array('Q', [0]) * self.size
+            self.pcs = array('I', [0]) * self.size
+            self.ptrs = array('q', [0]) * self.size
+            self.cells = bytearray(self.size)
+            self.prevs = bytearray(self.size)
+
+    def record(self, step, pc, ptr, cell, prev):
+        if self.stream is not None:
+            self.buffer += RECORD.pack(step, pc, ptr, cell, prev)
+            self.count += 1
+            if len(self.buffer) >= FLUSH_RECORDS * RECORD.size:
+                self.flush()
+            return
+        i = self.count % self.size
+        self.steps[i] = step
+        self.pcs[i] = pc
+        self.ptrs[i] = ptr
+        self.cells[i] = cell
+        self.prevs[i] = prev
+        self.count += 1
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.write(self.buffer)
+            self.buffer.clear()
+            self.stream.flush()
+
+    def records(self):
+        # Ring buffer contents, oldest first
+        if self.stream is not None:
+            raise ValueError("A streaming trace keeps no records in memory")
+        kept = min(self.count, self.size)
+        for k in range(self.count - kept, self.count):
+            i = k % self.size
+            yield self.steps[i], self.pcs[i], self.ptrs[i], self.cells[i], self.prevs[i]
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.every, self.optimized))
+            for record in self.records():
+                f.write(RECORD.pack(*record))
+
+
+def read_header(f):
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise ValueError("Not a MusicCoder trace")
+    magic, version, every, optimized = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a MusicCoder trace for this version")
+    return every, bool(optimized)
+
+
+def read_trace(f):
+    # Yields (step, pc, ptr, cell, prev) from an open binary trace file
+    # positioned after its header
+    while True:
+        data = f.read(RECORD.size * FLUSH_RECORDS)
+        if not data:
+            return
+        usable = len(data) - len(data) % RECORD.size # A crash may leave half a record
+        yield from RECORD.iter_unpack(data[:usable])
+        if usable < len(data):
+            return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode and filter a MusicCoder execution trace.")
+    parser.add_argument("trace_file")
+    parser.add_argument("--source", metavar="FILE",
+                        help="Program that produced the trace, to show instruction names and positions")
+    parser.add_argument("--pc", type=int, action="append", help="Only records at this pc (repeatable)")
+    parser.add_argument("--ptr", type=int, action="append", help="Only records with the pointer here (repeatable)")
+    parser.add_argument("--cell", type=int, help="Only records where the current cell holds this value")
+    parser.add_argument("--from-step", type=int, default=0, help="Skip records before this step")
+    parser.add_argument("--to-step", type=int, default=None, help="Stop after this step")
+    parser.add_argument("--tail", type=int, default=None, help="Only the last N matching records")
+    args = parser.parse_args()
+
+    program = None
+    source = None
+    if args.source:
+        # Imported here, the interpreter imports this module
+        from interpreter import MusicCoderInterpreter
+        from bytecode import OP_NAMES
+    pcs = set(args.pc) if args.pc else None
+    ptrs = set(args.ptr) if args.ptr else None
+
+    with open(args.trace_file, 'rb') as f:
+        every, optimized = read_header(f)
+        if args.source:
+            with open(args.source, 'r') as s:
+                source = s.read()
+            program = MusicCoderInterpreter(source, optimize=optimized).compile()
+
+        matches = deque(maxlen=args.tail)
+        for step, pc, ptr, cell, prev in read_trace(f):
+            if step < args.from_step:
+                continue
+            if args.to_step is not None and step > args.to_step:
+                break
+            if pcs is not None and pc not in pcs:
+                continue
+            if ptrs is not None and ptr not in ptrs:
+                continue
+            if args.cell is not None and cell != args.cell:
+                continue
+
+            line = f"STEP={step}, PC={pc}, Ptr={ptr}, Val={cell}, PrevNote={prev}"
+            if program is not None and pc < len(program):
+                name = OP_NAMES[program.code[pc]]
+                pos = program.positions[pc]
+                if pos >= 0:
+                    line_no = source.count('\n', 0, pos) + 1
+                    col = pos - (source.rfind('\n', 0, pos) + 1) + 1
+                    line += f", Token={name} at {line_no}:{col}"
+                else:
+                    line += f", Token={name}"
+
+            if args.tail is not None:
+                matches.append(line)
+            else:
+                print(line)
+
+        for line in matches:
+            print(line)
@@ -1,114 +1,219 @@
+import argparse
 import sys
 import xml.etree.ElementTree as ET
 from interpreter import MusicCoderInterpreter
 
 
+# Characters handed out per read() by CodeReader
+READ_SIZE = 65536
+
+
+def measure_tokens(measure):
+    # Raw tokens of one <measure>, barlines and notes in order
+    for child in measure:
+        if child.tag == 'barline':
+            repeat = child.find('repeat')
+            if repeat is not None:
+                direction = repeat.get('direction')
+                if direction == 'start' or direction == 'forward':
+                    yield {'type': 'BARLINE', 'value': '|:'}
+                elif direction == 'backward':
+                    yield {'type': 'BARLINE', 'value': ':|'}
+        
+        elif child.tag == 'note':
+            # Check for Rest
+            rest = child.find('rest')
+            if rest is not None:
+                duration = child.find('duration')
+                dur_val = 1
+                if duration is not None:
+                    dur_val = int(duration.text)
+                
+                token_str = 'R2' if dur_val >= 2 else 'R4'
+                yield {'type': 'REST', 'value': token_str}
+                continue
+            
+            # Pitch
+            pitch = child.find('pitch')
+            if pitch is not None:
+                step = pitch.find('step').text
+                alter_elem = pitch.find('alter')
+                alter = int(alter_elem.text) if alter_elem is not None else 0
+                octave_elem = pitch.find('octave')
+                octave = int(octave_elem.text) if octave_elem is not None else 4
+                
+                # Reconstruct Note Name
+                note_name = step
+                if alter == 1:
+                    note_name += '#'
+                elif alter == -1:
+                    note_name += 'B'
+                    
+                # Articulations (Staccato)
+                staccato = False
+                notations = child.find('notations')
+                if notations is not None:
+                    articulations = notations.find('articulations')
+                    if articulations is not None:
+                        if articulations.find('staccato') is not None:
+                            staccato = True
+                            
+                yield {
+                    'type': 'NOTE',
+                    'name': note_name,
+                    'octave': octave,
+                    'staccato': staccato
+                }
+
+
+def resolve_token(token):
+    # MusicCoder source text of one raw token
+    if token['type'] == 'BARLINE' or token['type'] == 'REST':
+        return token['value']
+    
+    note_str = token['name']
+    octave = token['octave']
+    
+    # Append octave if not 4 (default)
+    if octave != 4:
+        note_str += str(octave)
+    
+    if token['staccato']:
+        note_str += "."
+        
+    return note_str
+
+
+def list_parts(xml_file):
+    # (id, name) of every part in the <part-list>, read without loading
+    # the rest of the score
+    parts = []
+    for event, elem in ET.iterparse(xml_file, events=('end',)):
+        if elem.tag == 'score-part':
+            name = elem.find('part-name')
+            parts.append((elem.get('id'), name.text if name is not None else None))
+        elif elem.tag == 'part-list':
+            break
+    return parts
+
+
+# File-like view of MusicCoder source produced piece by piece, so the
+# interpreter's stream scanner can tokenize it without the whole string
+class CodeReader:
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.buffer = ''
+        self.first = True
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            piece = next(self.pieces, None)
+            if piece is None:
+                break
+            if not self.first:
+                piece = " " + piece
+            self.first = False
+            chunks.append(piece)
+            length += len(piece)
+        text = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return text
+        self.buffer = text[size:]
+        return text[:size]
+
+
 class XML2MC:
-    def __init__(self, xml_file):
+    def __init__(self, xml_file, part_id=None):
         self.xml_file = xml_file
+        self.part_id = part_id # Only this part; all parts in order when None
         self.raw_tokens = []
         self.mc_tokens = []
+
+    def iter_raw_tokens(self):
+        # Streams the score with iterparse, yielding each measure's tokens
+        # once it has been read and then dropping it, so memory does not
+        # grow with the length of the score
+        depth = 0
+        root = None
+        part = None # <part> being read
+        selected = False
+        found = False
+        for event, elem in ET.iterparse(self.xml_file, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2:
+                    part = elem
+                    selected = elem.tag == 'part' and (self.part_id is None or elem.get('id') == self.part_id)
+                    found = found or selected
+                continue
+
+            depth -= 1
+            if depth == 1:
+                root.remove(elem)
+            elif depth == 2:
+                if selected and elem.tag == 'measure':
+                    yield from measure_tokens(elem)
+                part.remove(elem)
+
+        if self.part_id is not None and not found:
+            ids = ", ".join(str(part_id) for part_id, name in list_parts(self.xml_file))
+            raise ValueError(f"No part with id {self.part_id!r} (parts: {ids or 'none'})")
+
+    def iter_code(self):
+        # MusicCoder tokens as text, in order
+        for token in self.iter_raw_tokens():
+            yield resolve_token(token)
+
+    def reader(self):
+        # The recovered source as a file object, for MusicCoderInterpreter
+        return CodeReader(self.iter_code())
         
     def parse(self):
-        tree = ET.parse(self.xml_file)
-        root = tree.getroot()
-        
-        # Traverse parts (assuming P1 for now or iterate all)
-        for part in root.findall('part'):
-            for measure in part.findall('measure'):
-                # Check for barlines and notes in order
-                for child in measure:
-                    if child.tag == 'barline':
-                        repeat = child.find('repeat')
-                        if repeat is not None:
-                            direction = repeat.get('direction')
-                            if direction == 'start' or direction == 'forward':
-                                self.raw_tokens.append({'type': 'BARLINE', 'value': '|:'})
-                            elif direction == 'backward':
-                                self.raw_tokens.append({'type': 'BARLINE', 'value': ':|'})
-                    
-                    elif child.tag == 'note':
-                        # Check for Rest
-                        rest = child.find('rest')
-                        if rest is not None:
-                            duration = child.find('duration')
-                            dur_val = 1
-                            if duration is not None:
-                                dur_val = int(duration.text)
-                            
-                            token_str = 'R2' if dur_val >= 2 else 'R4'
-                            self.raw_tokens.append({'type': 'REST', 'value': token_str})
-                            continue
-                        
-                        # Pitch
-                        pitch = child.find('pitch')
-                        if pitch is not None:
-                            step = pitch.find('step').text
-                            alter_elem = pitch.find('alter')
-                            alter = int(alter_elem.text) if alter_elem is not None else 0
-                            octave_elem = pitch.find('octave')
-                            octave = int(octave_elem.text) if octave_elem is not None else 4
-                            
-                            # Reconstruct Note Name
-                            note_name = step
-                            if alter == 1:
-                                note_name += '#'
-                            elif alter == -1:
-                                note_name += 'B'
-                                
-                            # Articulations (Staccato)
-                            staccato = False
-                            notations = child.find('notations')
-                            if notations is not None:
-                                articulations = notations.find('articulations')
-                                if articulations is not None:
-                                    if articulations.find('staccato') is not None:
-                                        staccato = True
-                                        
-                            self.raw_tokens.append({
-                                'type': 'NOTE',
-                                'name': note_name,
-                                'octave': octave,
-                                'staccato': staccato
-                            })
+        self.raw_tokens.extend(self.iter_raw_tokens())
 
     def resolve_tokens(self):
-        for i, token in enumerate(self.raw_tokens):
-            if token['type'] == 'BARLINE' or token['type'] == 'REST':
-                self.mc_tokens.append(token['value'])
-                continue
-            
-            if token['type'] == 'NOTE':
-                note_str = token['name']
-                octave = token['octave']
-                
-                # Append octave if not 4 (default)
-                if octave != 4:
-                    note_str += str(octave)
-                
-                if token['staccato']:
-                    note_str += "."
-                    
-                self.mc_tokens.append(note_str)
+        for token in self.raw_tokens:
+            self.mc_tokens.append(resolve_token(token))
 
     def get_code(self):
         return " ".join(self.mc_tokens)
 
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python xml2mc.py <xml_file>")
-        sys.exit(1)
-        
-    xml_file = sys.argv[1]
-    converter = XML2MC(xml_file)
-    converter.parse()
-    converter.resolve_tokens()
-    code = converter.get_code()
-    
-    print("Recovered MC Code:")
-    print(code)
+    parser = argparse.ArgumentParser(description="Convert MusicXML back to MusicCoder and run it.")
+    parser.add_argument("xml_file")
+    parser.add_argument("--part", metavar="ID", help="Only convert the part with this id (default: all parts)")
+    parser.add_argument("--list-parts", action="store_true", help="Print the part ids and names, then exit")
+    parser.add_argument("--no-run", action="store_true",
+                        help="Only print the recovered code, streamed as the score is read")
+    args = parser.parse_args()
+
+    if args.list_parts:
+        for part_id, name in list_parts(args.xml_file):
+            print(f"{part_id}\t{name or ''}")
+        sys.exit(0)
+
+    converter = XML2MC(args.xml_file, args.part)
+    # The score is read twice, once to print the code and once by the
+    # interpreter, so the recovered source is never held in memory
+    reader = converter.reader()
+    if not args.no_run:
+        print("Recovered MC Code:")
+    while True:
+        chunk = reader.read(READ_SIZE)
+        if not chunk:
+            break
+        sys.stdout.write(chunk)
+    print()
+    if args.no_run:
+        sys.exit(0)
     print("-" * 20)
     print("Executing Code:")
     
-    interpreter = MusicCoderInterpreter(code)
+    interpreter = MusicCoderInterpreter(converter.reader())
     interpreter.run()